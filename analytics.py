@@ -0,0 +1,141 @@
+"""
+Batched analytics ingestion.
+
+Player events are buffered in memory per worker process and written in a
+single transaction once FLUSH_SIZE events have queued up or FLUSH_INTERVAL
+seconds have passed, instead of one write transaction per event. The
+play_count / total_watch_time updates are aggregated per media item, so a
+flush issues one UPDATE per item no matter how many events it carries.
+"""
+
+import os
+import json
+import atexit
+import sqlite3
+import threading
+import time
+
+FLUSH_SIZE = int(os.environ.get('ANALYTICS_FLUSH_SIZE', 200))
+FLUSH_INTERVAL = float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', 5))
+MAX_PENDING = int(os.environ.get('ANALYTICS_MAX_PENDING', 10000))
+MAX_BATCH_EVENTS = 100
+
+
+class AnalyticsBuffer:
+    def __init__(self, connect, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.connect = connect
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._events = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer_pid = None
+        self._stats = {'received': 0, 'flushed': 0, 'flushes': 0, 'dropped': 0, 'failed_flushes': 0}
+        atexit.register(self.flush)
+
+    def record(self, data):
+        """Queue one event payload as sent by the player"""
+        if not isinstance(data, dict) or not data.get('filename'):
+            return
+        self._ensure_timer()
+
+        try:
+            watch_time = float(data.get('watch_time') or 0)
+        except (TypeError, ValueError):
+            watch_time = 0
+
+        event = (data['filename'], data.get('event_type'), watch_time, json.dumps(data))
+        with self._lock:
+            self._events.append(event)
+            self._stats['received'] += 1
+            self._trim()
+            should_flush = len(self._events) >= self.flush_size
+
+        if should_flush:
+            self.flush()
+
+    def record_many(self, events):
+        for data in events[:MAX_BATCH_EVENTS]:
+            self.record(data)
+
+    def _trim(self):
+        # Never let a stuck database grow the buffer without bound
+        overflow = len(self._events) - self.max_pending
+        if overflow > 0:
+            del self._events[:overflow]
+            self._stats['dropped'] += overflow
+
+    def _ensure_timer(self):
+        pid = os.getpid()
+        if self._timer_pid == pid:
+            return
+        with self._lock:
+            if self._timer_pid == pid:
+                return
+            self._timer_pid = pid
+        threading.Thread(target=self._run_timer, daemon=True).start()
+
+    def _run_timer(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write all buffered events in one transaction"""
+        with self._flush_lock:
+            with self._lock:
+                events, self._events = self._events, []
+            if not events:
+                return 0
+
+            try:
+                self._write(events)
+            except sqlite3.Error:
+                with self._lock:
+                    self._events[:0] = events
+                    self._stats['failed_flushes'] += 1
+                    self._trim()
+                return 0
+
+            with self._lock:
+                self._stats['flushed'] += len(events)
+                self._stats['flushes'] += 1
+            return len(events)
+
+    def _write(self, events):
+        deltas = {}
+        for filename, event_type, watch_time, _ in events:
+            plays, seconds = deltas.get(filename, (0, 0))
+            deltas[filename] = (plays + (event_type == 'play'), seconds + max(watch_time, 0))
+
+        conn = self.connect()
+        try:
+            filenames = list(deltas)
+            ids = {}
+            # Chunk the IN list to stay under SQLite's bound-parameter limit
+            for i in range(0, len(filenames), 500):
+                chunk = filenames[i:i + 500]
+                placeholders = ','.join('?' * len(chunk))
+                for row in conn.execute(f'SELECT id, filename FROM media WHERE filename IN ({placeholders})', chunk):
+                    ids[row[1]] = row[0]
+
+            # Any event counts as an access; storage eviction keeps recently watched media
+            conn.executemany(
+                '''UPDATE media SET play_count = play_count + ?, total_watch_time = total_watch_time + ?,
+                   last_accessed = CURRENT_TIMESTAMP WHERE id = ?''',
+                [(plays, seconds, ids[f]) for f, (plays, seconds) in deltas.items() if f in ids]
+            )
+            conn.executemany(
+                'INSERT INTO analytics (media_id, event_type, data) VALUES (?, ?, ?)',
+                [(ids[f], event_type, data) for f, event_type, _, data in events if f in ids]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['pending'] = len(self._events)
+        return snapshot
@@ -1,17 +1,39 @@
 import os
-import re
-import mimetypes
-import sqlite3
 import json
+import zlib
+import time
+import uuid
+import mimetypes
 from datetime import datetime, timedelta
 from flask import Flask, render_template, request, Response, jsonify, send_file
 from werkzeug.utils import secure_filename
-import pysrt
-import webvtt
 import m3u8
 import requests
+import db
+import migrations
+from streaming import stream_file, file_etag, is_not_modified, IMMUTABLE_CACHE_CONTROL
+import upstream
+from segment_cache import segment_cache, is_segment_url
+from manifest_cache import manifest_cache, is_playlist_url
+from analytics import AnalyticsBuffer
+import library
+import uploads
+import blobstore
+from probe import ProbeQueue
+import subtitles as subtitle_store
+import playlist_parser
+import playlist_cache
+import playlist_health
+import cleanup
+import quota
+import hls_packager
+import transcode
+import webm_remux
+import previews
+import assets
 
 app = Flask(__name__)
+app.jinja_env.globals['asset_url'] = assets.asset_url
 app.secret_key = os.environ.get('SESSION_SECRET', 'dev-secret-key-change-in-production')
 
 UPLOAD_FOLDER = 'static/uploads'
@@ -23,13 +45,32 @@ ALLOWED_SUBTITLE_EXTENSIONS = {'srt', 'vtt'}
 ALLOWED_PLAYLIST_EXTENSIONS = {'m3u', 'm3u8'}
 MAX_FILE_SIZE = 100 * 1024 * 1024
 MAX_SUBTITLE_SIZE = 5 * 1024 * 1024
+# Seconds one /cleanup request may spend deleting before it returns
+CLEANUP_TIME_BUDGET = 20
+# Reject oversized request bodies from Content-Length before reading them;
+# the slack covers multipart framing around a MAX_FILE_SIZE upload
+app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + 1024 * 1024
+ALLOWED_RECORDING_TYPES = {'video', 'audio'}
+
+# User agent mapping for proxy_browse
+USER_AGENTS = {
+    'chrome-windows': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'chrome-mac': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'firefox-windows': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'firefox-mac': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'safari-mac': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15',
+    'edge-windows': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0',
+    'chrome-android': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+    'safari-ios': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Mobile/15E148 Safari/604.1',
+    'firefox-android': 'Mozilla/5.0 (Android 10; Mobile; rv:121.0) Gecko/121.0 Firefox/121.0'
+}
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(SUBTITLE_FOLDER, exist_ok=True)
 os.makedirs(VPN_FOLDER, exist_ok=True)
 
 def init_db():
-    conn = sqlite3.connect('mediafusion.db')
+    conn = db.connect()
     c = conn.cursor()
     
     c.execute('''CREATE TABLE IF NOT EXISTS media
@@ -68,6 +109,7 @@ def init_db():
                   is_active INTEGER DEFAULT 0)''')
     
     conn.commit()
+    migrations.migrate(conn)
     conn.close()
 
 init_db()
@@ -76,9 +118,35 @@ def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
 def get_db():
-    conn = sqlite3.connect('mediafusion.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    return db.get_connection()
+
+analytics_buffer = AnalyticsBuffer(get_db)
+probe_queue = ProbeQueue(get_db, UPLOAD_FOLDER)
+remux_queue = webm_remux.RemuxQueue(get_db, UPLOAD_FOLDER)
+preview_queue = previews.PreviewQueue(get_db, UPLOAD_FOLDER)
+storage_quota = quota.StorageQuota(get_db, UPLOAD_FOLDER, SUBTITLE_FOLDER)
+transcoder = transcode.TranscodeWorker(get_db, UPLOAD_FOLDER)
+
+@app.before_request
+def start_background_workers():
+    # Once per worker process; picks up work queued before a restart
+    probe_queue.start()
+    remux_queue.start()
+    preview_queue.start()
+    if transcode.IN_APP:
+        transcoder.start()
+
+def browse_headers(user_agent_type):
+    """Request headers proxy_browse sends upstream for the chosen browser profile"""
+    return {
+        'User-Agent': USER_AGENTS.get(user_agent_type, USER_AGENTS['chrome-windows']),
+        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+        'Accept-Language': 'en-US,en;q=0.5',
+        'Accept-Encoding': 'gzip, deflate, br',
+        'DNT': '1',
+        'Connection': 'keep-alive',
+        'Upgrade-Insecure-Requests': '1'
+    }
 
 @app.route('/health')
 def health():
@@ -88,6 +156,39 @@ def health():
         'version': '1.0.0'
     }), 200
 
+@app.route('/proxy_stats')
+def proxy_stats():
+    """Per-worker counters for the upstream pool and the proxy caches"""
+    return jsonify({
+        'upstream': upstream.stats(),
+        'segments': segment_cache.stats(),
+        'manifests': manifest_cache.stats(),
+        'hls': hls_packager.stats(),
+        'transcode': transcoder.stats(),
+        'previews': preview_queue.stats()
+    })
+
+@app.route('/static/dist/<path:name>')
+def static_asset(name):
+    # Content-hashed by assets.py, so safe to cache forever
+    path = assets.dist_file(name)
+    if path is None:
+        return "File not found", 404
+    path, encoding = assets.negotiate(path, request.accept_encodings)
+    response = stream_file(request.environ, path, request.headers, mimetype=assets.mimetype(name))
+    response.headers['Vary'] = 'Accept-Encoding'
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.route('/static/sw.js')
+def service_worker():
+    # Fixed URL, revalidated on every load so a new build is picked up
+    response = stream_file(request.environ, assets.service_worker(), request.headers,
+                           mimetype='text/javascript', cache_control='no-cache')
+    response.headers['Service-Worker-Allowed'] = '/'
+    return response
+
 @app.route('/favicon.ico')
 def favicon():
     return send_file('static/favicon.ico', mimetype='image/x-icon')
@@ -98,10 +199,8 @@ def manifest():
 
 @app.route('/')
 def index():
-    conn = get_db()
-    media_files = conn.execute('SELECT * FROM media ORDER BY upload_date DESC').fetchall()
-    conn.close()
-    rv = render_template('index.html', media_files=media_files)
+    # The library is loaded page by page from /api/library by the page itself
+    rv = render_template('index.html')
     response = app.make_response(rv)
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
@@ -117,12 +216,16 @@ def player():
     conn = get_db()
     media = conn.execute('SELECT * FROM media WHERE filename = ?', (filename,)).fetchone()
     subtitles = conn.execute('SELECT * FROM subtitles WHERE media_id = ?', (media['id'],)).fetchall() if media else []
+    job = transcode.job_for_media(conn, media['id']) if media else None
     conn.close()
+    transcoded = job is not None and job['status'] == 'done'
     
     if not media:
         return "File not found", 404
     
-    rv = render_template('player.html', media=media, subtitles=subtitles)
+    rv = render_template('player.html', media=media, subtitles=subtitles, transcoded=transcoded,
+                         hls_available=hls_packager.can_package(media),
+                         previews=previews.urls(media['id'], media['preview_key'], media['file_type']))
     response = app.make_response(rv)
     response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
     response.headers['Pragma'] = 'no-cache'
@@ -166,6 +269,82 @@ def settings():
 #     response.headers['Expires'] = '0'
 #     return response
 
+def unique_suffix():
+    # Uploads of one name within the same second must still get distinct files
+    return uuid.uuid4().hex[:8]
+
+def timestamped_filename(original_name):
+    name, ext = os.path.splitext(secure_filename(original_name))
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    return f"{name}_{timestamp}_{unique_suffix()}{ext}"
+
+def recording_filename(recording_type, timestamp):
+    return f"{webm_remux.RECORDING_PREFIX}{recording_type}_{timestamp}_{unique_suffix()}.webm"
+
+def media_file_type(filename):
+    ext = filename.rsplit('.', 1)[-1].lower()
+    return 'video' if ext in ALLOWED_VIDEO_EXTENSIONS else 'audio' if ext in ALLOWED_AUDIO_EXTENSIONS else 'playlist'
+
+def is_allowed_media_mime(mime_type):
+    return not mime_type or any(mime_type.startswith(prefix) for prefix in ['video/', 'audio/', 'application/'])
+
+def record_media(path, digest, filename, original_name, file_type, file_size, mime_type):
+    """Move a hashed upload into the blob store, expose it as
+    UPLOAD_FOLDER/filename and insert its media row. Returns
+    (media_id, duplicate), duplicate being True when the content was
+    already stored."""
+    conn = get_db()
+    upload_path = os.path.join(UPLOAD_FOLDER, filename)
+    linked = False
+    # The blob's reference is taken under the write lock, so a concurrent
+    # delete of the last other row cannot remove the blob kept here
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        duplicate = blobstore.put(conn, path, digest, file_size)
+        # The row first: a filename already taken fails here, before any file
+        # of the media that owns it is touched
+        c = conn.cursor()
+        c.execute('''INSERT INTO media (filename, original_name, file_type, file_size, mime_type, blob_digest)
+                     VALUES (?, ?, ?, ?, ?, ?)''', (filename, original_name, file_type, file_size, mime_type, digest))
+        media_id = c.lastrowid
+        blobstore.link(digest, upload_path, replace=False)
+        linked = True
+        if file_type in transcode.TRANSCODED_TYPES:
+            transcode.enqueue(conn, media_id, transcode.default_priority(mime_type))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if linked:
+            os.remove(upload_path)
+        if os.path.lexists(path):
+            os.remove(path)
+        blobstore.remove(conn, [digest])
+        raise
+    finally:
+        conn.close()
+    # Duration, codecs and resolution are filled in by the background prober
+    probe_queue.enqueue(media_id)
+    # MediaRecorder output gets Duration and Cues so it can be seeked
+    if webm_remux.is_recording(filename, mime_type):
+        remux_queue.enqueue(media_id)
+    if file_type in previews.PREVIEW_TYPES:
+        preview_queue.enqueue(media_id)
+    transcoder.wake()
+    storage_quota.check()
+    return media_id, duplicate
+
+def make_room(size):
+    """Evict cold media if an upload of `size` bytes would not fit.
+    Returns an error response when there is no room, else None."""
+    conn = get_db()
+    try:
+        storage_quota.ensure_room(conn, size)
+    except quota.QuotaExceeded as e:
+        return jsonify({'error': str(e)}), 507
+    finally:
+        conn.close()
+    return None
+
 @app.route('/upload', methods=['POST'])
 def upload_file():
     if 'file' not in request.files:
@@ -187,45 +366,30 @@ def upload_file():
         return jsonify({'error': f'File too large. Maximum size is {MAX_FILE_SIZE / 1024 / 1024}MB'}), 400
     
     original_name = file.filename
-    filename = secure_filename(file.filename)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    name, ext = os.path.splitext(filename)
-    filename = f"{name}_{timestamp}{ext}"
+    filename = timestamped_filename(original_name)
     
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
-    try:
-        file.save(filepath)
-    except Exception as e:
-        return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
-    
-    detected_mime = mimetypes.guess_type(filepath)[0]
-    allowed_mimes = {
-        'video/mp4', 'video/x-msvideo', 'video/x-matroska', 'video/quicktime',
-        'video/webm', 'video/ogg', 'audio/mpeg', 'audio/wav', 'audio/ogg',
-        'audio/flac', 'audio/aac', 'application/vnd.apple.mpegurl', 'application/x-mpegURL'
-    }
-    
-    if detected_mime and not any(detected_mime.startswith(prefix) for prefix in ['video/', 'audio/', 'application/']):
-        os.remove(filepath)
+    detected_mime = mimetypes.guess_type(filename)[0]
+    if not is_allowed_media_mime(detected_mime):
         return jsonify({'error': 'Invalid file type detected'}), 400
     
-    file_size = os.path.getsize(filepath)
-    mime_type = mimetypes.guess_type(filepath)[0]
-    file_type = 'video' if ext[1:].lower() in ALLOWED_VIDEO_EXTENSIONS else 'audio' if ext[1:].lower() in ALLOWED_AUDIO_EXTENSIONS else 'playlist'
+    no_room = make_room(file_length)
+    if no_room:
+        return no_room
     
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT INTO media (filename, original_name, file_type, file_size, mime_type)
-                 VALUES (?, ?, ?, ?, ?)''', (filename, original_name, file_type, file_size, mime_type))
-    media_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    file_type = media_file_type(filename)
+    try:
+        tmp_path, digest, file_size = blobstore.save_stream(file.stream)
+        media_id, duplicate = record_media(tmp_path, digest, filename, original_name, file_type, file_size,
+                                           detected_mime)
+    except Exception as e:
+        return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
     
     return jsonify({
         'success': True,
         'filename': filename,
         'media_id': media_id,
-        'file_type': file_type
+        'file_type': file_type,
+        'deduplicated': duplicate
     })
 
 @app.route('/stream/<path:filename>')
@@ -235,51 +399,126 @@ def stream_media(filename):
     if not os.path.exists(file_path):
         return "File not found", 404
     
-    range_header = request.headers.get('Range', None)
-    size = os.path.getsize(file_path)
-    
-    if not range_header:
-        rv = send_file(file_path)
-        rv.headers.add('Accept-Ranges', 'bytes')
-        rv.headers.add('Cache-Control', 'no-cache, no-store, must-revalidate')
-        rv.headers.add('Pragma', 'no-cache')
-        rv.headers.add('Expires', '0')
-        rv.headers.add('Content-Length', str(size))
-        return rv
-    
-    byte1, byte2 = 0, None
-    
-    match = re.search(r'(\d+)-(\d*)', range_header)
-    if match:
-        groups = match.groups()
-        if groups[0]:
-            byte1 = int(groups[0])
-        if groups[1]:
-            byte2 = int(groups[1])
-    
-    if byte2 is None:
-        byte2 = size - 1
-    
-    if byte1 >= size or byte2 >= size or byte1 > byte2:
-        rv = Response('Requested Range Not Satisfiable', 416)
-        rv.headers.add('Content-Range', f'bytes */{size}')
-        return rv
-    
-    length = byte2 - byte1 + 1
-    
-    with open(file_path, 'rb') as f:
-        f.seek(byte1)
-        data = f.read(length)
-    
-    rv = Response(data, 206, mimetype=mimetypes.guess_type(file_path)[0], direct_passthrough=True)
-    rv.headers.add('Content-Range', f'bytes {byte1}-{byte2}/{size}')
-    rv.headers.add('Accept-Ranges', 'bytes')
-    rv.headers.add('Content-Length', str(length))
-    rv.headers.add('Cache-Control', 'no-cache, no-store, must-revalidate')
-    rv.headers.add('Pragma', 'no-cache')
-    rv.headers.add('Expires', '0')
-    
-    return rv
+    return stream_file(request.environ, file_path, request.headers, cache_control=stream_cache_control(filename))
+
+def stream_cache_control(filename):
+    """Uploads never change, except recordings still waiting for the
+    background remux, which is rewritten under the same name: those must be
+    revalidated until it is done"""
+    if not filename.lower().endswith('.webm'):
+        return IMMUTABLE_CACHE_CONTROL
+    conn = get_db()
+    try:
+        row = conn.execute('SELECT mime_type, remux_status FROM media WHERE filename = ?', (filename,)).fetchone()
+    finally:
+        conn.close()
+    if row and webm_remux.is_recording(filename, row['mime_type']) and row['remux_status'] in (None, 'remuxing'):
+        return 'no-cache'
+    return IMMUTABLE_CACHE_CONTROL
+
+def packaged_media(media_id):
+    """The media row if it can be served as HLS, else an error response"""
+    if not hls_packager.available():
+        return None, (jsonify({'error': 'HLS packaging needs ffmpeg'}), 503)
+    conn = get_db()
+    media = conn.execute('SELECT id, filename, file_type, duration FROM media WHERE id = ?', (media_id,)).fetchone()
+    conn.close()
+    if not media or not hls_packager.can_package(media):
+        return None, (jsonify({'error': 'Media not available as HLS'}), 404)
+    return media, None
+
+@app.route('/hls/<int:media_id>/index.m3u8')
+def hls_playlist(media_id):
+    media, error = packaged_media(media_id)
+    if error:
+        return error
+    response = Response(hls_packager.playlist(media), mimetype='application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/hls/<int:media_id>/<int:index>.ts')
+def hls_segment(media_id, index):
+    media, error = packaged_media(media_id)
+    if error:
+        return error
+    source = os.path.join(UPLOAD_FOLDER, media['filename'])
+    if not os.path.exists(source):
+        return "File not found", 404
+    try:
+        path = hls_packager.segment(source, media, index)
+    except IndexError:
+        return "Segment not found", 404
+    except hls_packager.PackagingError as e:
+        return jsonify({'error': f'Packaging failed: {str(e)}'}), 500
+    return stream_file(request.environ, path, request.headers, mimetype='video/mp2t',
+                       cache_control='public, max-age=3600')
+
+@app.route('/transcoded/<int:media_id>/<path:name>')
+def transcoded_file(media_id, name):
+    path = transcode.output_file(media_id, name)
+    if path is None:
+        return "File not found", 404
+    if name.endswith('.m3u8'):
+        return stream_file(request.environ, path, request.headers, mimetype='application/vnd.apple.mpegurl',
+                           cache_control='no-cache')
+    return stream_file(request.environ, path, request.headers, mimetype='video/mp2t',
+                       cache_control='public, max-age=3600')
+
+@app.route('/previews/<int:media_id>/<key>/<name>')
+def preview_file(media_id, key, name):
+    # A new key is used whenever previews are regenerated, so these are immutable
+    path = previews.preview_file(media_id, key, name)
+    if path is None:
+        return "File not found", 404
+    mimetype = 'text/vtt' if name.endswith('.vtt') else None
+    return stream_file(request.environ, path, request.headers, mimetype=mimetype)
+
+@app.route('/transcode/jobs')
+def transcode_jobs():
+    """The transcode queue: running jobs, then queued by priority, then finished"""
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    conn = get_db()
+    try:
+        jobs = transcode.list_jobs(conn, request.args.get('status'), limit)
+    finally:
+        conn.close()
+    return jsonify({'jobs': jobs, 'workers': transcode.WORKERS})
+
+@app.route('/transcode/<int:media_id>', methods=['GET', 'POST'])
+def transcode_media(media_id):
+    """GET: the item's job. POST {"priority": n}: queue it, requeue a failed
+    or cancelled job, or change a queued job's priority."""
+    conn = get_db()
+    try:
+        media = conn.execute('SELECT id, file_type, mime_type FROM media WHERE id = ?', (media_id,)).fetchone()
+        if not media or media['file_type'] not in transcode.TRANSCODED_TYPES:
+            return jsonify({'error': 'Media not found'}), 404
+        if request.method == 'POST':
+            data = request.get_json(silent=True) or {}
+            try:
+                priority = int(data.get('priority', transcode.default_priority(media['mime_type'])))
+            except (TypeError, ValueError):
+                return jsonify({'error': 'Invalid priority'}), 400
+            transcode.enqueue(conn, media_id, priority)
+            conn.commit()
+            transcoder.wake()
+        job = transcode.job_for_media(conn, media_id)
+    finally:
+        conn.close()
+    if job is None:
+        return jsonify({'error': 'No transcode job'}), 404
+    return jsonify(job)
+
+@app.route('/transcode/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_transcode(job_id):
+    conn = get_db()
+    try:
+        cancelled = transcode.cancel(conn, job_id)
+    finally:
+        conn.close()
+    if not cancelled:
+        return jsonify({'error': 'Job not found or already finished'}), 404
+    return jsonify({'success': True})
 
 @app.route('/upload_subtitle', methods=['POST'])
 def upload_subtitle():
@@ -308,19 +547,32 @@ def upload_subtitle():
     name, ext = os.path.splitext(filename)
     filename = f"{name}_{timestamp}{ext}"
     
+    no_room = make_room(file_length)
+    if no_room:
+        return no_room
+    
     filepath = os.path.join(SUBTITLE_FOLDER, filename)
     try:
         file.save(filepath)
     except Exception as e:
         return jsonify({'error': f'Failed to save subtitle file: {str(e)}'}), 500
     
+    # Convert once now so serving it is a plain file send
+    try:
+        artifact = subtitle_store.ensure_vtt(filepath)
+    except (subtitle_store.SubtitleError, UnicodeError) as e:
+        os.remove(filepath)
+        return jsonify({'error': f'Invalid subtitle file: {str(e)}'}), 400
+    
     conn = get_db()
     c = conn.cursor()
-    c.execute('''INSERT INTO subtitles (media_id, filename, language)
-                 VALUES (?, ?, ?)''', (media_id, filename, language))
+    c.execute('''INSERT INTO subtitles (media_id, filename, language, file_size)
+                 VALUES (?, ?, ?, ?)''',
+              (media_id, filename, language, os.path.getsize(filepath) + os.path.getsize(artifact)))
     subtitle_id = c.lastrowid
     conn.commit()
     conn.close()
+    storage_quota.check()
     
     return jsonify({
         'success': True,
@@ -333,7 +585,46 @@ def get_subtitle(filename):
     file_path = os.path.join(SUBTITLE_FOLDER, filename)
     if not os.path.exists(file_path):
         return "Subtitle not found", 404
-    return send_file(file_path, mimetype='text/vtt')
+    
+    # Subtitles uploaded before conversion existed are converted on first request
+    try:
+        vtt_path = subtitle_store.ensure_vtt(file_path)
+    except (subtitle_store.SubtitleError, UnicodeError):
+        return "Subtitle could not be converted", 422
+    return stream_file(request.environ, vtt_path, request.headers, mimetype='text/vtt; charset=utf-8')
+
+@app.route('/subtitles/<path:filename>/cues')
+def get_subtitle_cues(filename):
+    """Cues overlapping ?start=&end= (seconds), or matching ?q= when searching"""
+    file_path = os.path.join(SUBTITLE_FOLDER, filename)
+    if not os.path.exists(file_path):
+        return jsonify({'error': 'Subtitle not found'}), 404
+    
+    try:
+        index = subtitle_store.cue_index(file_path)
+    except (subtitle_store.SubtitleError, UnicodeError):
+        return jsonify({'error': 'Subtitle could not be converted'}), 422
+    
+    # Answers only change when the artifact does, so derive validators from it
+    stat = os.stat(subtitle_store.artifact_path(filename))
+    etag = f'{file_etag(stat)[:-1]}-{zlib.crc32(request.query_string):x}"'
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=3600'}
+    if is_not_modified(request.headers, etag, stat.st_mtime):
+        return '', 304, headers
+    
+    limit = max(1, min(request.args.get('limit', 500, type=int), 2000))
+    query = request.args.get('q')
+    if query is not None:
+        return jsonify({'cues': index.search(query, limit), 'total': len(index)}), 200, headers
+    
+    start = request.args.get('start', 0, type=float)
+    end = request.args.get('end', start + 300, type=float)
+    return jsonify({
+        'start': start,
+        'end': end,
+        'cues': index.window(start, end, limit),
+        'total': len(index)
+    }), 200, headers
 
 @app.route('/upload_recording', methods=['POST'])
 def upload_recording():
@@ -350,33 +641,155 @@ def upload_recording():
     if file_length > MAX_FILE_SIZE:
         return jsonify({'error': f'Recording too large. Maximum size is {MAX_FILE_SIZE / 1024 / 1024}MB'}), 400
     
+    no_room = make_room(file_length)
+    if no_room:
+        return no_room
+    
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    ext = '.webm'
-    filename = f"recording_{recording_type}_{timestamp}{ext}"
+    filename = recording_filename(recording_type, timestamp)
     
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
+    mime_type = 'video/webm' if recording_type == 'video' else 'audio/webm'
     try:
-        file.save(filepath)
+        tmp_path, digest, file_size = blobstore.save_stream(file.stream)
+        media_id, duplicate = record_media(tmp_path, digest, filename, f'Recording {timestamp}', recording_type,
+                                           file_size, mime_type)
     except Exception as e:
         return jsonify({'error': f'Failed to save recording: {str(e)}'}), 500
     
-    file_size = os.path.getsize(filepath)
-    mime_type = 'video/webm' if recording_type == 'video' else 'audio/webm'
+    return jsonify({
+        'success': True,
+        'filename': filename,
+        'media_id': media_id,
+        'deduplicated': duplicate
+    })
+
+def upload_error(e, upload_id=None):
+    response = jsonify({'error': str(e)})
+    response.status_code = e.status
+    if upload_id:
+        response.headers['Upload-Offset'] = str(uploads.current_offset(upload_id))
+    return response
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    """Start a resumable upload: {filename, size} for media files or
+    {kind: 'recording', recording_type, size} for browser recordings"""
+    data = request.get_json(silent=True) or {}
+    
+    try:
+        upload_length = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Upload size required'}), 400
+    if upload_length <= 0:
+        return jsonify({'error': 'Upload size required'}), 400
+    if upload_length > MAX_FILE_SIZE:
+        return jsonify({'error': f'File too large. Maximum size is {MAX_FILE_SIZE / 1024 / 1024}MB'}), 413
+    
+    if data.get('kind') == 'recording':
+        recording_type = data.get('recording_type', 'video')
+        if recording_type not in ALLOWED_RECORDING_TYPES:
+            return jsonify({'error': 'Invalid recording type'}), 400
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = recording_filename(recording_type, timestamp)
+        original_name = f'Recording {timestamp}'
+        file_type = recording_type
+        mime_type = 'video/webm' if recording_type == 'video' else 'audio/webm'
+    else:
+        original_name = data.get('filename') or ''
+        all_extensions = ALLOWED_VIDEO_EXTENSIONS | ALLOWED_AUDIO_EXTENSIONS | ALLOWED_PLAYLIST_EXTENSIONS
+        if not allowed_file(original_name, all_extensions):
+            return jsonify({'error': 'File type not allowed'}), 400
+        filename = timestamped_filename(original_name)
+        mime_type = mimetypes.guess_type(filename)[0]
+        if not is_allowed_media_mime(mime_type):
+            return jsonify({'error': 'Invalid file type detected'}), 400
+        file_type = media_file_type(filename)
+    
+    no_room = make_room(upload_length)
+    if no_room:
+        return no_room
     
     conn = get_db()
-    c = conn.cursor()
-    c.execute('''INSERT INTO media (filename, original_name, file_type, file_size, mime_type)
-                 VALUES (?, ?, ?, ?, ?)''', (filename, f'Recording {timestamp}', recording_type, file_size, mime_type))
-    media_id = c.lastrowid
-    conn.commit()
+    upload_id = uploads.create(conn, filename, original_name, file_type, mime_type, upload_length)
     conn.close()
     
+    response = jsonify({'success': True, 'upload_id': upload_id, 'offset': 0, 'upload_length': upload_length})
+    response.status_code = 201
+    response.headers['Location'] = f'/uploads/{upload_id}'
+    response.headers['Upload-Offset'] = '0'
+    return response
+
+@app.route('/uploads/<upload_id>', methods=['HEAD'])
+def upload_status(upload_id):
+    conn = get_db()
+    session = uploads.get(conn, upload_id)
+    conn.close()
+    if not session:
+        return '', 404
+    
+    return '', 200, {
+        'Upload-Offset': str(uploads.current_offset(upload_id)),
+        'Upload-Length': str(session['upload_length']),
+        'Cache-Control': 'no-store'
+    }
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+def upload_chunk(upload_id):
+    """Append the raw request body at Upload-Offset"""
+    offset = request.headers.get('Upload-Offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'Upload-Offset header required'}), 400
+    
+    conn = get_db()
+    session = uploads.get(conn, upload_id)
+    conn.close()
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    try:
+        new_offset = uploads.append(session, request.stream, offset, request.content_length)
+    except uploads.UploadError as e:
+        return upload_error(e, upload_id)
+    
+    return '', 204, {'Upload-Offset': str(new_offset)}
+
+@app.route('/uploads/<upload_id>/finish', methods=['POST'])
+def finish_upload(upload_id):
+    conn = get_db()
+    session = uploads.get(conn, upload_id)
+    if not session:
+        conn.close()
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    try:
+        part_path, digest = uploads.finish(conn, session)
+    except uploads.UploadError as e:
+        return upload_error(e, upload_id)
+    finally:
+        conn.close()
+    
+    try:
+        media_id, duplicate = record_media(part_path, digest, session['filename'], session['original_name'],
+                                           session['file_type'], session['upload_length'], session['mime_type'])
+    except FileNotFoundError:
+        # A concurrent DELETE /uploads/<id> removed the part file
+        return jsonify({'error': 'Upload was cancelled'}), 409
+    
     return jsonify({
         'success': True,
-        'filename': filename,
-        'media_id': media_id
+        'filename': session['filename'],
+        'media_id': media_id,
+        'file_type': session['file_type'],
+        'deduplicated': duplicate
     })
 
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    conn = get_db()
+    uploads.discard(conn, upload_id)
+    conn.close()
+    return jsonify({'success': True})
+
 def get_vpn_socks_proxy():
     """Get SOCKS proxy address if VPN is active
     Note: OpenVPN doesn't natively create a SOCKS proxy.
@@ -390,6 +803,12 @@ def get_vpn_socks_proxy():
     # To use SOCKS proxy, you would need to set up dante-server or similar
     return None
 
+def get_active_vpn():
+    conn = get_db()
+    active_vpn = conn.execute('SELECT * FROM vpn_configs WHERE is_active = 1 LIMIT 1').fetchone()
+    conn.close()
+    return active_vpn
+
 def check_vpn_status():
     """Check if OpenVPN process is running"""
     try:
@@ -548,42 +967,17 @@ def proxy_browse():
     if not url.startswith(('http://', 'https://')):
         url = 'https://' + url
     
-    # User agent mapping
-    user_agents = {
-        'chrome-windows': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'chrome-mac': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-        'firefox-windows': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:121.0) Gecko/20100101 Firefox/121.0',
-        'firefox-mac': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:121.0) Gecko/20100101 Firefox/121.0',
-        'safari-mac': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Safari/605.1.15',
-        'edge-windows': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0',
-        'chrome-android': 'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
-        'safari-ios': 'Mozilla/5.0 (iPhone; CPU iPhone OS 17_2 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.2 Mobile/15E148 Safari/604.1',
-        'firefox-android': 'Mozilla/5.0 (Android 10; Mobile; rv:121.0) Gecko/121.0 Firefox/121.0'
-    }
-    
-    selected_user_agent = user_agents.get(user_agent_type, user_agents['chrome-windows'])
-    
     try:
         # Check if VPN is active
         if use_vpn:
-            conn = get_db()
-            active_vpn = conn.execute('SELECT * FROM vpn_configs WHERE is_active = 1 LIMIT 1').fetchone()
-            conn.close()
+            active_vpn = get_active_vpn()
             
             if not active_vpn or not check_vpn_status():
                 return jsonify({'error': 'VPN is not active. Please activate a VPN first.'}), 400
         
-        headers = {
-            'User-Agent': selected_user_agent,
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'DNT': '1',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1'
-        }
+        headers = browse_headers(user_agent_type)
         
-        response = requests.get(url, timeout=15, headers=headers, allow_redirects=True)
+        response = upstream.get(url, read_timeout=15, headers=headers, allow_redirects=True)
         response.raise_for_status()
         
         # Get the final URL after redirects
@@ -621,6 +1015,26 @@ def proxy_browse():
     except Exception as e:
         return jsonify({'error': f'Failed to browse: {str(e)}'}), 400
 
+def proxy_request_headers(range_header=None):
+    """Headers proxy_resource sends upstream; Range is only forwarded when present"""
+    headers = {
+        'User-Agent': USER_AGENTS['chrome-windows'],
+        'Accept': '*/*',
+        'Accept-Encoding': 'identity'
+    }
+    if range_header:
+        headers['Range'] = range_header
+    return headers
+
+def proxy_response_headers():
+    return {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': 'GET, OPTIONS',
+        'Access-Control-Allow-Headers': 'Range, Content-Type',
+        'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Content-Type',
+        'Cache-Control': 'no-cache'
+    }
+
 @app.route('/proxy_resource/<path:url>')
 def proxy_resource(url):
     """Proxy external resources to avoid CORS issues"""
@@ -629,83 +1043,61 @@ def proxy_resource(url):
         import urllib.parse
         decoded_url = urllib.parse.unquote(url)
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': '*/*',
-            'Accept-Encoding': 'identity',
-            'Range': request.headers.get('Range', '')
-        }
+        headers = proxy_request_headers(request.headers.get('Range'))
         
-        # Remove empty Range header
-        if not headers['Range']:
-            del headers['Range']
-        
-        response = requests.get(decoded_url, timeout=30, headers=headers, stream=True)
-        response.raise_for_status()
-        
-        # Get content type
-        content_type = response.headers.get('Content-Type', 'application/octet-stream')
-        
-        # For m3u8 files, rewrite URLs to go through proxy
-        if decoded_url.endswith('.m3u8') or decoded_url.endswith('.m3u'):
-            content_type = 'application/vnd.apple.mpegurl'
-            content = response.text
-            
-            # Get the base URL for relative paths
-            from urllib.parse import urljoin
-            base_url = decoded_url.rsplit('/', 1)[0] + '/'
-            
-            # Rewrite URLs in the m3u8 file to go through proxy
-            lines = content.split('\n')
-            rewritten_lines = []
-            for line in lines:
-                line = line.strip()
-                # Skip comments and empty lines
-                if line.startswith('#') or not line:
-                    rewritten_lines.append(line)
-                else:
-                    # This is a URL line
-                    if line.startswith('http://') or line.startswith('https://'):
-                        # Absolute URL
-                        proxied_url = '/proxy_resource/' + urllib.parse.quote(line, safe='')
-                    elif line.startswith('/'):
-                        # Absolute path
-                        full_url = urljoin(decoded_url, line)
-                        proxied_url = '/proxy_resource/' + urllib.parse.quote(full_url, safe='')
-                    else:
-                        # Relative URL
-                        full_url = urljoin(base_url, line)
-                        proxied_url = '/proxy_resource/' + urllib.parse.quote(full_url, safe='')
-                    rewritten_lines.append(proxied_url)
-            
-            rewritten_content = '\n'.join(rewritten_lines)
+        # Whole-segment requests are shared between viewers through the segment cache
+        if 'Range' not in headers and is_segment_url(decoded_url):
+            segment = segment_cache.open(
+                decoded_url,
+                lambda: upstream.get(decoded_url, read_timeout=30, headers=headers, stream=True)
+            )
+            try:
+                segment.wait_for_headers()
+            except Exception:
+                segment.release()
+                raise
+            if segment.status >= 400:
+                segment.release()
+                return f"Error loading resource: upstream returned {segment.status}", 404
             
-            response_headers = {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, OPTIONS',
-                'Access-Control-Allow-Headers': 'Range, Content-Type',
-                'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Content-Type',
-                'Cache-Control': 'no-cache'
-            }
+            content_type = 'video/mp2t' if decoded_url.endswith('.ts') else segment.content_type
+            response_headers = proxy_response_headers()
+            if segment.content_length() is not None:
+                response_headers['Content-Length'] = str(segment.content_length())
             
             return Response(
-                rewritten_content,
+                segment.iter_chunks(),
+                status=200,
                 content_type=content_type,
-                headers=response_headers
+                headers=response_headers,
+                direct_passthrough=True
+            )
+        
+        # For m3u8 files, serve the cached copy with URLs rewritten to go through proxy
+        if is_playlist_url(decoded_url):
+            def fetch_playlist():
+                playlist_response = upstream.get(decoded_url, read_timeout=30, headers=headers)
+                playlist_response.raise_for_status()
+                return playlist_response.text
+            
+            return Response(
+                manifest_cache.get(decoded_url, fetch_playlist),
+                content_type='application/vnd.apple.mpegurl',
+                headers=proxy_response_headers()
             )
         
+        response = upstream.get(decoded_url, read_timeout=30, headers=headers, stream=True)
+        response.raise_for_status()
+        
+        # Get content type
+        content_type = response.headers.get('Content-Type', 'application/octet-stream')
+        
         # For other files (like .ts segments), stream normally
-        elif decoded_url.endswith('.ts'):
+        if decoded_url.endswith('.ts'):
             content_type = 'video/mp2t'
         
         # Build response headers
-        response_headers = {
-            'Access-Control-Allow-Origin': '*',
-            'Access-Control-Allow-Methods': 'GET, OPTIONS',
-            'Access-Control-Allow-Headers': 'Range, Content-Type',
-            'Access-Control-Expose-Headers': 'Content-Length, Content-Range, Content-Type',
-            'Cache-Control': 'no-cache'
-        }
+        response_headers = proxy_response_headers()
         
         # Copy range headers if present
         if 'Content-Range' in response.headers:
@@ -714,9 +1106,14 @@ def proxy_resource(url):
         
         # Stream the content
         def generate():
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    yield chunk
+            # Closing returns the keep-alive connection to the pool even
+            # when the client disconnects mid-stream
+            try:
+                for chunk in response.iter_content(chunk_size=8192):
+                    if chunk:
+                        yield chunk
+            finally:
+                response.close()
         
         return Response(
             generate(),
@@ -728,9 +1125,19 @@ def proxy_resource(url):
     except Exception as e:
         return f"Error loading resource: {str(e)}", 404
 
+def wants_ndjson(data):
+    return data.get('format') == 'ndjson' or 'application/x-ndjson' in request.headers.get('Accept', '')
+
 @app.route('/parse_playlist', methods=['POST'])
 def parse_playlist():
-    data = request.get_json()
+    """Parse a remote M3U/M3U8 playlist while it downloads.
+    
+    With {"format": "ndjson"} (or Accept: application/x-ndjson) every item is
+    streamed as one JSON line as soon as it is parsed, followed by a
+    {"done": true, "count": n} line. Otherwise one page of up to `limit`
+    items is returned, with a `next_cursor` to pass back for the next page.
+    """
+    data = request.get_json(silent=True) or {}
     url = data.get('url')
     use_vpn = data.get('use_vpn', False)
     
@@ -738,17 +1145,15 @@ def parse_playlist():
         return jsonify({'error': 'URL required'}), 400
     
     try:
-        # Configure proxy based on VPN status
-        proxies = None
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
-        
+        position = playlist_parser.decode_cursor(data.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    limit = playlist_parser.page_size(data.get('limit', playlist_parser.DEFAULT_PAGE_SIZE))
+    
+    try:
         if use_vpn:
             # Check if VPN is active in database
-            conn = get_db()
-            active_vpn = conn.execute('SELECT * FROM vpn_configs WHERE is_active = 1 LIMIT 1').fetchone()
-            conn.close()
+            active_vpn = get_active_vpn()
             
             if not active_vpn:
                 return jsonify({'error': 'VPN is not active. Please activate a VPN first.'}), 400
@@ -757,59 +1162,16 @@ def parse_playlist():
             # The request will use the system's VPN connection if available
             # SOCKS proxy would require additional setup (dante-server, etc.)
         
-        response = requests.get(url, timeout=10, proxies=proxies, headers=headers)
-        response.raise_for_status()
-        content = response.text
-        
-        items = []
-        
-        if '#EXTM3U' in content:
-            lines = content.strip().split('\n')
-            current_title = None
-            current_duration = 0
-            
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith('#EXTM3U'):
-                    continue
-                
-                if line.startswith('#EXTINF:'):
-                    parts = line[8:].split(',', 1)
-                    try:
-                        current_duration = float(parts[0].split()[0])
-                    except (ValueError, IndexError):
-                        current_duration = -1
-                    
-                    current_title = parts[1] if len(parts) > 1 else 'Untitled'
-                    
-                elif line.startswith('#EXT-X-STREAM-INF:'):
-                    current_title = 'Stream'
-                    
-                elif not line.startswith('#'):
-                    full_url = line if line.startswith('http') else url.rsplit('/', 1)[0] + '/' + line
-                    
-                    items.append({
-                        'uri': full_url,
-                        'title': current_title or 'Untitled',
-                        'duration': current_duration if current_duration > 0 else None
-                    })
-                    current_title = None
-                    current_duration = 0
-        else:
-            lines = [line.strip() for line in content.strip().split('\n') if line.strip() and not line.startswith('#')]
-            for idx, line in enumerate(lines):
-                full_url = line if line.startswith('http') else url.rsplit('/', 1)[0] + '/' + line
-                items.append({
-                    'uri': full_url,
-                    'title': f'Item {idx + 1}',
-                    'duration': None
-                })
-        
-        if not items:
-            return jsonify({'error': 'No valid playlist items found'}), 400
-        
-        return jsonify({'success': True, 'items': items})
-        
+        conn = get_db()
+        entry = playlist_cache.lookup(conn, url)
+        conn.close()
+        headers = {'User-Agent': USER_AGENTS['chrome-windows']}
+        headers.update(playlist_cache.conditional_headers(entry))
+        # The read timeout bounds each read, not the whole download, so
+        # long lists keep flowing as long as the server keeps sending
+        response = upstream.get(url, read_timeout=10, headers=headers, stream=True)
+        if not (response.status_code == 304 and entry is not None):
+            response.raise_for_status()
     except requests.exceptions.Timeout:
         return jsonify({'error': 'Request timeout - URL took too long to respond'}), 400
     except requests.exceptions.ConnectionError:
@@ -818,6 +1180,153 @@ def parse_playlist():
         return jsonify({'error': f'HTTP error: {e.response.status_code}'}), 400
     except Exception as e:
         return jsonify({'error': f'Failed to parse playlist: {str(e)}'}), 400
+    
+    conn = get_db()
+    if response.status_code == 304:
+        # Unchanged upstream: serve the stored items without parsing anything
+        response.close()
+        playlist_cache.touch(conn, entry)
+        return cached_playlist_response(conn, entry, data, position, limit)
+    
+    writer = playlist_cache.CacheWriter(conn, url, response.headers) if playlist_cache.is_cacheable(response.headers) else None
+    # Lines are parsed as bytes: M3U8 is UTF-8 whatever charset the server claims
+    items = playlist_parser.iter_items(response.iter_lines(chunk_size=playlist_parser.READ_SIZE), url)
+    
+    if wants_ndjson(data):
+        def generate():
+            count = 0
+            completed = False
+            try:
+                for item in items:
+                    count += 1
+                    line = json.dumps(item)
+                    if writer is not None:
+                        writer.add(line)
+                    yield line + '\n'
+                if writer is not None:
+                    writer.commit()
+                completed = True
+                yield json.dumps({'done': True, 'count': count}) + '\n'
+            except requests.exceptions.RequestException as e:
+                yield json.dumps({'error': f'Failed to parse playlist: {str(e)}', 'count': count}) + '\n'
+            finally:
+                # A partial list (error or client gone) is never cached
+                if writer is not None and not completed:
+                    writer.abort()
+                response.close()
+                conn.close()
+        
+        return Response(generate(), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Playlist-Cache': 'MISS'})
+    
+    if writer is None:
+        conn.close()
+        try:
+            page, next_cursor = playlist_parser.take_page(items, position, limit)
+        except requests.exceptions.RequestException as e:
+            return jsonify({'error': f'Failed to parse playlist: {str(e)}'}), 400
+        finally:
+            # Stops the download as soon as the page is full
+            response.close()
+        
+        if not page and position == 0:
+            return jsonify({'error': 'No valid playlist items found'}), 400
+        
+        return jsonify({'success': True, 'items': page, 'next_cursor': next_cursor})
+    
+    # A cacheable list is read to the end once, so every later page (and
+    # every later load) comes from the cache instead of a fresh download
+    try:
+        for item in items:
+            writer.add(json.dumps(item))
+        writer.commit()
+    except requests.exceptions.RequestException as e:
+        writer.abort()
+        conn.close()
+        return jsonify({'error': f'Failed to parse playlist: {str(e)}'}), 400
+    finally:
+        response.close()
+    
+    return cached_playlist_response(conn, playlist_cache.lookup(conn, url), data, position, limit, 'MISS')
+
+def cached_playlist_response(conn, entry, data, position, limit, cache_status='HIT'):
+    """Serve a cached playlist in the requested format; closes `conn`"""
+    if wants_ndjson(data):
+        def generate():
+            try:
+                for line in playlist_cache.iter_items(conn, entry):
+                    yield line + '\n'
+                yield json.dumps({'done': True, 'count': entry['item_count']}) + '\n'
+            finally:
+                conn.close()
+        
+        return Response(generate(), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Playlist-Cache': cache_status})
+    
+    try:
+        page, next_cursor = playlist_cache.page(conn, entry, position, limit)
+    finally:
+        conn.close()
+    if not page and position == 0:
+        return jsonify({'error': 'No valid playlist items found'}), 400
+    return Response(playlist_cache.page_json(page, next_cursor), mimetype='application/json',
+                    headers={'X-Playlist-Cache': cache_status})
+
+@app.route('/check_playlist', methods=['POST'])
+def check_playlist():
+    """Check which items of a playlist actually respond.
+    
+    Takes either {"uris": [...]} or the {"url": ...} of a playlist, whose
+    items come from the parsed-playlist cache when it has them. Results are
+    keyed by URI; stored results younger than PLAYLIST_CHECK_TTL are reused.
+    Items not reached within PLAYLIST_CHECK_BUDGET seconds come back
+    'unchecked'; checking again continues from there.
+    """
+    data = request.get_json(silent=True) or {}
+    uris = data.get('uris')
+    url = data.get('url')
+    
+    if uris is None:
+        if not url:
+            return jsonify({'error': 'URL or uris required'}), 400
+        conn = get_db()
+        entry = playlist_cache.lookup(conn, url)
+        if entry is not None:
+            uris = [json.loads(item)['uri'] for item in playlist_cache.iter_items(conn, entry)]
+        conn.close()
+    
+    if uris is None:
+        try:
+            response = upstream.get(url, read_timeout=10, headers={'User-Agent': USER_AGENTS['chrome-windows']}, stream=True)
+            response.raise_for_status()
+            with response:
+                uris = [item['uri'] for item in playlist_parser.iter_items(
+                    response.iter_lines(chunk_size=playlist_parser.READ_SIZE), url)]
+        except requests.exceptions.RequestException as e:
+            return jsonify({'error': f'Failed to load playlist: {str(e)}'}), 400
+    
+    if not isinstance(uris, list) or not all(isinstance(uri, str) for uri in uris):
+        return jsonify({'error': 'uris must be a list of strings'}), 400
+    
+    started = time.monotonic()
+    conn = get_db()
+    try:
+        results, probed = playlist_health.check(conn, uris, headers={'User-Agent': USER_AGENTS['chrome-windows']})
+    finally:
+        conn.close()
+    
+    summary = {}
+    for result in results.values():
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    
+    return jsonify({
+        'success': True,
+        'checked': len(results),
+        'probed': probed,
+        'elapsed_ms': int((time.monotonic() - started) * 1000),
+        'summary': summary,
+        'results': results
+    })
 
 @app.route('/metadata/<path:filename>')
 def get_metadata(filename):
@@ -836,56 +1345,124 @@ def get_metadata(filename):
         'mime_type': media['mime_type'],
         'upload_date': media['upload_date'],
         'play_count': media['play_count'],
-        'total_watch_time': media['total_watch_time']
+        'total_watch_time': media['total_watch_time'],
+        'duration': media['duration'],
+        'container': media['container'],
+        'video_codec': media['video_codec'],
+        'audio_codec': media['audio_codec'],
+        'width': media['width'],
+        'height': media['height'],
+        'bitrate': media['bitrate'],
+        'probe_status': media['probe_status'] or 'pending'
     })
 
-@app.route('/update_analytics', methods=['POST'])
-def update_analytics():
-    data = request.get_json()
-    filename = data.get('filename')
-    event_type = data.get('event_type')
-    watch_time = data.get('watch_time', 0)
+@app.route('/api/library')
+def library_page():
+    """One page of the media library. Pass next_cursor back as ?cursor= for the next page."""
+    sort = request.args.get('sort', 'date')
+    file_type = request.args.get('file_type') or None
+    cursor = request.args.get('cursor') or None
+    limit = request.args.get('limit', library.DEFAULT_LIMIT, type=int)
     
     conn = get_db()
-    media = conn.execute('SELECT * FROM media WHERE filename = ?', (filename,)).fetchone()
-    
-    if media:
-        if event_type == 'play':
-            conn.execute('UPDATE media SET play_count = play_count + 1 WHERE id = ?', (media['id'],))
-        
-        if watch_time > 0:
-            conn.execute('UPDATE media SET total_watch_time = total_watch_time + ? WHERE id = ?', (watch_time, media['id']))
-        
-        conn.execute('''INSERT INTO analytics (media_id, event_type, data)
-                       VALUES (?, ?, ?)''', (media['id'], event_type, json.dumps(data)))
-        conn.commit()
+    try:
+        items, next_cursor = library.fetch_page(conn, sort, file_type, cursor, limit)
+    except library.InvalidQuery as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        conn.close()
     
-    conn.close()
+    for item in items:
+        item.update(previews.urls(item['id'], item.pop('preview_key'), item['file_type']))
+    return jsonify({'items': items, 'next_cursor': next_cursor})
+
+@app.route('/update_analytics', methods=['POST'])
+def update_analytics():
+    analytics_buffer.record(request.get_json(silent=True))
     return jsonify({'success': True})
 
+@app.route('/update_analytics/batch', methods=['POST'])
+def update_analytics_batch():
+    """Accept several player events at once (sent with sendBeacon on page hide)"""
+    data = request.get_json(force=True, silent=True) or {}
+    events = data.get('events') if isinstance(data, dict) else data
+    if not isinstance(events, list):
+        return jsonify({'error': 'events list required'}), 400
+    
+    analytics_buffer.record_many(events)
+    return jsonify({'success': True})
+
+@app.route('/admin/storage')
+def storage_status():
+    """Usage against the quota, the next eviction candidates and the
+    most recent evictions"""
+    conn = get_db()
+    try:
+        status = storage_quota.status(conn)
+        status['next_candidates'] = [
+            {'media_id': row['id'], 'filename': row['filename'], 'file_size': row['freeable'],
+             'play_count': row['play_count'], 'total_watch_time': row['total_watch_time'],
+             'last_accessed': row['last_accessed'], 'score': score}
+            for score, row in quota.candidates(conn, limit=20)]
+        status['recent_evictions'] = quota.recent_evictions(conn)
+    finally:
+        conn.close()
+    return jsonify(status)
+
+@app.route('/admin/storage/evict', methods=['POST'])
+def storage_evict():
+    """Evict down to the low water mark now, or {"bytes": n}; "dry_run"
+    only reports what would go"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Expected a JSON object'}), 400
+    bytes_needed = data.get('bytes')
+    if bytes_needed is not None:
+        try:
+            bytes_needed = int(bytes_needed)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'bytes must be a non-negative integer'}), 400
+        if bytes_needed < 0:
+            return jsonify({'error': 'bytes must be a non-negative integer'}), 400
+    
+    conn = get_db()
+    try:
+        if bytes_needed is None:
+            status = storage_quota.status(conn)
+            bytes_needed = max(status['usage']['total'] - status['low_water'], 0)
+        decisions = storage_quota.evict(conn, bytes_needed, 'manual', dry_run=bool(data.get('dry_run')))
+        usage = quota.usage(conn)
+    finally:
+        conn.close()
+    return jsonify({'success': True, 'dry_run': bool(data.get('dry_run')), 'evicted': decisions, 'usage': usage})
+
+@app.route('/admin/storage/recount', methods=['POST'])
+def storage_recount():
+    """Rebuild the usage counters from the tables"""
+    conn = get_db()
+    try:
+        usage = quota.recount(conn, SUBTITLE_FOLDER)
+    finally:
+        conn.close()
+    return jsonify({'success': True, 'usage': usage})
+
 @app.route('/cleanup', methods=['POST'])
 def cleanup_files():
-    hours = request.json.get('hours', 24)
-    cutoff = datetime.now() - timedelta(hours=hours)
+    """Delete media older than `hours`. With "dry_run" nothing is removed
+    and the response reports what would be. A large purge stops after
+    CLEANUP_TIME_BUDGET seconds with "complete": false; post again to go on."""
+    data = request.get_json(silent=True) or {}
+    hours = data.get('hours', 24)
+    cutoff = (datetime.now() - timedelta(hours=hours)).strftime('%Y-%m-%d %H:%M:%S')
     
     conn = get_db()
-    old_files = conn.execute('SELECT * FROM media WHERE upload_date < ?', (cutoff,)).fetchall()
-    
-    deleted_count = 0
-    for media in old_files:
-        filepath = os.path.join(UPLOAD_FOLDER, media['filename'])
-        if os.path.exists(filepath):
-            os.remove(filepath)
-            deleted_count += 1
-        
-        conn.execute('DELETE FROM subtitles WHERE media_id = ?', (media['id'],))
-        conn.execute('DELETE FROM analytics WHERE media_id = ?', (media['id'],))
-        conn.execute('DELETE FROM media WHERE id = ?', (media['id'],))
-    
-    conn.commit()
-    conn.close()
+    try:
+        report = cleanup.run(conn, cutoff, UPLOAD_FOLDER, SUBTITLE_FOLDER,
+                             dry_run=bool(data.get('dry_run')), time_budget=CLEANUP_TIME_BUDGET)
+    finally:
+        conn.close()
     
-    return jsonify({'success': True, 'deleted_count': deleted_count})
+    return jsonify({'success': True, 'deleted_count': 0 if report['dry_run'] else report['media'], **report})
 
 @app.route('/delete/<path:filename>', methods=['DELETE'])
 def delete_file(filename):
@@ -896,21 +1473,12 @@ def delete_file(filename):
         conn.close()
         return jsonify({'error': 'File not found'}), 404
     
-    filepath = os.path.join(UPLOAD_FOLDER, filename)
-    if os.path.exists(filepath):
-        os.remove(filepath)
-    
-    subtitles = conn.execute('SELECT * FROM subtitles WHERE media_id = ?', (media['id'],)).fetchall()
-    for subtitle in subtitles:
-        subtitle_path = os.path.join(SUBTITLE_FOLDER, subtitle['filename'])
-        if os.path.exists(subtitle_path):
-            os.remove(subtitle_path)
-    
-    conn.execute('DELETE FROM subtitles WHERE media_id = ?', (media['id'],))
-    conn.execute('DELETE FROM analytics WHERE media_id = ?', (media['id'],))
-    conn.execute('DELETE FROM media WHERE id = ?', (media['id'],))
-    conn.commit()
-    conn.close()
+    # Files, subtitles and analytics go with the row; the blob only with
+    # its last reference, after the rows are gone
+    try:
+        cleanup.delete_media(conn, [media], UPLOAD_FOLDER, SUBTITLE_FOLDER)
+    finally:
+        conn.close()
     
     return jsonify({'success': True})
 
@@ -0,0 +1,581 @@
+"""
+Async (ASGI) serving mode for Stream Weaver.
+
+The I/O-bound endpoints -- /stream, /proxy_resource, /proxy_browse and
+/parse_playlist -- are served natively on the event loop with an async
+HTTP client and non-blocking file reads, so a long-running stream holds
+a coroutine instead of a whole worker. Every other route falls through
+to the Flask app unchanged. URLs and responses match the WSGI mode.
+
+Start it with SERVER_MODE=asgi ./start.sh, or directly:
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+    python asgi.py
+"""
+
+import os
+import json
+import asyncio
+import functools
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.datastructures import Headers
+
+import app as flask_app
+from streaming import plan_file_response, CHUNK_SIZE
+from segment_cache import segment_cache, is_segment_url, STALL_TIMEOUT
+from manifest_cache import manifest_cache, is_playlist_url
+import upstream
+import playlist_parser
+import playlist_cache
+
+MAX_CONNECTIONS = int(os.environ.get('ASGI_MAX_UPSTREAM_CONNECTIONS', 1000))
+MAX_KEEPALIVE = int(os.environ.get('ASGI_MAX_KEEPALIVE_CONNECTIONS', 200))
+MAX_JSON_BODY = 1024 * 1024
+# Threads for blocking disk reads; a bounded pool of its own so slow disks
+# queue reads instead of starving other users of the default executor
+DISK_READ_THREADS = int(os.environ.get('ASGI_DISK_READ_THREADS', 16))
+
+_disk_executor = ThreadPoolExecutor(max_workers=DISK_READ_THREADS, thread_name_prefix='asgi-disk')
+
+
+class StreamWeaverASGI:
+    def __init__(self, wsgi_app):
+        self.fallback = WsgiToAsgi(wsgi_app)
+        self.client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+
+        if scope['type'] == 'http':
+            path = scope['path']
+            method = scope['method']
+            if path.startswith('/stream/') and method in ('GET', 'HEAD'):
+                return await self.stream_media(scope, receive, send, path[len('/stream/'):])
+            if path.startswith('/proxy_resource/') and method == 'GET':
+                return await self.proxy_resource(scope, receive, send, path[len('/proxy_resource/'):])
+            if path == '/proxy_browse' and method == 'POST':
+                return await self.proxy_browse(scope, receive, send)
+            if path == '/parse_playlist' and method == 'POST':
+                return await self.parse_playlist(scope, receive, send)
+
+        return await self.fallback(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._get_client()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=MAX_CONNECTIONS,
+                                    max_keepalive_connections=MAX_KEEPALIVE),
+                timeout=httpx.Timeout(30, connect=upstream.CONNECT_TIMEOUT),
+                transport=httpx.AsyncHTTPTransport(retries=upstream.MAX_RETRIES)
+            )
+        return self.client
+
+    # Endpoints
+
+    async def stream_media(self, scope, receive, send, filename):
+        file_path = os.path.join(flask_app.UPLOAD_FOLDER, filename)
+        loop = asyncio.get_running_loop()
+        # Stats and the cache-control lookup block; a slow disk or a locked
+        # database must not stall every other connection on the loop
+        if not await loop.run_in_executor(_disk_executor, os.path.exists, file_path):
+            return await _send_text(send, 'File not found', 404)
+
+        cache_control = await asyncio.to_thread(flask_app.stream_cache_control, filename)
+        status, headers, parts = await loop.run_in_executor(
+            _disk_executor, functools.partial(plan_file_response, file_path, _request_headers(scope),
+                                              cache_control=cache_control))
+        await _start(send, status, headers)
+        if scope['method'] == 'HEAD' or not parts:
+            return await send({'type': 'http.response.body', 'body': b''})
+        await _stream_body(send, receive, _iter_file_parts(file_path, parts))
+
+    async def proxy_resource(self, scope, receive, send, url):
+        started = False
+
+        async def tracked_send(message):
+            nonlocal started
+            started = started or message['type'] == 'http.response.start'
+            await send(message)
+
+        try:
+            await self._proxy_resource(scope, receive, tracked_send, url)
+        except Exception as e:
+            # Once headers are out the only option left is to drop the connection
+            if started:
+                raise
+            await _send_text(send, f'Error loading resource: {str(e)}', 404)
+
+    async def _proxy_resource(self, scope, receive, send, url):
+        decoded_url = urllib.parse.unquote(url)
+        headers = flask_app.proxy_request_headers(_request_headers(scope).get('Range'))
+
+        if 'Range' not in headers and is_segment_url(decoded_url):
+            return await self._proxy_segment(send, receive, decoded_url, headers)
+
+        if is_playlist_url(decoded_url):
+            text = manifest_cache.lookup(decoded_url)
+            if text is None:
+                response = await self._get_client().get(decoded_url, headers=headers)
+                response.raise_for_status()
+                text = manifest_cache.store(decoded_url, response.text)
+            response_headers = flask_app.proxy_response_headers()
+            response_headers['Content-Type'] = 'application/vnd.apple.mpegurl'
+            return await _send_body(send, 200, response_headers, text.encode('utf-8'))
+
+        request = self._get_client().build_request('GET', decoded_url, headers=headers)
+        response = await self._get_client().send(request, stream=True)
+        try:
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', 'application/octet-stream')
+            if decoded_url.endswith('.ts'):
+                content_type = 'video/mp2t'
+
+            response_headers = flask_app.proxy_response_headers()
+            response_headers['Content-Type'] = content_type
+            if 'Content-Range' in response.headers:
+                response_headers['Content-Range'] = response.headers['Content-Range']
+                response_headers['Accept-Ranges'] = 'bytes'
+
+            await _start(send, response.status_code, response_headers)
+            await _stream_body(send, receive, response.aiter_raw(CHUNK_SIZE))
+        finally:
+            await response.aclose()
+
+    async def _proxy_segment(self, send, receive, decoded_url, headers):
+        """Serve a segment through the shared cache. Misses are filled by the
+        cache's own fetch thread so concurrent viewers still coalesce onto a
+        single upstream request."""
+        # open() may read the disk tier
+        segment = await asyncio.get_running_loop().run_in_executor(
+            _disk_executor, segment_cache.open, decoded_url,
+            lambda: upstream.get(decoded_url, read_timeout=30, headers=headers, stream=True)
+        )
+        try:
+            if segment.status is None:
+                waiter = _SegmentWaiter(segment)
+                try:
+                    while segment.status is None and segment.error is None:
+                        await waiter.wait()
+                finally:
+                    waiter.close()
+                if segment.status is None:
+                    raise segment.error
+        except BaseException:
+            segment.release()
+            raise
+        if segment.status >= 400:
+            segment.release()
+            return await _send_text(send, f'Error loading resource: upstream returned {segment.status}', 404)
+
+        response_headers = flask_app.proxy_response_headers()
+        response_headers['Content-Type'] = 'video/mp2t' if decoded_url.endswith('.ts') else segment.content_type
+        if segment.content_length() is not None:
+            response_headers['Content-Length'] = str(segment.content_length())
+
+        token = segment.reader()
+        try:
+            await _start(send, 200, response_headers)
+            await _stream_body(send, receive, _iter_segment(segment, token))
+        finally:
+            # Leaving an unfinished fetch as its last reader cancels it
+            segment.close_reader(token)
+
+    async def proxy_browse(self, scope, receive, send):
+        data = await _read_json(receive)
+        url = data.get('url')
+        use_vpn = data.get('use_vpn', True)
+        user_agent_type = data.get('user_agent', 'chrome-windows')
+
+        if not url:
+            return await _send_json(send, {'error': 'URL required'}, 400)
+
+        if not url.startswith(('http://', 'https://')):
+            url = 'https://' + url
+
+        try:
+            if use_vpn:
+                active_vpn = await asyncio.to_thread(flask_app.get_active_vpn)
+                if not active_vpn or not await asyncio.to_thread(flask_app.check_vpn_status):
+                    return await _send_json(send, {'error': 'VPN is not active. Please activate a VPN first.'}, 400)
+
+            response = await self._get_client().get(
+                url, headers=flask_app.browse_headers(user_agent_type),
+                follow_redirects=True, timeout=httpx.Timeout(15, connect=upstream.CONNECT_TIMEOUT))
+            response.raise_for_status()
+
+            content_type = response.headers.get('Content-Type', 'text/html')
+            is_media = any(media_type in content_type.lower() for media_type in ['video/', 'audio/', 'image/'])
+
+            await _send_json(send, {
+                'success': True,
+                'content': response.text,
+                'final_url': str(response.url),
+                'content_type': content_type,
+                'status_code': response.status_code,
+                'encoding': response.encoding or 'utf-8',
+                'is_media': is_media
+            })
+        except httpx.TimeoutException:
+            await _send_json(send, {'error': 'Request timeout - URL took too long to respond'}, 400)
+        except httpx.ConnectError:
+            await _send_json(send, {'error': 'Connection error - could not reach the URL'}, 400)
+        except httpx.HTTPStatusError as e:
+            await _send_json(send, {'error': f'HTTP error: {e.response.status_code}'}, 400)
+        except Exception as e:
+            await _send_json(send, {'error': f'Failed to browse: {str(e)}'}, 400)
+
+    async def parse_playlist(self, scope, receive, send):
+        data = await _read_json(receive)
+        url = data.get('url')
+        use_vpn = data.get('use_vpn', False)
+
+        if not url:
+            return await _send_json(send, {'error': 'URL required'}, 400)
+
+        try:
+            position = playlist_parser.decode_cursor(data.get('cursor'))
+        except ValueError as e:
+            return await _send_json(send, {'error': str(e)}, 400)
+        limit = playlist_parser.page_size(data.get('limit', playlist_parser.DEFAULT_PAGE_SIZE))
+        ndjson = data.get('format') == 'ndjson' or 'application/x-ndjson' in _request_headers(scope).get('Accept', '')
+
+        if use_vpn and not await asyncio.to_thread(flask_app.get_active_vpn):
+            return await _send_json(send, {'error': 'VPN is not active. Please activate a VPN first.'}, 400)
+
+        conn = await asyncio.to_thread(flask_app.get_db)
+        entry = await asyncio.to_thread(playlist_cache.lookup, conn, url)
+        conn.close()
+        headers = {'User-Agent': flask_app.USER_AGENTS['chrome-windows']}
+        headers.update(playlist_cache.conditional_headers(entry))
+
+        request = self._get_client().build_request(
+            'GET', url, headers=headers, timeout=httpx.Timeout(10, connect=upstream.CONNECT_TIMEOUT))
+        try:
+            response = await self._get_client().send(request, stream=True)
+            if not (response.status_code == 304 and entry is not None):
+                response.raise_for_status()
+        except httpx.TimeoutException:
+            return await _send_json(send, {'error': 'Request timeout - URL took too long to respond'}, 400)
+        except httpx.ConnectError:
+            return await _send_json(send, {'error': 'Connection error - could not reach the URL'}, 400)
+        except httpx.HTTPStatusError as e:
+            await response.aclose()
+            return await _send_json(send, {'error': f'HTTP error: {e.response.status_code}'}, 400)
+        except Exception as e:
+            return await _send_json(send, {'error': f'Failed to parse playlist: {str(e)}'}, 400)
+
+        conn = await asyncio.to_thread(flask_app.get_db)
+        if response.status_code == 304:
+            await response.aclose()
+            await asyncio.to_thread(playlist_cache.touch, conn, entry)
+            return await _send_cached_playlist(send, receive, conn, entry, ndjson, position, limit, 'HIT')
+
+        writer = None
+        if playlist_cache.is_cacheable(response.headers):
+            writer = playlist_cache.CacheWriter(conn, url, response.headers)
+
+        if ndjson:
+            await _start(send, 200, {'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-cache',
+                                     'X-Playlist-Cache': 'MISS'})
+            return await _stream_body(send, receive, _iter_playlist_ndjson(response, url, writer, conn))
+
+        if writer is None:
+            conn.close()
+            page = []
+            next_cursor = None
+            parser = playlist_parser.PlaylistParser(url)
+            index = 0
+            try:
+                async for line in _aiter_raw_lines(response):
+                    item = parser.feed(line)
+                    if item is None:
+                        continue
+                    if index >= position:
+                        if len(page) == limit:
+                            next_cursor = playlist_parser.encode_cursor(position + limit)
+                            break
+                        page.append(item)
+                    index += 1
+            except httpx.HTTPError as e:
+                return await _send_json(send, {'error': f'Failed to parse playlist: {str(e)}'}, 400)
+            finally:
+                # Stops the download as soon as the page is full
+                await response.aclose()
+
+            if not page and position == 0:
+                return await _send_json(send, {'error': 'No valid playlist items found'}, 400)
+
+            return await _send_json(send, {'success': True, 'items': page, 'next_cursor': next_cursor})
+
+        # Cacheable lists are read to the end once; this page and all later
+        # ones are then served from the cache
+        parser = playlist_parser.PlaylistParser(url)
+        batch = []
+        try:
+            async for line in _aiter_raw_lines(response):
+                item = parser.feed(line)
+                if item is not None:
+                    batch.append(json.dumps(item))
+                    if len(batch) >= playlist_cache.WRITE_BATCH:
+                        await asyncio.to_thread(writer.extend, batch)
+                        batch = []
+            await asyncio.to_thread(writer.extend, batch)
+            await asyncio.to_thread(writer.commit)
+        except httpx.HTTPError as e:
+            await asyncio.to_thread(writer.abort)
+            conn.close()
+            return await _send_json(send, {'error': f'Failed to parse playlist: {str(e)}'}, 400)
+        finally:
+            await response.aclose()
+
+        entry = await asyncio.to_thread(playlist_cache.lookup, conn, url)
+        await _send_cached_playlist(send, receive, conn, entry, ndjson, position, limit, 'MISS')
+
+
+async def _send_cached_playlist(send, receive, conn, entry, ndjson, position, limit, cache_status):
+    """Serve a cached playlist as NDJSON or as one page; closes `conn`"""
+    if ndjson:
+        await _start(send, 200, {'Content-Type': 'application/x-ndjson', 'Cache-Control': 'no-cache',
+                                 'X-Playlist-Cache': cache_status})
+        return await _stream_body(send, receive, _iter_cached_playlist_ndjson(conn, entry))
+
+    try:
+        page, next_cursor = await asyncio.to_thread(playlist_cache.page, conn, entry, position, limit)
+    finally:
+        conn.close()
+    if not page and position == 0:
+        return await _send_json(send, {'error': 'No valid playlist items found'}, 400)
+    await _send_body(send, 200, {'Content-Type': 'application/json', 'X-Playlist-Cache': cache_status},
+                     playlist_cache.page_json(page, next_cursor).encode('utf-8'))
+
+
+# Request/response helpers
+
+def _request_headers(scope):
+    return Headers([(k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']])
+
+
+async def _read_json(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if len(body) > MAX_JSON_BODY:
+            break
+    try:
+        data = json.loads(body or b'{}')
+    except ValueError:
+        data = {}
+    return data if isinstance(data, dict) else {}
+
+
+async def _start(send, status, headers):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(k.lower().encode('latin-1'), str(v).encode('latin-1')) for k, v in headers.items()]
+    })
+
+
+async def _send_body(send, status, headers, body):
+    headers['Content-Length'] = str(len(body))
+    await _start(send, status, headers)
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _send_text(send, text, status):
+    await _send_body(send, status, {'Content-Type': 'text/html; charset=utf-8'}, text.encode('utf-8'))
+
+
+async def _send_json(send, data, status=200):
+    await _send_body(send, status, {'Content-Type': 'application/json'}, json.dumps(data).encode('utf-8'))
+
+
+async def _stream_body(send, receive, chunks):
+    """Send an async iterable of chunks, stopping early if the client goes away"""
+    async def pump():
+        async for chunk in chunks:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def wait_for_disconnect():
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    pump_task = asyncio.ensure_future(pump())
+    disconnect_task = asyncio.ensure_future(wait_for_disconnect())
+    try:
+        done, _ = await asyncio.wait({pump_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+        if pump_task in done:
+            pump_task.result()
+    finally:
+        for task in (pump_task, disconnect_task):
+            task.cancel()
+        await asyncio.gather(pump_task, disconnect_task, return_exceptions=True)
+        aclose = getattr(chunks, 'aclose', None)
+        if aclose is not None:
+            await aclose()
+
+
+async def _iter_file_parts(path, parts):
+    """Async counterpart of streaming._iter_parts: file reads run on the
+    bounded disk executor so the event loop never blocks on disk I/O."""
+    loop = asyncio.get_running_loop()
+    f = await loop.run_in_executor(_disk_executor, open, path, 'rb')
+    try:
+        for part in parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            start, remaining = part
+            await loop.run_in_executor(_disk_executor, f.seek, start)
+            while remaining > 0:
+                chunk = await loop.run_in_executor(_disk_executor, f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    finally:
+        await loop.run_in_executor(_disk_executor, f.close)
+
+
+async def _aiter_raw_lines(response):
+    """Lines of a streamed httpx response as bytes. Decoding is left to the
+    playlist parser, which treats M3U as UTF-8 whatever the charset says."""
+    pending = b''
+    async for chunk in response.aiter_bytes():
+        pending += chunk
+        lines = pending.splitlines(keepends=True)
+        pending = lines.pop() if lines and not lines[-1].endswith((b'\n', b'\r')) else b''
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+
+async def _iter_playlist_ndjson(response, url, writer, conn):
+    parser = playlist_parser.PlaylistParser(url)
+    batch = []
+    completed = False
+    try:
+        async for line in _aiter_raw_lines(response):
+            item = parser.feed(line)
+            if item is not None:
+                encoded = json.dumps(item)
+                if writer is not None:
+                    batch.append(encoded)
+                    if len(batch) >= playlist_cache.WRITE_BATCH:
+                        await asyncio.to_thread(writer.extend, batch)
+                        batch = []
+                yield (encoded + '\n').encode('utf-8')
+        if writer is not None:
+            await asyncio.to_thread(writer.extend, batch)
+            await asyncio.to_thread(writer.commit)
+        completed = True
+        yield (json.dumps({'done': True, 'count': parser.count}) + '\n').encode('utf-8')
+    except httpx.HTTPError as e:
+        yield (json.dumps({'error': f'Failed to parse playlist: {str(e)}', 'count': parser.count}) + '\n').encode('utf-8')
+    finally:
+        # A partial list (error or client gone) is never cached
+        if writer is not None and not completed:
+            await asyncio.to_thread(writer.abort)
+        await response.aclose()
+        conn.close()
+
+
+async def _iter_cached_playlist_ndjson(conn, entry):
+    position = 0
+    try:
+        while True:
+            items, next_cursor = await asyncio.to_thread(
+                playlist_cache.page, conn, entry, position, playlist_cache.WRITE_BATCH)
+            if items:
+                yield ('\n'.join(items) + '\n').encode('utf-8')
+            if next_cursor is None:
+                break
+            position += len(items)
+        yield (json.dumps({'done': True, 'count': entry['item_count']}) + '\n').encode('utf-8')
+    finally:
+        conn.close()
+
+
+class _SegmentWaiter:
+    """Wakes a coroutine when the segment's fill thread makes progress. The
+    fill thread signals the event loop directly, so a waiting reader holds
+    no thread however long upstream takes."""
+
+    def __init__(self, segment):
+        loop = asyncio.get_running_loop()
+        self.segment = segment
+        self.event = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(self.event.set)
+            except RuntimeError:
+                # Loop already closed
+                pass
+
+        self._listener = wake
+        segment.add_listener(wake)
+
+    async def wait(self):
+        try:
+            await asyncio.wait_for(self.event.wait(), STALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Upstream segment fetch stalled')
+        self.event.clear()
+
+    def close(self):
+        self.segment.remove_listener(self._listener)
+
+
+async def _iter_segment(segment, token):
+    """Async reader over a cached or in-flight segment; waits for the fill
+    thread to signal new data instead of blocking a thread"""
+    waiter = None
+    try:
+        while True:
+            chunks, finished, error = segment.read_from(token)
+            for chunk in chunks:
+                yield chunk
+            # read_from() is a consistent snapshot: once finished, nothing follows
+            if finished:
+                if error is not None:
+                    raise error
+                return
+            if not chunks:
+                if waiter is None:
+                    # Registered before polling again, so no wake-up is missed
+                    waiter = _SegmentWaiter(segment)
+                    continue
+                await waiter.wait()
+    finally:
+        if waiter is not None:
+            waiter.close()
+
+
+application = StreamWeaverASGI(flask_app.app)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run('asgi:application', host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,216 @@
+"""
+Fingerprinted, precompressed static assets.
+
+`python assets.py` copies the stylesheets, scripts, PWA icons, favicon and
+web app manifest into static/dist/ under content-hashed names
+(css/style.3f2a1b9c0d1e.css), next to .gz and, when the brotli package is
+installed, .br variants of the text files, and records the mapping in
+static/dist/assets.json. It also writes dist/sw.js: static/sw.js with the
+precache list set to the hashed URLs and CACHE_NAME derived from them, so
+the service worker changes exactly when an asset does.
+
+Templates link assets through asset_url(), which falls back to the plain
+/static/ URL for anything not built. A hashed URL never changes content,
+so it is served with immutable caching and the variant the client's
+Accept-Encoding allows; repeat visits then cost no asset requests at all.
+Run the build after every change to static/ (the Dockerfile does).
+"""
+
+import os
+import re
+import gzip
+import json
+import hashlib
+import mimetypes
+
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_DIR = 'static'
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+ASSET_MANIFEST = os.path.join(DIST_DIR, 'assets.json')
+SOURCE_WORKER = os.path.join(STATIC_DIR, 'sw.js')
+# Directories and single files under static/ that are built
+SOURCES = ('css', 'js', 'icons', 'favicon.ico', 'manifest.json')
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.ico', '.txt')
+HASH_LENGTH = 12
+# Pages precached by the service worker besides the assets
+PRECACHE_PAGES = ('/',)
+# Preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+_manifest = {}
+_manifest_mtime = None
+
+
+def _hashed_name(path, digest):
+    root, ext = os.path.splitext(path)
+    return f'{root}.{digest[:HASH_LENGTH]}{ext}'
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _compressed(data):
+    """(suffix, bytes) for each encoding that makes `data` smaller"""
+    variants = [('.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(data, quality=11)))
+    return [(suffix, encoded) for suffix, encoded in variants if len(encoded) < len(data)]
+
+
+def _emit(name, data):
+    """Write `data` as the hashed form of asset `name`, with its compressed
+    variants. Returns the hashed name and the files written."""
+    hashed = _hashed_name(name, hashlib.sha256(data).hexdigest())
+    path = os.path.join(DIST_DIR, hashed)
+    written = [hashed]
+    if not os.path.exists(path):
+        _write(path, data)
+    if name.endswith(COMPRESSIBLE):
+        for suffix, encoded in _compressed(data):
+            if not os.path.exists(path + suffix):
+                _write(path + suffix, encoded)
+            written.append(hashed + suffix)
+    return hashed, written
+
+
+def _source_files():
+    for source in SOURCES:
+        top = os.path.join(STATIC_DIR, source)
+        if os.path.isfile(top):
+            yield source
+            continue
+        for directory, _, files in os.walk(top):
+            for filename in sorted(files):
+                yield os.path.relpath(os.path.join(directory, filename), STATIC_DIR).replace(os.sep, '/')
+
+
+def _rewrite_web_manifest(data, assets):
+    # Icons listed in the web app manifest are fetched by the browser
+    # outside any template, so point them at their hashed files here
+    manifest = json.loads(data)
+    for icon in manifest.get('icons', []):
+        src = icon.get('src', '')
+        if src.startswith('/static/') and src[len('/static/'):] in assets:
+            icon['src'] = f"/static/dist/{assets[src[len('/static/'):]]}"
+    return json.dumps(manifest, indent=2).encode('utf-8')
+
+
+def _service_worker(assets):
+    with open(SOURCE_WORKER) as f:
+        source = f.read()
+    urls = list(PRECACHE_PAGES) + [f'/static/dist/{hashed}' for hashed in sorted(assets.values())]
+    version = hashlib.sha256('\n'.join(urls).encode('utf-8')).hexdigest()[:HASH_LENGTH]
+    source, names = re.subn(r"const CACHE_NAME = [^;]*;", f"const CACHE_NAME = 'stream-weaver-{version}';", source)
+    source, lists = re.subn(r"const urlsToCache = \[[^\]]*\];",
+                            lambda _: f'const urlsToCache = {json.dumps(urls, indent=2)};', source)
+    if not (names and lists):
+        raise ValueError(f'{SOURCE_WORKER} must declare CACHE_NAME and urlsToCache')
+    return source.encode('utf-8')
+
+
+def _prune(keep):
+    removed = 0
+    for directory, _, files in os.walk(DIST_DIR):
+        for filename in files:
+            name = os.path.relpath(os.path.join(directory, filename), DIST_DIR).replace(os.sep, '/')
+            if name not in keep:
+                os.remove(os.path.join(directory, filename))
+                removed += 1
+    return removed
+
+
+def build():
+    """Build static/dist/. Files of the previous build are kept, so pages
+    rendered just before a deploy still load; older ones are removed.
+    Returns the new {name: hashed name} mapping."""
+    try:
+        with open(ASSET_MANIFEST) as f:
+            previous = json.load(f)
+    except FileNotFoundError:
+        previous = {'files': []}
+
+    assets = {}
+    files = []
+    web_manifest = None
+    for name in _source_files():
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            data = f.read()
+        if name == 'manifest.json':
+            # Last, once the icons' hashed names are known
+            web_manifest = data
+            continue
+        assets[name], written = _emit(name, data)
+        files += written
+    if web_manifest is not None:
+        assets['manifest.json'], written = _emit('manifest.json', _rewrite_web_manifest(web_manifest, assets))
+        files += written
+
+    _write(os.path.join(DIST_DIR, 'sw.js'), _service_worker(assets))
+    _write(ASSET_MANIFEST, json.dumps({'assets': assets, 'files': files}, indent=2).encode('utf-8'))
+    _prune(set(files) | set(previous['files']) | {'sw.js', 'assets.json'})
+    return assets
+
+
+def manifest():
+    """The {name: hashed name} mapping of the last build, reloaded when it changes"""
+    global _manifest, _manifest_mtime
+    try:
+        mtime = os.stat(ASSET_MANIFEST).st_mtime_ns
+    except FileNotFoundError:
+        _manifest, _manifest_mtime = {}, None
+        return _manifest
+    if mtime != _manifest_mtime:
+        with open(ASSET_MANIFEST) as f:
+            _manifest = json.load(f)['assets']
+        _manifest_mtime = mtime
+    return _manifest
+
+
+def asset_url(name):
+    """URL of static asset `name` (relative to static/): the hashed file
+    when built, else the plain static URL"""
+    hashed = manifest().get(name)
+    return f'/static/dist/{hashed}' if hashed else f'/static/{name}'
+
+
+def dist_file(name):
+    path = safe_join(DIST_DIR, name)
+    return path if path and os.path.isfile(path) else None
+
+
+def negotiate(path, accept_encodings):
+    """(path, Content-Encoding) of the best precompressed variant of `path`
+    the client accepts, or (path, None)"""
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding] > 0 and os.path.isfile(path + suffix):
+            return path + suffix, encoding
+    return path, None
+
+
+def mimetype(name):
+    if os.path.basename(name).startswith('manifest.') and name.endswith('.json'):
+        return 'application/manifest+json'
+    return mimetypes.guess_type(name)[0]
+
+
+def service_worker():
+    """The built service worker, or the source one before any build"""
+    built = os.path.join(DIST_DIR, 'sw.js')
+    return built if os.path.isfile(built) else SOURCE_WORKER
+
+
+if __name__ == '__main__':
+    assets = build()
+    print(f'Built {len(assets)} assets into {DIST_DIR}/'
+          + ('' if brotli else ' (gzip only; install brotli for .br variants)'))
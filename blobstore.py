@@ -0,0 +1,176 @@
+"""
+Content-addressed storage for uploaded media.
+
+Each distinct file body is stored once under its SHA-256 digest in
+BLOB_FOLDER and tracked in the blobs table with a reference count. The
+familiar static/uploads/<filename> path is a hard link to the blob (a
+symlink when the two folders are on different filesystems), so streaming,
+players and static serving are unchanged while re-uploads of the same
+content cost no extra disk.
+
+Deleting media releases its reference; the blob file itself is removed
+only once the last referencing row is gone, and only after the caller's
+transaction has committed.
+"""
+
+import os
+import uuid
+import shutil
+import hashlib
+from collections import Counter
+
+BLOB_FOLDER = os.environ.get('BLOB_STORE_DIR', 'blobs')
+CHUNK_SIZE = 64 * 1024
+
+
+def new_hasher():
+    return hashlib.sha256()
+
+
+def blob_path(digest):
+    # Two-level fan-out keeps directories small for large libraries
+    return os.path.join(BLOB_FOLDER, digest[:2], digest)
+
+
+def hash_file(path, length=None):
+    """Return a hasher fed with the first `length` bytes (default: all) of `path`"""
+    hasher = new_hasher()
+    remaining = length
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return hasher
+
+
+def save_stream(stream, max_size=None):
+    """Copy `stream` to a temporary file in the blob store, hashing as it
+    goes. Returns (temp_path, digest, size); raises ValueError past max_size."""
+    tmp_dir = os.path.join(BLOB_FOLDER, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+
+    hasher = new_hasher()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size is not None and size > max_size:
+                    raise ValueError('File too large')
+                hasher.update(chunk)
+                out.write(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return tmp_path, hasher.hexdigest(), size
+
+
+def put(conn, path, digest, size):
+    """Move the file at `path` into the store under `digest` and count one
+    reference to it, in the caller's transaction. That transaction must
+    hold the write lock (BEGIN IMMEDIATE) from here to its commit: a
+    concurrent delete then either sees the new reference or has already
+    removed its blob, never removes the one kept here. If the content is
+    already stored and referenced the new copy is simply dropped.
+    Returns True when the content was a duplicate."""
+    target = blob_path(digest)
+    referenced = conn.execute('SELECT 1 FROM blobs WHERE digest = ? AND refcount > 0', (digest,)).fetchone()
+    add_reference(conn, digest, size)
+    if referenced and os.path.exists(target):
+        os.remove(path)
+        return True
+
+    # Also replaces a released blob still waiting for remove(), which will
+    # now find it referenced and keep it
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(path, target)
+    except OSError:
+        # Part files may live on another filesystem
+        shutil.move(path, target)
+    return False
+
+
+def link(digest, destination, replace=True):
+    """Make `destination` point at the stored blob. An existing file there
+    is replaced atomically, so readers never see it missing; with
+    replace=False it is left alone and FileExistsError raised instead."""
+    target = blob_path(digest)
+    path = f'{destination}.{uuid.uuid4().hex}.tmp' if replace else destination
+    try:
+        os.link(target, path)
+    except (FileNotFoundError, FileExistsError):
+        # No blob to point at (never leave a dangling symlink), or the
+        # name is taken
+        raise
+    except OSError:
+        os.symlink(os.path.abspath(target), path)
+    if replace:
+        os.replace(path, destination)
+
+
+def add_reference(conn, digest, size):
+    """Count one more media row pointing at `digest`. Runs in the caller's transaction."""
+    conn.execute('''INSERT INTO blobs (digest, size, refcount) VALUES (?, ?, 1)
+                    ON CONFLICT(digest) DO UPDATE SET refcount = refcount + 1''', (digest, size))
+
+
+def release(conn, digests):
+    """Drop one reference per digest (None entries are ignored) in the
+    caller's transaction. Returns the digests that are now unreferenced;
+    pass them to remove() once the transaction has committed."""
+    counts = Counter(digest for digest in digests if digest)
+    if not counts:
+        return []
+    conn.executemany('UPDATE blobs SET refcount = refcount - ? WHERE digest = ?',
+                     [(n, digest) for digest, n in counts.items()])
+    orphans = []
+    keys = list(counts)
+    for i in range(0, len(keys), 500):
+        batch = keys[i:i + 500]
+        placeholders = ','.join('?' * len(batch))
+        orphans += [row[0] for row in conn.execute(
+            f'SELECT digest FROM blobs WHERE digest IN ({placeholders}) AND refcount <= 0', batch)]
+    conn.executemany('DELETE FROM blobs WHERE digest = ?', [(digest,) for digest in orphans])
+    return orphans
+
+
+def _unlink(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def remove(conn, digests, pool=None):
+    """Delete blob files for unreferenced digests, unlinking on `pool` when
+    given. Digests referenced again since their release are kept; the write
+    lock held meanwhile keeps put() from taking a reference to a file being
+    deleted. Returns bytes freed."""
+    digests = list(dict.fromkeys(digest for digest in digests if digest))
+    if not digests:
+        return 0
+    map_ = pool.map if pool is not None else map
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        referenced = set()
+        for i in range(0, len(digests), 500):
+            batch = digests[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            referenced.update(row[0] for row in conn.execute(
+                f'SELECT digest FROM blobs WHERE digest IN ({placeholders}) AND refcount > 0', batch))
+        freed = sum(map_(_unlink, [blob_path(digest) for digest in digests if digest not in referenced]))
+    finally:
+        # Nothing was written; this just releases the lock
+        conn.rollback()
+    return freed
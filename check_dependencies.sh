@@ -24,6 +24,13 @@ else
     echo "⚠ OpenVPN: NOT FOUND (VPN features will be disabled)"
 fi
 
+# Check FFmpeg
+if command -v ffmpeg &> /dev/null; then
+    echo "✓ FFmpeg: $(ffmpeg -version 2>&1 | head -n1 | cut -d' ' -f1-3)"
+else
+    echo "⚠ FFmpeg: NOT FOUND (uploads will not be offered as HLS)"
+fi
+
 echo ""
 echo "Checking Python packages..."
 echo "=================================================="
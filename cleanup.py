@@ -0,0 +1,194 @@
+"""
+Removal of expired media, shared by POST /cleanup and cleanup_script.py.
+
+Expired media is processed in batches of BATCH_SIZE rows, oldest first,
+walking the upload_date index. For each batch the files (media links,
+subtitles and their WebVTT artifacts) are unlinked in parallel, then the
+rows are removed with one set-based DELETE per table in a short
+transaction, and blobs that lost their last reference are removed once
+that transaction has committed. The write lock is only held for one
+batch's DELETEs, so the web app keeps working during a large purge.
+
+Every batch commits on its own, so an interrupted run (or one stopped by
+max_batches / time_budget) is resumed by simply running again. With
+dry_run nothing is touched and the report says what would be removed.
+"""
+
+import os
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import blobstore
+import uploads
+import subtitles
+import playlist_cache
+import playlist_health
+import hls_packager
+import transcode
+import previews
+
+BATCH_SIZE = int(os.environ.get('CLEANUP_BATCH_SIZE', 200))
+UNLINK_WORKERS = int(os.environ.get('CLEANUP_UNLINK_WORKERS', 8))
+
+
+def _placeholders(values):
+    return ','.join('?' * len(values))
+
+
+def _reclaimable(st):
+    # Media files that are links into the blob store free nothing by
+    # themselves; their space comes back when the blob is removed
+    if stat.S_ISLNK(st.st_mode) or st.st_nlink > 1:
+        return 0
+    return st.st_size
+
+
+def _size(path):
+    try:
+        return _reclaimable(os.lstat(path))
+    except FileNotFoundError:
+        return None
+
+
+def _unlink(path):
+    """Remove `path`; returns bytes freed, or None if it was already gone"""
+    try:
+        st = os.lstat(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return None
+    return _reclaimable(st)
+
+
+def _next_batch(conn, cutoff, after, batch_size):
+    if after is None:
+        return conn.execute('''SELECT id, filename, blob_digest, upload_date FROM media
+                               WHERE upload_date < ? ORDER BY upload_date, id LIMIT ?''',
+                            (cutoff, batch_size)).fetchall()
+    return conn.execute('''SELECT id, filename, blob_digest, upload_date FROM media
+                           WHERE upload_date < ? AND (upload_date, id) > (?, ?)
+                           ORDER BY upload_date, id LIMIT ?''',
+                        (cutoff, after[0], after[1], batch_size)).fetchall()
+
+
+def _batch_paths(conn, media, upload_folder, subtitle_folder):
+    ids = [row['id'] for row in media]
+    subtitle_files = [row[0] for row in conn.execute(
+        f'SELECT filename FROM subtitles WHERE media_id IN ({_placeholders(ids)})', ids)]
+    paths = [os.path.join(upload_folder, row['filename']) for row in media]
+    paths += [os.path.join(subtitle_folder, filename) for filename in subtitle_files]
+    paths += [subtitles.artifact_path(filename) for filename in subtitle_files]
+    # Subtitle rows can share a file; count each path once
+    return ids, subtitle_files, list(dict.fromkeys(paths))
+
+
+def _freed_blob_bytes(conn, cutoff):
+    """Size and count of blobs whose every reference is expired media"""
+    row = conn.execute('''SELECT COALESCE(SUM(b.size), 0), COUNT(*) FROM blobs b
+                          JOIN (SELECT blob_digest, COUNT(*) AS n FROM media
+                                WHERE upload_date < ? AND blob_digest IS NOT NULL
+                                GROUP BY blob_digest) m ON m.blob_digest = b.digest
+                          WHERE b.refcount <= m.n''', (cutoff,)).fetchone()
+    return row[0], row[1]
+
+
+def delete_media(conn, media, upload_folder, subtitle_folder, pool=None, paths=None):
+    """Delete one batch of media rows (id, filename, blob_digest) with their
+    files, subtitles and analytics, unlinking on `pool` when given.
+    Returns {'media', 'files', 'blobs', 'bytes'}."""
+    map_ = pool.map if pool is not None else map
+    if paths is None:
+        _, _, paths = _batch_paths(conn, media, upload_folder, subtitle_folder)
+
+    # Files go first: if the run dies here the rows are still there and
+    # the next run retries, and missing files are simply skipped
+    freed = [size for size in map_(_unlink, paths) if size is not None]
+
+    ids = [row['id'] for row in media]
+    placeholders = _placeholders(ids)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        # Only rows still present count: another worker may have deleted
+        # some of them already, and their blobs must not be released twice
+        present = conn.execute(f'SELECT id, blob_digest FROM media WHERE id IN ({placeholders})', ids).fetchall()
+        conn.execute(f'DELETE FROM subtitles WHERE media_id IN ({placeholders})', ids)
+        conn.execute(f'DELETE FROM analytics WHERE media_id IN ({placeholders})', ids)
+        conn.execute(f'DELETE FROM transcode_jobs WHERE media_id IN ({placeholders})', ids)
+        conn.execute(f'DELETE FROM media WHERE id IN ({placeholders})', ids)
+        orphans = blobstore.release(conn, [row[1] for row in present])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+    blob_bytes = blobstore.remove(conn, orphans, pool)
+    hls_packager.remove(ids)
+    transcode.remove_outputs(ids)
+    previews.remove(ids)
+    return {'media': len(present), 'files': len(freed), 'blobs': len(orphans), 'bytes': sum(freed) + blob_bytes}
+
+
+def run(conn, cutoff, upload_folder, subtitle_folder, dry_run=False, batch_size=BATCH_SIZE,
+        max_batches=None, time_budget=None, log=None):
+    """Remove media uploaded before `cutoff` ('YYYY-MM-DD HH:MM:SS').
+
+    Stops early after `max_batches` batches or `time_budget` seconds, with
+    report['complete'] False; calling again carries on. `log` is called
+    with the filename of each media item removed. Returns the report.
+    """
+    report = {
+        'dry_run': dry_run,
+        'cutoff': cutoff,
+        'media': 0,
+        'subtitles': 0,
+        'files': 0,
+        'blobs': 0,
+        'bytes': 0,
+        'batches': 0,
+        'stale_uploads': 0,
+        'complete': True,
+    }
+    started = time.monotonic()
+    after = None
+
+    if dry_run:
+        report['bytes'], report['blobs'] = _freed_blob_bytes(conn, cutoff)
+
+    with ThreadPoolExecutor(max_workers=UNLINK_WORKERS) as pool:
+        while True:
+            if not dry_run and ((max_batches is not None and report['batches'] >= max_batches) or
+                                (time_budget is not None and time.monotonic() - started >= time_budget)):
+                report['complete'] = False
+                break
+
+            media = _next_batch(conn, cutoff, after, batch_size)
+            if not media:
+                break
+            _, subtitle_files, paths = _batch_paths(conn, media, upload_folder, subtitle_folder)
+            report['batches'] += 1
+            report['media'] += len(media)
+            report['subtitles'] += len(subtitle_files)
+
+            if dry_run:
+                sizes = [size for size in pool.map(_size, paths) if size is not None]
+                report['files'] += len(sizes)
+                report['bytes'] += sum(sizes)
+                after = (media[-1]['upload_date'], media[-1]['id'])
+                continue
+
+            removed = delete_media(conn, media, upload_folder, subtitle_folder, pool, paths)
+            for key in ('files', 'blobs', 'bytes'):
+                report[key] += removed[key]
+            if log is not None:
+                for row in media:
+                    log(row['filename'])
+
+    if dry_run:
+        report['stale_uploads'] = len(uploads.find_stale(conn))
+    elif report['complete']:
+        report['stale_uploads'] = uploads.prune_stale(conn)
+        playlist_cache.remove_orphans(conn)
+        playlist_health.prune(conn)
+        hls_packager.prune()
+    return report
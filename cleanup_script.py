@@ -2,11 +2,14 @@
 """
 Cleanup script for PythonAnywhere scheduled tasks
 Run this daily to remove old media files and free up disk space
+Pass --dry-run to see what would be removed without deleting anything
 """
 
-import os
+import sys
 import sqlite3
 from datetime import datetime, timedelta
+import db
+import cleanup
 
 # Configuration
 UPLOAD_FOLDER = 'static/uploads'
@@ -14,65 +17,36 @@ SUBTITLE_FOLDER = 'static/subtitles'
 DATABASE = 'mediafusion.db'
 CLEANUP_HOURS = 24  # Delete files older than this many hours
 
-def cleanup_old_files(hours=CLEANUP_HOURS):
+def cleanup_old_files(hours=CLEANUP_HOURS, dry_run=False):
     """Remove files older than specified hours"""
     cutoff = datetime.now() - timedelta(hours=hours)
     
-    conn = sqlite3.connect(DATABASE)
+    conn = db.connect(DATABASE)
     conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    
-    # Find old files
-    old_files = c.execute(
-        'SELECT * FROM media WHERE upload_date < ?',
-        (cutoff,)
-    ).fetchall()
-    
-    deleted_count = 0
-    freed_space = 0
-    
-    for media in old_files:
-        # Delete media file
-        filepath = os.path.join(UPLOAD_FOLDER, media['filename'])
-        if os.path.exists(filepath):
-            file_size = os.path.getsize(filepath)
-            os.remove(filepath)
-            freed_space += file_size
-            deleted_count += 1
-            print(f"Deleted: {media['filename']} ({file_size / 1024 / 1024:.2f} MB)")
-        
-        # Delete associated subtitles
-        subtitles = c.execute(
-            'SELECT * FROM subtitles WHERE media_id = ?',
-            (media['id'],)
-        ).fetchall()
-        
-        for subtitle in subtitles:
-            sub_path = os.path.join(SUBTITLE_FOLDER, subtitle['filename'])
-            if os.path.exists(sub_path):
-                os.remove(sub_path)
-        
-        # Delete from database
-        c.execute('DELETE FROM subtitles WHERE media_id = ?', (media['id'],))
-        c.execute('DELETE FROM analytics WHERE media_id = ?', (media['id'],))
-        c.execute('DELETE FROM media WHERE id = ?', (media['id'],))
-    
-    conn.commit()
-    conn.close()
-    
-    print(f"\nCleanup Summary:")
-    print(f"Files deleted: {deleted_count}")
-    print(f"Space freed: {freed_space / 1024 / 1024:.2f} MB")
+    try:
+        report = cleanup.run(conn, cutoff.strftime('%Y-%m-%d %H:%M:%S'), UPLOAD_FOLDER, SUBTITLE_FOLDER,
+                             dry_run=dry_run, log=None if dry_run else lambda filename: print(f"Deleted: {filename}"))
+    finally:
+        conn.close()
+    
+    print(f"\nCleanup Summary{' (dry run, nothing deleted)' if dry_run else ''}:")
+    print(f"Media items {'to delete' if dry_run else 'deleted'}: {report['media']}")
+    print(f"Files {'to delete' if dry_run else 'deleted'}: {report['files']}")
+    print(f"Blobs {'to delete' if dry_run else 'deleted'}: {report['blobs']}")
+    print(f"Space {'to free' if dry_run else 'freed'}: {report['bytes'] / 1024 / 1024:.2f} MB")
+    print(f"Stale uploads {'to remove' if dry_run else 'removed'}: {report['stale_uploads']}")
+    print(f"Batches: {report['batches']}")
     print(f"Cutoff date: {cutoff.strftime('%Y-%m-%d %H:%M:%S')}")
     
-    return deleted_count, freed_space
+    return report['media'], report['bytes']
 
 if __name__ == '__main__':
+    dry_run = '--dry-run' in sys.argv
     print(f"Starting cleanup of files older than {CLEANUP_HOURS} hours...")
     print(f"Current time: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
     
     try:
-        deleted, freed = cleanup_old_files()
+        deleted, freed = cleanup_old_files(dry_run=dry_run)
         print("\n✓ Cleanup completed successfully")
     except Exception as e:
         print(f"\n✗ Error during cleanup: {str(e)}")
@@ -0,0 +1,95 @@
+"""
+Pooled SQLite connections for mediafusion.db.
+
+Each worker process keeps a small pool of open connections instead of
+opening a new one per request. Connections run in WAL mode, so readers
+never block behind the analytics writer, and carry a busy_timeout so
+concurrent writers from other workers wait instead of failing. Statement
+caching is per connection, so reusing connections also reuses prepared
+statements.
+"""
+
+import os
+import queue
+import sqlite3
+import threading
+
+DATABASE = 'mediafusion.db'
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', 16 * 1024))
+MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', 128 * 1024 * 1024))
+CACHED_STATEMENTS = 256
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+class PooledConnection(sqlite3.Connection):
+    """A connection whose close() hands it back to the pool. Callers keep
+    the usual get_db() / conn.close() pattern."""
+
+    def close(self):
+        # Guard against double close() putting one connection in the pool twice
+        if not getattr(self, 'in_pool', False):
+            self.in_pool = True
+            _release(self)
+
+    def really_close(self):
+        sqlite3.Connection.close(self)
+
+
+def _apply_pragmas(conn):
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size={MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+
+
+def connect(database=DATABASE, factory=sqlite3.Connection):
+    """Open a tuned connection outside the pool (schema setup, scripts)"""
+    conn = sqlite3.connect(database, timeout=BUSY_TIMEOUT_MS / 1000,
+                           cached_statements=CACHED_STATEMENTS,
+                           check_same_thread=False, factory=factory)
+    _apply_pragmas(conn)
+    return conn
+
+
+def _get_pool():
+    # Pools never cross a fork: a gunicorn worker builds its own on first use
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = queue.LifoQueue(maxsize=POOL_SIZE)
+                _pool_pid = pid
+    return _pool
+
+
+def get_connection():
+    """Borrow a connection from this process's pool, opening one if it is empty"""
+    try:
+        conn = _get_pool().get_nowait()
+    except queue.Empty:
+        conn = connect(factory=PooledConnection)
+    conn.in_pool = False
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def _release(conn):
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+    except sqlite3.Error:
+        conn.really_close()
+        return
+
+    try:
+        _get_pool().put_nowait(conn)
+    except queue.Full:
+        conn.really_close()
@@ -0,0 +1,251 @@
+"""
+On-demand HLS packaging of uploaded media.
+
+/hls/<media_id>/index.m3u8 describes the item as a VOD playlist of
+SEGMENT_SECONDS MPEG-TS segments, computed from the probed duration alone,
+so the playlist is ready at once and nothing is encoded up front. Each
+segment is cut and encoded by ffmpeg the first time it is requested
+(seeking straight to its start, so a seek costs one segment's encode
+rather than a read through the file) and kept under CACHE_DIR/<media_id>/
+for every later viewer. Encoding the following segment is started in the
+background as soon as one is served, so straight playback rarely waits.
+
+Segments are re-encoded at a capped bitrate and height, so clients on
+weak links no longer pull the original file's bitrate. The encoder is
+optional: without an ffmpeg binary available() is False and the player
+keeps using the progressive /stream/ URL.
+"""
+
+import os
+import math
+import shutil
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+FFMPEG = os.environ.get('FFMPEG_BINARY') or shutil.which('ffmpeg')
+CACHE_DIR = os.environ.get('HLS_CACHE_DIR', 'cache/hls')
+CACHE_MAX_BYTES = int(os.environ.get('HLS_CACHE_BYTES', 2 * 1024 * 1024 * 1024))
+SEGMENT_SECONDS = int(os.environ.get('HLS_SEGMENT_SECONDS', 6))
+MAX_HEIGHT = int(os.environ.get('HLS_MAX_HEIGHT', 720))
+VIDEO_BITRATE = int(os.environ.get('HLS_VIDEO_BITRATE', 2000))  # kbit/s
+AUDIO_BITRATE = 128  # kbit/s
+MAX_ENCODERS = int(os.environ.get('HLS_MAX_ENCODERS', max(1, (os.cpu_count() or 2) // 2)))
+ENCODE_TIMEOUT = 120
+READAHEAD = 1
+PACKAGED_TYPES = ('video', 'audio')
+
+_encoders = threading.BoundedSemaphore(MAX_ENCODERS)
+_inflight = {}
+_inflight_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+_stats = {'encoded': 0, 'hits': 0, 'failed': 0}
+
+
+class PackagingError(Exception):
+    pass
+
+
+def available():
+    return FFMPEG is not None
+
+
+def can_package(media):
+    return available() and media['file_type'] in PACKAGED_TYPES and bool(media['duration'])
+
+
+def _media_dir(media_id):
+    return os.path.join(CACHE_DIR, str(int(media_id)))
+
+
+def _segment_name(index):
+    return f'{index:05d}.ts'
+
+
+def segment_count(duration):
+    return max(1, math.ceil(duration / SEGMENT_SECONDS))
+
+
+def _segment_bounds(duration, index):
+    start = index * SEGMENT_SECONDS
+    return start, min(SEGMENT_SECONDS, duration - start)
+
+
+def _prepare_dir(media):
+    """The media's cache directory, emptied first if it was left by another
+    item that had the same id"""
+    directory = _media_dir(media['id'])
+    marker = os.path.join(directory, 'source')
+    try:
+        with open(marker) as f:
+            if f.read() == media['filename']:
+                return directory
+        shutil.rmtree(directory, ignore_errors=True)
+    except FileNotFoundError:
+        pass
+    os.makedirs(directory, exist_ok=True)
+    with open(marker, 'w') as f:
+        f.write(media['filename'])
+    prune()
+    return directory
+
+
+def playlist(media):
+    """The VOD playlist for `media`; segment URIs are relative to it"""
+    directory = _prepare_dir(media)
+    # Marks the item as recently played for prune()
+    os.utime(directory)
+    duration = media['duration']
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-PLAYLIST-TYPE:VOD',
+             f'#EXT-X-TARGETDURATION:{SEGMENT_SECONDS}', '#EXT-X-MEDIA-SEQUENCE:0']
+    for index in range(segment_count(duration)):
+        lines.append(f'#EXTINF:{_segment_bounds(duration, index)[1]:.3f},')
+        lines.append(_segment_name(index))
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def _encode_args(source, media, index, output):
+    start, length = _segment_bounds(media['duration'], index)
+    args = [FFMPEG, '-nostdin', '-loglevel', 'error', '-ss', f'{start:.3f}', '-i', source, '-t', f'{length:.3f}']
+    if media['file_type'] == 'video':
+        args += ['-map', '0:v:0?', '-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main',
+                 '-pix_fmt', 'yuv420p', '-vf', f"scale=-2:'min({MAX_HEIGHT},ih)'",
+                 '-b:v', f'{VIDEO_BITRATE}k', '-maxrate', f'{VIDEO_BITRATE * 3 // 2}k',
+                 '-bufsize', f'{VIDEO_BITRATE * 2}k', '-force_key_frames', 'expr:eq(n,0)']
+    args += ['-map', '0:a:0?', '-c:a', 'aac', '-b:a', f'{AUDIO_BITRATE}k', '-ac', '2', '-sn', '-dn']
+    # Each segment is encoded on its own; offsetting its timestamps to its
+    # place in the item keeps the segments one continuous timeline
+    args += ['-output_ts_offset', f'{start:.3f}', '-muxdelay', '0', '-f', 'mpegts', output]
+    return args
+
+
+def _encode(source, media, index, path):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with _encoders:
+            result = subprocess.run(_encode_args(source, media, index, tmp_path), stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE, timeout=ENCODE_TIMEOUT)
+        if result.returncode != 0 or not os.path.exists(tmp_path):
+            message = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+            raise PackagingError(message[-1] if message else f'ffmpeg exited with {result.returncode}')
+        os.replace(tmp_path, path)
+    except subprocess.TimeoutExpired:
+        raise PackagingError('Segment encode timed out')
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def _produce(source, media, index):
+    path = os.path.join(_media_dir(media['id']), _segment_name(index))
+    if os.path.exists(path):
+        return path, False
+
+    key = (media['id'], index)
+    with _inflight_lock:
+        done = _inflight.get(key)
+        owner = done is None
+        if owner:
+            done = _inflight[key] = threading.Event()
+    if not owner:
+        # Someone else is encoding it; share their result
+        done.wait(ENCODE_TIMEOUT)
+        if os.path.exists(path):
+            return path, False
+        raise PackagingError('Segment encode failed')
+
+    try:
+        _encode(source, media, index, path)
+        _stats['encoded'] += 1
+    except (PackagingError, OSError):
+        _stats['failed'] += 1
+        raise
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        done.set()
+    return path, True
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _inflight_lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(max_workers=MAX_ENCODERS)
+                _executor_pid = pid
+    return _executor
+
+
+def _read_ahead(source, media, index):
+    try:
+        _produce(source, media, index)
+    except (PackagingError, OSError):
+        # The player's own request for it will report the failure
+        pass
+
+
+def segment(source, media, index):
+    """Path of segment `index` of `media` (source file at `source`),
+    encoding it first if it is not cached yet. Raises IndexError for an
+    index past the end and PackagingError when encoding fails."""
+    if not 0 <= index < segment_count(media['duration']):
+        raise IndexError(index)
+    _prepare_dir(media)
+    path, encoded = _produce(source, media, index)
+    if not encoded:
+        _stats['hits'] += 1
+
+    executor = _get_executor()
+    for ahead in range(index + 1, min(index + 1 + READAHEAD, segment_count(media['duration']))):
+        if not os.path.exists(os.path.join(_media_dir(media['id']), _segment_name(ahead))):
+            executor.submit(_read_ahead, source, media, ahead)
+    return path
+
+
+def remove(media_ids):
+    """Drop the cached segments of deleted media"""
+    for media_id in media_ids:
+        shutil.rmtree(_media_dir(media_id), ignore_errors=True)
+
+
+def _dir_size(directory):
+    total = 0
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            try:
+                total += entry.stat().st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def prune(max_bytes=CACHE_MAX_BYTES):
+    """Remove the least recently played items' segments until the cache
+    fits in `max_bytes`. Returns the number of items removed."""
+    try:
+        with os.scandir(CACHE_DIR) as entries:
+            dirs = [(entry.stat().st_mtime, entry.path) for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return 0
+    sizes = {path: _dir_size(path) for _, path in dirs}
+    total = sum(sizes.values())
+    removed = 0
+    for _, path in sorted(dirs):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= sizes[path]
+        removed += 1
+    return removed
+
+
+def stats():
+    snapshot = dict(_stats)
+    snapshot['available'] = available()
+    with _inflight_lock:
+        snapshot['inflight'] = len(_inflight)
+    return snapshot
@@ -0,0 +1,99 @@
+"""
+Keyset-paginated media library queries.
+
+Pages are addressed by an opaque cursor holding the sort key and id of the
+last row returned, so fetching page N is an index range scan starting
+where page N-1 stopped instead of an OFFSET that walks every earlier row.
+The (sort key, id) pair is unique, which keeps pages stable while uploads
+and play counts change underneath a scrolling client.
+"""
+
+import json
+import base64
+import binascii
+
+DEFAULT_LIMIT = 24
+MAX_LIMIT = 100
+
+# Sort name -> column. Both are descending with id as the tie-breaker.
+SORT_COLUMNS = {
+    'date': 'upload_date',
+    'plays': 'play_count',
+}
+# Sort name -> type of its cursor value, as the column stores it
+SORT_VALUE_TYPES = {
+    'date': str,
+    'plays': int,
+}
+FILE_TYPES = {'video', 'audio', 'playlist'}
+
+LIBRARY_FIELDS = ('id', 'filename', 'original_name', 'file_type', 'file_size', 'mime_type',
+                  'duration', 'upload_date', 'play_count', 'total_watch_time', 'preview_key')
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+def encode_cursor(sort_value, media_id):
+    raw = json.dumps([sort_value, media_id], separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort='date'):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        sort_value, media_id = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError):
+        raise InvalidQuery('Invalid cursor')
+    # Only a value of the sort column's own type compares meaningfully;
+    # anything else is a cursor from another sort or a forged one
+    if not _is_type(media_id, int) or not _is_type(sort_value, SORT_VALUE_TYPES[sort]):
+        raise InvalidQuery('Invalid cursor')
+    return sort_value, media_id
+
+
+def _is_type(value, expected):
+    # JSON true/false decode to bool, which is an int subclass
+    return isinstance(value, expected) and not isinstance(value, bool)
+
+
+def build_query(sort='date', file_type=None, cursor=None, limit=DEFAULT_LIMIT):
+    """SQL and parameters for one page; fetches limit + 1 rows so the
+    caller can tell whether another page exists"""
+    column = SORT_COLUMNS.get(sort)
+    if column is None:
+        raise InvalidQuery(f"Unknown sort '{sort}'")
+    if file_type is not None and file_type not in FILE_TYPES:
+        raise InvalidQuery(f"Unknown file_type '{file_type}'")
+
+    where = []
+    params = []
+    if file_type:
+        where.append('file_type = ?')
+        params.append(file_type)
+    if cursor:
+        # Row-value comparison lets SQLite seek straight into the index
+        where.append(f'({column}, id) < (?, ?)')
+        params.extend(decode_cursor(cursor, sort))
+
+    sql = f'SELECT {", ".join(LIBRARY_FIELDS)} FROM media'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += f' ORDER BY {column} DESC, id DESC LIMIT ?'
+    params.append(limit + 1)
+    return sql, params
+
+
+def fetch_page(conn, sort='date', file_type=None, cursor=None, limit=DEFAULT_LIMIT):
+    """Return (items, next_cursor); next_cursor is None on the last page"""
+    limit = max(1, min(int(limit), MAX_LIMIT))
+    sql, params = build_query(sort, file_type, cursor, limit)
+    rows = conn.execute(sql, params).fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(last[SORT_COLUMNS[sort]], last['id'])
+    return [dict(row) for row in rows], next_cursor
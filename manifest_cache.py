@@ -0,0 +1,173 @@
+"""
+Short-TTL cache and incremental rewriting for proxied HLS playlists.
+
+Players poll live playlists every few seconds. Each rewritten manifest is
+cached per upstream URL for a TTL derived from #EXT-X-TARGETDURATION, and
+when a poll does go upstream only lines that were not in the previous
+version are resolved and quoted; everything else is a dictionary hit.
+URIs inside tag attributes (#EXT-X-KEY, #EXT-X-MAP, #EXT-X-MEDIA, ...)
+are rewritten as well as plain URI lines.
+"""
+
+import re
+import time
+import hashlib
+import threading
+from urllib.parse import urljoin, quote, urlparse
+
+PROXY_PREFIX = '/proxy_resource/'
+VOD_TTL = 300
+MASTER_TTL = 60
+MIN_LIVE_TTL = 1
+
+_URI_ATTRIBUTE = re.compile(r'URI="([^"]*)"')
+_TARGET_DURATION = re.compile(r'^#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)', re.MULTILINE)
+
+
+def is_playlist_url(url):
+    return urlparse(url).path.lower().endswith(('.m3u8', '.m3u'))
+
+
+def proxied_uri(uri, playlist_url):
+    """Resolve `uri` against the playlist URL and route it through the proxy.
+    Non-HTTP schemes (data:, skd:// key URIs) are left untouched."""
+    scheme = urlparse(uri).scheme.lower()
+    if scheme and scheme not in ('http', 'https'):
+        return uri
+    return PROXY_PREFIX + quote(urljoin(playlist_url, uri), safe='')
+
+
+def _rewrite_line(line, playlist_url):
+    if line.startswith('#'):
+        if 'URI="' not in line:
+            return line
+        return _URI_ATTRIBUTE.sub(
+            lambda m: f'URI="{proxied_uri(m.group(1), playlist_url)}"', line)
+    return proxied_uri(line, playlist_url)
+
+
+def playlist_ttl(content):
+    """How long a rewritten playlist may be served without refetching.
+    Live media playlists get half a target duration (what RFC 8216 lets a
+    client wait before reloading an unchanged playlist); VOD and master
+    playlists change rarely, if ever."""
+    if '#EXT-X-ENDLIST' in content:
+        return VOD_TTL
+    match = _TARGET_DURATION.search(content)
+    if not match:
+        return MASTER_TTL
+    return max(MIN_LIVE_TTL, float(match.group(1)) / 2)
+
+
+class _Entry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.expires = 0
+        self.digest = None
+        self.text = None
+        self.lines = {}
+
+
+class ManifestCache:
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'refreshes': 0, 'unchanged': 0, 'lines_rewritten': 0, 'lines_reused': 0}
+
+    def _entry(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is None:
+                if len(self._entries) >= self.max_entries:
+                    self._evict_expired()
+                entry = self._entries[url] = _Entry()
+            return entry
+
+    def _evict_expired(self):
+        now = time.time()
+        for url in [u for u, e in self._entries.items() if e.expires <= now]:
+            del self._entries[url]
+        # Still full: drop the entry closest to expiry
+        if len(self._entries) >= self.max_entries:
+            url = min(self._entries, key=lambda u: self._entries[u].expires)
+            del self._entries[url]
+
+    def get(self, url, fetch):
+        """Return the rewritten playlist for `url`. `fetch()` returns the raw
+        playlist text and is only called when the cached copy has expired;
+        concurrent pollers of the same URL wait for a single refresh."""
+        entry = self._entry(url)
+        with entry.lock:
+            if entry.text is not None and entry.expires > time.time():
+                self._count('hits')
+                return entry.text
+            return self._refresh(url, entry, fetch())
+
+    def lookup(self, url):
+        """Fresh rewritten text for `url`, or None. Non-blocking counterpart
+        of get() for callers (the ASGI mode) that fetch asynchronously."""
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is not None and entry.text is not None and entry.expires > time.time():
+            self._count('hits')
+            return entry.text
+        return None
+
+    def store(self, url, content):
+        """Rewrite freshly fetched playlist text, cache it and return it"""
+        entry = self._entry(url)
+        with entry.lock:
+            return self._refresh(url, entry, content)
+
+    def _refresh(self, url, entry, content):
+        self._count('refreshes')
+        digest = hashlib.sha1(content.encode('utf-8', 'surrogatepass')).digest()
+        if digest != entry.digest:
+            entry.text = self._rewrite(url, content, entry)
+            entry.digest = digest
+        else:
+            self._count('unchanged')
+        entry.expires = time.time() + playlist_ttl(content)
+        return entry.text
+
+    def _rewrite(self, url, content, entry):
+        previous = entry.lines
+        current = {}
+        rewritten_lines = []
+        rewritten = reused = 0
+
+        for line in content.split('\n'):
+            line = line.strip()
+            if not line or (line.startswith('#') and 'URI="' not in line):
+                rewritten_lines.append(line)
+                continue
+
+            out = previous.get(line)
+            if out is None:
+                out = _rewrite_line(line, url)
+                rewritten += 1
+            else:
+                reused += 1
+            current[line] = out
+            rewritten_lines.append(out)
+
+        # Only keep lines still present, so memory tracks the live window
+        entry.lines = current
+        with self._lock:
+            self._stats['lines_rewritten'] += rewritten
+            self._stats['lines_reused'] += reused
+        return '\n'.join(rewritten_lines)
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['entries'] = len(self._entries)
+        return snapshot
+
+
+manifest_cache = ManifestCache()
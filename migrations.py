@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Versioned schema migrations for mediafusion.db.
+
+The schema version is stored in SQLite's PRAGMA user_version. Each
+migration runs inside a BEGIN IMMEDIATE transaction that re-checks the
+version first, so several gunicorn workers starting at once apply each
+migration exactly once and existing deployments upgrade in place.
+
+Usage:
+    python migrations.py            # apply pending migrations
+    python migrations.py --explain  # show query plans for hot statements
+"""
+
+import sys
+import db
+
+
+def _has_duplicates(conn, table, column):
+    return conn.execute(
+        f'SELECT 1 FROM {table} GROUP BY {column} HAVING COUNT(*) > 1 LIMIT 1'
+    ).fetchone() is not None
+
+
+def _m1_lookup_indexes(conn):
+    # Filenames embed an upload timestamp and should be unique, but older
+    # databases may contain duplicates; fall back to a plain index there.
+    if _has_duplicates(conn, 'media', 'filename'):
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_media_filename ON media(filename)')
+    else:
+        conn.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_media_filename ON media(filename)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_upload_date ON media(upload_date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_subtitles_media_id ON subtitles(media_id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_analytics_media_id ON analytics(media_id)')
+
+
+def _m2_library_indexes(conn):
+    # Keyset pages seek on (sort column, id); id is the rowid, so it is
+    # already the last column of every index
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_play_count ON media(play_count)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_type_upload_date ON media(file_type, upload_date)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_type_play_count ON media(file_type, play_count)')
+
+
+def _m3_upload_sessions(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS upload_sessions
+                    (id TEXT PRIMARY KEY,
+                     filename TEXT NOT NULL,
+                     original_name TEXT NOT NULL,
+                     file_type TEXT NOT NULL,
+                     mime_type TEXT,
+                     upload_length INTEGER NOT NULL,
+                     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+
+
+def _m4_blob_store(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS blobs
+                    (digest TEXT PRIMARY KEY,
+                     size INTEGER NOT NULL,
+                     refcount INTEGER NOT NULL DEFAULT 0,
+                     created TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+    # Rows from before the blob store keep a NULL digest and a plain file
+    conn.execute('ALTER TABLE media ADD COLUMN blob_digest TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_media_blob_digest ON media(blob_digest)')
+
+
+def _m5_probe_metadata(conn):
+    # NULL probe_status means "not probed yet", so existing rows get probed too
+    for column, column_type in [('container', 'TEXT'), ('video_codec', 'TEXT'), ('audio_codec', 'TEXT'),
+                                ('width', 'INTEGER'), ('height', 'INTEGER'), ('bitrate', 'INTEGER'),
+                                ('probe_status', 'TEXT')]:
+        conn.execute(f'ALTER TABLE media ADD COLUMN {column} {column_type}')
+
+
+def _m6_playlist_cache(conn):
+    # Items are keyed by (version, position) so a refetch writes a new
+    # version beside the old one and swaps it in when complete
+    conn.execute('''CREATE TABLE playlist_cache (
+        url TEXT PRIMARY KEY,
+        version INTEGER NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        item_count INTEGER NOT NULL,
+        fetched_at REAL NOT NULL,
+        validated_at REAL NOT NULL
+    )''')
+    conn.execute('''CREATE TABLE playlist_items (
+        version INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        item TEXT NOT NULL,
+        PRIMARY KEY (version, position)
+    ) WITHOUT ROWID''')
+
+
+def _m7_playlist_health(conn):
+    conn.execute('''CREATE TABLE playlist_health (
+        uri TEXT PRIMARY KEY,
+        status TEXT NOT NULL,
+        http_status INTEGER,
+        latency_ms INTEGER,
+        content_type TEXT,
+        variant_ok INTEGER,
+        error TEXT,
+        checked_at REAL NOT NULL
+    )''')
+
+
+def _m8_storage_quota(conn):
+    conn.execute('ALTER TABLE media ADD COLUMN last_accessed TIMESTAMP')
+    # Bytes on disk for the subtitle file plus its WebVTT artifact
+    conn.execute('ALTER TABLE subtitles ADD COLUMN file_size INTEGER')
+
+    # Running byte totals, kept exact by triggers so every code path that
+    # adds or removes rows (uploads, deletes, cleanup, eviction) counts
+    conn.execute('''CREATE TABLE storage_usage (
+        kind TEXT PRIMARY KEY,
+        bytes INTEGER NOT NULL
+    )''')
+    conn.execute("INSERT INTO storage_usage VALUES ('blobs', (SELECT COALESCE(SUM(size), 0) FROM blobs))")
+    conn.execute("""INSERT INTO storage_usage VALUES ('media',
+                    (SELECT COALESCE(SUM(file_size), 0) FROM media WHERE blob_digest IS NULL))""")
+    conn.execute("INSERT INTO storage_usage VALUES ('subtitles', 0)")
+    # (table, event, condition, kind, delta); executescript() would commit
+    # the migration's transaction, so each trigger is created separately
+    triggers = [
+        ('blobs', 'INSERT', '', 'blobs', 'NEW.size'),
+        ('blobs', 'DELETE', '', 'blobs', '-OLD.size'),
+        ('media', 'INSERT', 'WHEN NEW.blob_digest IS NULL', 'media', 'COALESCE(NEW.file_size, 0)'),
+        ('media', 'DELETE', 'WHEN OLD.blob_digest IS NULL', 'media', '-COALESCE(OLD.file_size, 0)'),
+        ('subtitles', 'INSERT', '', 'subtitles', 'COALESCE(NEW.file_size, 0)'),
+        ('subtitles', 'UPDATE OF file_size', '', 'subtitles',
+         'COALESCE(NEW.file_size, 0) - COALESCE(OLD.file_size, 0)'),
+        ('subtitles', 'DELETE', '', 'subtitles', '-COALESCE(OLD.file_size, 0)'),
+    ]
+    for table, event, condition, kind, delta in triggers:
+        name = f"storage_{table}_{event.split()[0].lower()}"
+        conn.execute(f'''CREATE TRIGGER {name} AFTER {event} ON {table} {condition} BEGIN
+                            UPDATE storage_usage SET bytes = bytes + ({delta}) WHERE kind = '{kind}';
+                        END''')
+
+    conn.execute('''CREATE TABLE evictions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        media_id INTEGER,
+        filename TEXT NOT NULL,
+        file_size INTEGER,
+        play_count INTEGER,
+        total_watch_time REAL,
+        last_accessed TIMESTAMP,
+        score REAL,
+        reason TEXT,
+        evicted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )''')
+
+
+def _m9_transcode_jobs(conn):
+    # One row per media item; re-transcoding reuses it
+    conn.execute('''CREATE TABLE transcode_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        media_id INTEGER NOT NULL UNIQUE,
+        status TEXT NOT NULL DEFAULT 'queued',
+        priority INTEGER NOT NULL DEFAULT 0,
+        progress REAL NOT NULL DEFAULT 0,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        worker TEXT,
+        heartbeat_at REAL,
+        renditions TEXT,
+        output_bytes INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        started_at REAL,
+        finished_at REAL
+    )''')
+    conn.execute('CREATE INDEX idx_transcode_jobs_next ON transcode_jobs(status, priority DESC, id)')
+
+    conn.execute("INSERT INTO storage_usage VALUES ('transcodes', 0)")
+    triggers = [
+        ('UPDATE OF output_bytes', 'NEW.output_bytes - OLD.output_bytes'),
+        ('DELETE', '-OLD.output_bytes'),
+    ]
+    for event, delta in triggers:
+        conn.execute(f'''CREATE TRIGGER storage_transcodes_{event.split()[0].lower()} AFTER {event} ON transcode_jobs
+                        BEGIN
+                            UPDATE storage_usage SET bytes = bytes + ({delta}) WHERE kind = 'transcodes';
+                        END''')
+
+
+def _m10_webm_remux(conn):
+    # NULL means "not looked at yet", so existing recordings are remuxed too
+    conn.execute('ALTER TABLE media ADD COLUMN remux_status TEXT')
+
+
+def _m11_previews(conn):
+    # NULL status means "not generated yet", so existing media get previews too
+    conn.execute('ALTER TABLE media ADD COLUMN preview_status TEXT')
+    conn.execute('ALTER TABLE media ADD COLUMN preview_key TEXT')
+
+
+def _m12_probe_claims(conn):
+    conn.execute('ALTER TABLE media ADD COLUMN probe_claimed_at REAL')
+
+
+def _m13_remux_claims(conn):
+    conn.execute('ALTER TABLE media ADD COLUMN remux_claimed_at REAL')
+
+
+def _m14_preview_claims(conn):
+    conn.execute('ALTER TABLE media ADD COLUMN preview_claimed_at REAL')
+
+
+def _m15_media_size_trigger(conn):
+    # Rows without a blob count their own file_size (see _m8_storage_quota);
+    # a remux rewrites such a file in place and changes it
+    conn.execute('''CREATE TRIGGER storage_media_update AFTER UPDATE OF file_size, blob_digest ON media BEGIN
+                        UPDATE storage_usage SET bytes = bytes
+                            + (CASE WHEN NEW.blob_digest IS NULL THEN COALESCE(NEW.file_size, 0) ELSE 0 END)
+                            - (CASE WHEN OLD.blob_digest IS NULL THEN COALESCE(OLD.file_size, 0) ELSE 0 END)
+                        WHERE kind = 'media';
+                    END''')
+
+
+# (version, description, function). Append only; never edit a released entry.
+MIGRATIONS = [
+    (1, 'Indexes for filename, upload_date, subtitle and analytics lookups', _m1_lookup_indexes),
+    (2, 'Indexes for keyset-paginated library listing', _m2_library_indexes),
+    (3, 'Resumable upload sessions', _m3_upload_sessions),
+    (4, 'Content-addressed blob store with reference counts', _m4_blob_store),
+    (5, 'Probed stream metadata columns', _m5_probe_metadata),
+    (6, 'Parsed playlist cache', _m6_playlist_cache),
+    (7, 'Playlist item health check results', _m7_playlist_health),
+    (8, 'Storage usage counters, last access time and eviction log', _m8_storage_quota),
+    (9, 'Transcode job queue', _m9_transcode_jobs),
+    (10, 'WebM remux status', _m10_webm_remux),
+    (11, 'Poster, sprite and waveform preview status', _m11_previews),
+    (12, 'Probe claim time, to recover rows of dead workers', _m12_probe_claims),
+    (13, 'WebM remux claim time, to recover rows of dead workers', _m13_remux_claims),
+    (14, 'Preview claim time, to recover rows of dead workers', _m14_preview_claims),
+    (15, 'Count size changes of media stored outside the blob store', _m15_media_size_trigger),
+]
+
+# Statements on the request path, with sample parameters for EXPLAIN
+HOT_QUERIES = [
+    ('media by filename', 'SELECT * FROM media WHERE filename = ?', ('example.mp4',)),
+    ('subtitles by media', 'SELECT * FROM subtitles WHERE media_id = ?', (1,)),
+    ('analytics by media', 'DELETE FROM analytics WHERE media_id = ?', (1,)),
+    ('media older than cutoff', 'SELECT * FROM media WHERE upload_date < ?', ('2000-01-01',)),
+    ('library page by date',
+     'SELECT * FROM media WHERE (upload_date, id) < (?, ?) ORDER BY upload_date DESC, id DESC LIMIT 25',
+     ('2100-01-01', 0)),
+    ('library page by plays, filtered',
+     'SELECT * FROM media WHERE file_type = ? AND (play_count, id) < (?, ?) '
+     'ORDER BY play_count DESC, id DESC LIMIT 25',
+     ('video', 1 << 62, 0)),
+    ('cleanup batch',
+     'SELECT id, filename, blob_digest, upload_date FROM media WHERE upload_date < ? '
+     'AND (upload_date, id) > (?, ?) ORDER BY upload_date, id LIMIT 200',
+     ('2000-01-01', '1990-01-01', 0)),
+    ('cached playlist page',
+     'SELECT item FROM playlist_items WHERE version = ? AND position >= ? ORDER BY position LIMIT 501',
+     (0, 0)),
+    ('next transcode job',
+     "SELECT j.id FROM transcode_jobs j JOIN media m ON m.id = j.media_id WHERE j.status = 'queued' "
+     "ORDER BY j.priority DESC, j.id LIMIT 1",
+     ()),
+]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Apply every pending migration. Returns the list of versions applied."""
+    applied = []
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, description, apply in MIGRATIONS:
+            if current_version(conn) >= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Another process may have applied it while we waited for the lock
+                if current_version(conn) >= version:
+                    conn.execute('ROLLBACK')
+                    continue
+                apply(conn)
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            applied.append(version)
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
+
+
+def explain_hot_queries(conn):
+    """EXPLAIN QUERY PLAN for each hot statement, as {name: [plan lines]}"""
+    plans = {}
+    for name, sql, params in HOT_QUERIES:
+        rows = conn.execute(f'EXPLAIN QUERY PLAN {sql}', params).fetchall()
+        plans[name] = [row[-1] for row in rows]
+    return plans
+
+
+if __name__ == '__main__':
+    conn = db.connect()
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'media'").fetchone():
+            print('Database not initialized. Run: python -c "from app import init_db; init_db()"')
+            sys.exit(1)
+
+        if '--explain' in sys.argv:
+            for name, plan in explain_hot_queries(conn).items():
+                print(f"{name}:")
+                for line in plan:
+                    print(f"  {line}")
+        else:
+            applied = migrate(conn)
+            print(f"Applied migrations: {applied or 'none'}")
+            print(f"Schema version: {current_version(conn)}")
+    finally:
+        conn.close()
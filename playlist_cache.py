@@ -0,0 +1,158 @@
+"""
+Persistent cache of parsed remote playlists.
+
+The playlist page loads the same saved sources again and again. Each URL's
+parsed items are kept in SQLite together with the upstream ETag and
+Last-Modified, and the next load sends a conditional GET: a 304 is served
+straight from the stored items, which are already JSON, so nothing is
+downloaded or parsed again. A 200 is parsed as usual while CacheWriter
+stores it under a new version, which replaces the old one only once the
+whole list has been read.
+
+Responses carrying neither validator (or Cache-Control: no-store) are not
+cached, since there would be no cheap way to tell that they changed.
+"""
+
+import os
+import json
+import time
+from playlist_parser import encode_cursor
+
+# Most recently validated URLs kept; older entries are evicted
+MAX_ENTRIES = int(os.environ.get('PLAYLIST_CACHE_ENTRIES', 50))
+WRITE_BATCH = 1000
+# Versions nobody points at after this long were left by a crashed writer
+ORPHAN_AFTER = 3600
+
+
+def lookup(conn, url):
+    return conn.execute('SELECT * FROM playlist_cache WHERE url = ?', (url,)).fetchone()
+
+
+def conditional_headers(entry):
+    """If-None-Match / If-Modified-Since headers to revalidate `entry`"""
+    headers = {}
+    if entry is None:
+        return headers
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def is_cacheable(headers):
+    if 'no-store' in headers.get('Cache-Control', '').lower():
+        return False
+    return bool(headers.get('ETag') or headers.get('Last-Modified'))
+
+
+def touch(conn, entry):
+    """Record a successful revalidation, which keeps the entry from eviction"""
+    conn.execute('UPDATE playlist_cache SET validated_at = ? WHERE url = ?', (time.time(), entry['url']))
+    conn.commit()
+
+
+def page(conn, entry, position, limit):
+    """One page of cached items as JSON strings. Returns (items, next_cursor)."""
+    rows = conn.execute('''SELECT item FROM playlist_items WHERE version = ? AND position >= ?
+                           ORDER BY position LIMIT ?''', (entry['version'], position, limit + 1)).fetchall()
+    items = [row[0] for row in rows[:limit]]
+    next_cursor = encode_cursor(position + limit) if len(rows) > limit else None
+    return items, next_cursor
+
+
+def page_json(items, next_cursor):
+    """The /parse_playlist page body, assembled from already-encoded items"""
+    return '{"success": true, "items": [%s], "next_cursor": %s}' % (','.join(items), json.dumps(next_cursor))
+
+
+def iter_items(conn, entry):
+    """Every cached item as a JSON string, read in batches by position"""
+    position = 0
+    while True:
+        rows = conn.execute('''SELECT position, item FROM playlist_items WHERE version = ? AND position >= ?
+                               ORDER BY position LIMIT ?''', (entry['version'], position, WRITE_BATCH)).fetchall()
+        for row in rows:
+            yield row[1]
+        if len(rows) < WRITE_BATCH:
+            return
+        position = rows[-1][0] + 1
+
+
+class CacheWriter:
+    """Stores a playlist's items as they are parsed, then swaps them in.
+
+    add() takes each item already encoded as JSON, so the encoding done
+    for the response is reused. Items are written in batches, each in its
+    own short transaction, so a long download never holds the write lock.
+    """
+
+    def __init__(self, conn, url, headers):
+        self.conn = conn
+        self.url = url
+        self.etag = headers.get('ETag')
+        self.last_modified = headers.get('Last-Modified')
+        self.version = time.time_ns()
+        self.count = 0
+        self._pending = []
+
+    def add(self, item_json):
+        self._pending.append((self.version, self.count, item_json))
+        self.count += 1
+        if len(self._pending) >= WRITE_BATCH:
+            self.flush()
+
+    def extend(self, items_json):
+        for item_json in items_json:
+            self.add(item_json)
+
+    def flush(self):
+        if self._pending:
+            self.conn.executemany('INSERT INTO playlist_items (version, position, item) VALUES (?, ?, ?)',
+                                  self._pending)
+            self.conn.commit()
+            self._pending = []
+
+    def commit(self):
+        """Make the stored items the cached copy of the URL"""
+        self.flush()
+        now = time.time()
+        old = lookup(self.conn, self.url)
+        self.conn.execute('''INSERT OR REPLACE INTO playlist_cache
+                             (url, version, etag, last_modified, item_count, fetched_at, validated_at)
+                             VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                          (self.url, self.version, self.etag, self.last_modified, self.count, now, now))
+        if old is not None and old['version'] != self.version:
+            self.conn.execute('DELETE FROM playlist_items WHERE version = ?', (old['version'],))
+        self.conn.commit()
+        prune(self.conn)
+
+    def abort(self):
+        self._pending = []
+        self.conn.execute('DELETE FROM playlist_items WHERE version = ?', (self.version,))
+        self.conn.commit()
+
+
+def prune(conn, max_entries=MAX_ENTRIES):
+    """Evict all but the `max_entries` most recently validated playlists.
+    Returns the number of entries evicted."""
+    evicted = conn.execute('''SELECT url, version FROM playlist_cache ORDER BY validated_at DESC
+                              LIMIT -1 OFFSET ?''', (max_entries,)).fetchall()
+    for row in evicted:
+        conn.execute('DELETE FROM playlist_cache WHERE url = ? AND version = ?', (row['url'], row['version']))
+        conn.execute('DELETE FROM playlist_items WHERE version = ?', (row['version'],))
+    conn.commit()
+    return len(evicted)
+
+
+def remove_orphans(conn):
+    """Drop items left behind by writers that died before commit() or
+    abort(). Versions are creation timestamps, so an unreferenced version
+    older than ORPHAN_AFTER cannot belong to a running writer.
+    Returns the number of items removed."""
+    cutoff = time.time_ns() - ORPHAN_AFTER * 10**9
+    cursor = conn.execute('''DELETE FROM playlist_items WHERE version < ?
+                             AND version NOT IN (SELECT version FROM playlist_cache)''', (cutoff,))
+    conn.commit()
+    return cursor.rowcount
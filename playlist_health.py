@@ -0,0 +1,249 @@
+"""
+Bulk health checks for playlist items.
+
+check() probes every item URI of a playlist concurrently: a thread pool
+bounds the total number of requests in flight and a semaphore per host
+keeps a single origin from being hit by all of them at once. Work is
+interleaved across hosts so threads waiting on a busy origin do not hold
+up the rest of the list.
+
+Plain media URIs get a HEAD, falling back to a one-kilobyte Range GET for
+servers that refuse HEAD. HLS URIs are fetched (playlists are small) and,
+for a master playlist, the first variant is fetched too, since a master
+that loads but points at dead variants is the usual way IPTV entries
+break. Results are stored in the database and reused for RESULT_TTL
+seconds, so re-checking a list only probes what has expired.
+
+A check runs inside the request, so it stops after TIME_BUDGET seconds,
+well inside the server's worker timeout: URIs not probed by then are
+reported as 'unchecked' and not stored, and checking the list again picks
+up where it stopped.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urljoin, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CONCURRENCY = int(os.environ.get('PLAYLIST_CHECK_CONCURRENCY', 64))
+PER_HOST = int(os.environ.get('PLAYLIST_CHECK_PER_HOST', 16))
+RESULT_TTL = int(os.environ.get('PLAYLIST_CHECK_TTL', 300))
+TIME_BUDGET = float(os.environ.get('PLAYLIST_CHECK_BUDGET', 60))
+CONNECT_TIMEOUT = 3
+READ_TIMEOUT = 5
+MAX_URIS = 5000
+MAX_PLAYLIST_BYTES = 256 * 1024
+RANGE_PROBE = 'bytes=0-1023'
+# Status codes that mean "this URI is gone", not "this server dislikes HEAD"
+GONE_STATUSES = (404, 410)
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_host_limits = {}
+_host_limits_lock = threading.Lock()
+
+
+def _get_session():
+    # Separate from upstream's session: a health check must fail fast, so
+    # it never retries, and its pool is sized for PER_HOST connections
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                adapter = HTTPAdapter(pool_connections=CONCURRENCY, pool_maxsize=PER_HOST, max_retries=0)
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+                _session_pid = pid
+    return _session
+
+
+def _host_limit(host):
+    with _host_limits_lock:
+        limit = _host_limits.get(host)
+        if limit is None:
+            limit = _host_limits[host] = threading.BoundedSemaphore(PER_HOST)
+        return limit
+
+
+def is_hls(uri):
+    return urlparse(uri).path.lower().endswith(('.m3u8', '.m3u'))
+
+
+def _read_text(response):
+    body = b''
+    for chunk in response.iter_content(16 * 1024):
+        body += chunk
+        if len(body) >= MAX_PLAYLIST_BYTES:
+            break
+    return body.decode('utf-8', 'replace').lstrip('\ufeff')
+
+
+def _first_variant(text, base_url):
+    expect_uri = False
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF'):
+            expect_uri = True
+        elif expect_uri and line and not line.startswith('#'):
+            return urljoin(base_url, line)
+    return None
+
+
+def _result(status, response=None, **extra):
+    result = {
+        'status': status,
+        'http_status': response.status_code if response is not None else None,
+        'latency_ms': int(response.elapsed.total_seconds() * 1000) if response is not None else None,
+        'content_type': response.headers.get('Content-Type') if response is not None else None,
+        'variant_ok': None,
+        'error': None,
+    }
+    result.update(extra)
+    return result
+
+
+def _check_hls(session, uri, headers):
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    with session.get(uri, headers=headers, timeout=timeout, stream=True) as response:
+        if response.status_code >= 400:
+            return _result('dead', response)
+        text = _read_text(response)
+    if not text.startswith('#EXTM3U'):
+        return _result('broken', response, variant_ok=False, error='Not an HLS playlist')
+
+    variant = _first_variant(text, response.url)
+    if variant is None:
+        # A media playlist: it is its own variant
+        return _result('ok', response, variant_ok=True)
+
+    with session.get(variant, headers=headers, timeout=timeout, stream=True) as variant_response:
+        variant_ok = variant_response.status_code < 400 and _read_text(variant_response).startswith('#EXTM3U')
+    if not variant_ok:
+        return _result('broken', response, variant_ok=False, error=f'Variant failed: {variant}')
+    return _result('ok', response, variant_ok=True)
+
+
+def _check_media(session, uri, headers):
+    timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    response = session.head(uri, headers=headers, timeout=timeout, allow_redirects=True)
+    if response.status_code >= 400 and response.status_code not in GONE_STATUSES:
+        # Many streaming servers reject HEAD; ask for the first kilobyte instead
+        with session.get(uri, headers=dict(headers, Range=RANGE_PROBE), timeout=timeout, stream=True) as response:
+            pass
+    return _result('dead' if response.status_code >= 400 else 'ok', response)
+
+
+def _unchecked():
+    return _result('unchecked', error='Not checked within the time budget')
+
+
+def check_uri(uri, headers=None, deadline=None):
+    """Probe one URI, unless its host has no free slot before `deadline`
+    (a time.monotonic() value). Never raises; failures are reported in the
+    result."""
+    if urlparse(uri).scheme not in ('http', 'https'):
+        return _result('unsupported', error='Only http(s) URIs can be checked')
+
+    limit = _host_limit(urlparse(uri).netloc.lower())
+    if not limit.acquire(timeout=None if deadline is None else max(deadline - time.monotonic(), 0)):
+        return _unchecked()
+    started = time.monotonic()
+    try:
+        session = _get_session()
+        if is_hls(uri):
+            return _check_hls(session, uri, headers or {})
+        return _check_media(session, uri, headers or {})
+    except requests.exceptions.Timeout:
+        return _result('timeout', latency_ms=int((time.monotonic() - started) * 1000), error='Timed out')
+    except requests.exceptions.RequestException as e:
+        return _result('error', error=str(e)[:200])
+    finally:
+        limit.release()
+
+
+def _interleave_by_host(uris):
+    """Round-robin the URIs across hosts"""
+    by_host = OrderedDict()
+    for uri in uris:
+        by_host.setdefault(urlparse(uri).netloc.lower(), []).append(uri)
+    queues = list(by_host.values())
+    ordered = []
+    for i in range(max((len(q) for q in queues), default=0)):
+        ordered.extend(q[i] for q in queues if i < len(q))
+    return ordered
+
+
+def cached_results(conn, uris, ttl=RESULT_TTL):
+    """Stored results for `uris` that are younger than `ttl` seconds"""
+    cutoff = time.time() - ttl
+    results = {}
+    for i in range(0, len(uris), 500):
+        batch = uris[i:i + 500]
+        placeholders = ','.join('?' * len(batch))
+        rows = conn.execute(f'SELECT * FROM playlist_health WHERE uri IN ({placeholders}) AND checked_at >= ?',
+                            (*batch, cutoff)).fetchall()
+        for row in rows:
+            result = dict(row)
+            del result['uri'], result['checked_at']
+            if result['variant_ok'] is not None:
+                result['variant_ok'] = bool(result['variant_ok'])
+            results[row['uri']] = result
+    return results
+
+
+def store_results(conn, results):
+    now = time.time()
+    conn.executemany('''INSERT OR REPLACE INTO playlist_health
+                        (uri, status, http_status, latency_ms, content_type, variant_ok, error, checked_at)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                     [(uri, r['status'], r['http_status'], r['latency_ms'], r['content_type'],
+                       r['variant_ok'], r['error'], now) for uri, r in results.items()])
+    conn.commit()
+
+
+def check(conn, uris, headers=None, ttl=RESULT_TTL, budget=TIME_BUDGET):
+    """Check every URI, reusing stored results younger than `ttl`, for at
+    most `budget` seconds. Returns (results by URI, number of URIs actually
+    probed); URIs left when the budget runs out are 'unchecked'."""
+    uris = list(OrderedDict.fromkeys(uris))[:MAX_URIS]
+    results = cached_results(conn, uris, ttl)
+    pending = [uri for uri in uris if uri not in results]
+
+    fresh = {}
+    if pending:
+        deadline = time.monotonic() + budget
+
+        def probe(uri):
+            if time.monotonic() >= deadline:
+                return _unchecked()
+            return check_uri(uri, headers, deadline)
+
+        pool = ThreadPoolExecutor(max_workers=min(CONCURRENCY, len(pending)))
+        futures = {pool.submit(probe, uri): uri for uri in _interleave_by_host(pending)}
+        done, _ = wait(futures, timeout=budget)
+        # Probes still in flight finish on their own within their request
+        # timeouts; nothing waits for them
+        pool.shutdown(wait=False, cancel_futures=True)
+        for future in done:
+            result = future.result()
+            if result['status'] != 'unchecked':
+                fresh[futures[future]] = result
+        store_results(conn, fresh)
+        results.update(fresh)
+    return {uri: results.get(uri) or _unchecked() for uri in uris}, len(fresh)
+
+
+def prune(conn, ttl=RESULT_TTL):
+    """Delete expired results. Returns the number removed."""
+    cursor = conn.execute('DELETE FROM playlist_health WHERE checked_at < ?', (time.time() - ttl,))
+    conn.commit()
+    return cursor.rowcount
@@ -0,0 +1,151 @@
+"""
+Incremental M3U/M3U8 playlist parsing.
+
+PlaylistParser is a push parser: feed it one line at a time and it hands
+back an item whenever a URI line completes one. Nothing but the pending
+#EXTINF is buffered, so the parser runs straight off a streamed upstream
+response (requests' iter_lines or httpx's aiter_lines), time to first item
+is a single line, and memory does not grow with the playlist.
+
+#EXTINF attributes used by IPTV lists (tvg-id, tvg-name, tvg-logo,
+group-title, ...) are kept on each item, as is #EXTGRP.
+"""
+
+import re
+import base64
+import binascii
+from urllib.parse import urljoin
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 5000
+# Upstream read size: small enough that the first items show up at once,
+# large enough that a 100k-entry list is not read 512 bytes at a time
+READ_SIZE = 16 * 1024
+
+_ATTRIBUTE = re.compile(r'([A-Za-z0-9_-]+)="([^"]*)"')
+_EXTINF_HEAD = re.compile(r'((?:[^",]|"[^"]*")*),(.*)', re.DOTALL)
+_ABSOLUTE_URI = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*:')
+
+
+def split_extinf(value):
+    """Split the text after '#EXTINF:' into (duration, attributes, title)"""
+    # The title starts after the first comma that is not inside quotes
+    match = _EXTINF_HEAD.match(value)
+    head, title = match.groups() if match else (value, '')
+
+    try:
+        duration = float(head.split(None, 1)[0])
+    except (ValueError, IndexError):
+        duration = -1
+    attributes = {key.lower(): val for key, val in _ATTRIBUTE.findall(head)}
+    return duration, attributes, title.strip()
+
+
+class PlaylistParser:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        # Directory of the playlist, for the usual "segment.ts" relative entries
+        self._base_dir = urljoin(base_url, '.')
+        self.count = 0
+        self.extended = False
+        self._title = None
+        self._duration = 0
+        self._attributes = {}
+        self._group = None
+        self._first = True
+
+    def _resolve(self, uri):
+        # urljoin dominates parse time on large lists, so the two common
+        # shapes - absolute URLs and plain names next to the playlist - skip it
+        if _ABSOLUTE_URI.match(uri):
+            return uri
+        if not uri.startswith(('/', '.', '?', '#')) and '/.' not in uri:
+            return self._base_dir + uri
+        return urljoin(self.base_url, uri)
+
+    def feed(self, line):
+        """Consume one line; returns a finished item dict or None"""
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        if self._first:
+            line = line.lstrip('\ufeff')
+            self._first = False
+        line = line.strip()
+        if not line:
+            return None
+
+        if line.startswith('#'):
+            if line.startswith('#EXTM3U'):
+                self.extended = True
+            elif line.startswith('#EXTINF:'):
+                self._duration, self._attributes, title = split_extinf(line[8:])
+                self._title = title or 'Untitled'
+            elif line.startswith('#EXTGRP:'):
+                self._group = line[8:].strip()
+            elif line.startswith('#EXT-X-STREAM-INF:'):
+                self._title = 'Stream'
+            return None
+
+        self.count += 1
+        item = {
+            'uri': self._resolve(line),
+            'title': self._title or ('Untitled' if self.extended else f'Item {self.count}'),
+            'duration': self._duration if self._duration > 0 else None,
+        }
+        if self._attributes:
+            item['attributes'] = self._attributes
+        group = self._attributes.get('group-title') or self._group
+        if group:
+            item['group'] = group
+
+        self._title = None
+        self._duration = 0
+        self._attributes = {}
+        self._group = None
+        return item
+
+
+def iter_items(lines, base_url):
+    """Yield playlist items from an iterable of lines as they are parsed"""
+    parser = PlaylistParser(base_url)
+    for line in lines:
+        item = parser.feed(line)
+        if item is not None:
+            yield item
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(str(position).encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Item position a page cursor points at; 0 for no cursor"""
+    if not cursor:
+        return 0
+    try:
+        position = int(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        raise ValueError('Invalid cursor')
+    if position < 0:
+        raise ValueError('Invalid cursor')
+    return position
+
+
+def page_size(value):
+    try:
+        return max(1, min(int(value), MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+
+
+def take_page(items, position, limit):
+    """Collect one page from an item iterator, reading at most one item
+    past it. Returns (page, next_cursor)."""
+    page = []
+    for index, item in enumerate(items):
+        if index < position:
+            continue
+        if len(page) == limit:
+            return page, encode_cursor(position + limit)
+        page.append(item)
+    return page, None
@@ -0,0 +1,355 @@
+"""
+Poster, thumbnail, seek-preview sprite and waveform generation.
+
+For each video, PreviewQueue writes, in the background after upload:
+
+    poster.jpg      a frame from a tenth of the way in, POSTER_WIDTH wide
+    thumb.jpg       the same frame at THUMB_WIDTH, for library cards
+    sprite.jpg      up to SPRITE_MAX_FRAMES evenly spaced tiles
+    thumbnails.vtt  WebVTT cues mapping time ranges to sprite#xywh= tiles
+
+and for audio, peaks.json (min/max pairs in the audiowaveform JSON format
+that waveform players read) plus a thumb.png drawn from them. Frames are
+decoded by ffmpeg, only at keyframes for the sprite, and every image is
+resized and encoded with Pillow. Without ffmpeg, WAV files still get
+waveforms (read with the wave module) and videos get none.
+
+Files live under PREVIEW_DIR/<media_id>/<key>/, where the key is new each
+time previews are generated, so their URLs never change content and are
+served with immutable caching. The library and player only ever load
+these small files, never the media itself.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import wave
+import queue
+import shutil
+import sqlite3
+import threading
+import subprocess
+from array import array
+
+from PIL import Image, ImageDraw
+
+import hls_packager
+import transcode
+
+PREVIEW_DIR = os.environ.get('PREVIEW_DIR', 'previews')
+POSTER_WIDTH = 640
+THUMB_WIDTH = 320
+SPRITE_TILE = (160, 90)
+SPRITE_COLUMNS = 10
+SPRITE_MAX_FRAMES = 100
+SPRITE_MIN_INTERVAL = 2
+JPEG_QUALITY = 80
+PEAKS = 1000
+PEAK_SAMPLE_RATE = 8000
+WAVEFORM_SIZE = (320, 90)
+WAVEFORM_COLOR = (13, 110, 253)
+FFMPEG_TIMEOUT = 600
+# A row still 'generating' this long after its claim belongs to a dead worker
+STALE_AFTER = 3600
+# How often an idle worker sweeps for media without previews
+SWEEP_INTERVAL = 300
+PREVIEW_TYPES = ('video', 'audio')
+FILES = ('poster.jpg', 'thumb.jpg', 'sprite.jpg', 'thumbnails.vtt', 'peaks.json', 'thumb.png')
+
+
+class PreviewError(Exception):
+    pass
+
+
+def _ffmpeg(args, timeout=FFMPEG_TIMEOUT):
+    result = subprocess.run([hls_packager.FFMPEG, '-nostdin', '-loglevel', 'error'] + args,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    if result.returncode != 0:
+        message = result.stderr.decode('utf-8', 'replace').strip().splitlines()
+        raise PreviewError(message[-1] if message else f'ffmpeg exited with {result.returncode}')
+    return result.stdout
+
+
+def _save_jpeg(image, path):
+    image.convert('RGB').save(path, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+
+
+def _resized(image, width):
+    if image.width <= width:
+        return image
+    return image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+
+
+def _poster(source, duration, out_dir):
+    at = duration / 10 if duration else 0
+    frame = _ffmpeg(['-ss', f'{at:.3f}', '-i', source, '-frames:v', '1', '-f', 'image2pipe', '-vcodec', 'png', '-'])
+    if not frame:
+        raise PreviewError('No frame decoded')
+    with Image.open(io.BytesIO(frame)) as image:
+        image.load()
+        _save_jpeg(_resized(image, POSTER_WIDTH), os.path.join(out_dir, 'poster.jpg'))
+        _save_jpeg(_resized(image, THUMB_WIDTH), os.path.join(out_dir, 'thumb.jpg'))
+
+
+def _timestamp(seconds):
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f'{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}'
+
+
+def _sprite(source, duration, out_dir):
+    interval = max(SPRITE_MIN_INTERVAL, duration / SPRITE_MAX_FRAMES)
+    width, height = SPRITE_TILE
+    # Keyframes only: a sprite tile does not need the exact frame, and
+    # skipping the rest makes this a fraction of a full decode
+    raw = _ffmpeg(['-skip_frame', 'nokey', '-i', source, '-an', '-sn',
+                   '-vf', f'fps=1/{interval:.3f},scale={width}:{height}:force_original_aspect_ratio=decrease,'
+                          f'pad={width}:{height}:(ow-iw)/2:(oh-ih)/2',
+                   '-frames:v', str(SPRITE_MAX_FRAMES), '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'])
+    frame_size = width * height * 3
+    count = len(raw) // frame_size
+    if not count:
+        raise PreviewError('No frames decoded')
+
+    columns = min(count, SPRITE_COLUMNS)
+    rows = -(-count // columns)
+    sheet = Image.new('RGB', (columns * width, rows * height))
+    cues = ['WEBVTT', '']
+    for i in range(count):
+        x, y = (i % columns) * width, (i // columns) * height
+        sheet.paste(Image.frombytes('RGB', SPRITE_TILE, raw[i * frame_size:(i + 1) * frame_size]), (x, y))
+        start = i * interval
+        end = duration if i == count - 1 else (i + 1) * interval
+        cues += [f'{_timestamp(start)} --> {_timestamp(max(end, start + 0.001))}',
+                 f'sprite.jpg#xywh={x},{y},{width},{height}', '']
+    _save_jpeg(sheet, os.path.join(out_dir, 'sprite.jpg'))
+    with open(os.path.join(out_dir, 'thumbnails.vtt'), 'w') as f:
+        f.write('\n'.join(cues))
+
+
+def _wav_samples(source):
+    """Mono 16-bit samples and sample rate of a PCM WAV file, without ffmpeg"""
+    try:
+        with wave.open(source, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise PreviewError('Only 16-bit WAV can be read without ffmpeg')
+            channels = wav.getnchannels()
+            frames = wav.readframes(wav.getnframes())
+            rate = wav.getframerate()
+    except (wave.Error, EOFError) as e:
+        raise PreviewError(str(e))
+    # A truncated file can end mid-sample
+    samples = array('h')
+    samples.frombytes(frames[:len(frames) - len(frames) % 2])
+    if sys.byteorder == 'big':
+        # WAV PCM is little-endian
+        samples.byteswap()
+    if channels > 1:
+        # The first channel is enough for a peak overview
+        samples = samples[::channels]
+    return samples, rate
+
+
+def _samples(source):
+    if hls_packager.available():
+        pcm = _ffmpeg(['-i', source, '-vn', '-ac', '1', '-ar', str(PEAK_SAMPLE_RATE), '-f', 's16le', '-'])
+        samples = array('h')
+        samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        return samples, PEAK_SAMPLE_RATE
+    return _wav_samples(source)
+
+
+def peaks(samples, rate, count=PEAKS):
+    """audiowaveform-style JSON dict of `count` min/max pairs (8-bit)"""
+    per_peak = max(1, -(-len(samples) // count))
+    data = []
+    for start in range(0, len(samples), per_peak):
+        window = samples[start:start + per_peak]
+        data += [min(window) >> 8, max(window) >> 8]
+    return {'version': 2, 'channels': 1, 'sample_rate': rate, 'samples_per_pixel': per_peak,
+            'bits': 8, 'length': len(data) // 2, 'data': data}
+
+
+def _waveform(source, out_dir):
+    samples, rate = _samples(source)
+    if not samples:
+        raise PreviewError('No audio decoded')
+    waveform = peaks(samples, rate)
+    with open(os.path.join(out_dir, 'peaks.json'), 'w') as f:
+        json.dump(waveform, f, separators=(',', ':'))
+
+    width, height = WAVEFORM_SIZE
+    image = Image.new('RGBA', WAVEFORM_SIZE, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    data = waveform['data']
+    pairs = len(data) // 2
+    middle = height / 2
+    for x in range(width):
+        i = x * pairs // width * 2
+        low, high = data[i], data[i + 1]
+        draw.line([(x, middle - high * middle / 128), (x, middle - low * middle / 128)], fill=WAVEFORM_COLOR)
+    image.save(os.path.join(out_dir, 'thumb.png'), 'PNG', optimize=True)
+
+
+def generate(source, file_type, media_id):
+    """Write the previews for one item into a new key directory. Returns
+    the key; older keys of the item are removed."""
+    key = uuid.uuid4().hex[:12]
+    tmp_dir = os.path.join(PREVIEW_DIR, str(int(media_id)), f'{key}.tmp')
+    os.makedirs(tmp_dir)
+    try:
+        if file_type == 'video':
+            if not hls_packager.available():
+                raise PreviewError('Video previews need ffmpeg')
+            has_video, _, _, duration = transcode.inspect(source)
+            if not has_video:
+                raise PreviewError('No video stream')
+            _poster(source, duration, tmp_dir)
+            if duration:
+                _sprite(source, duration, tmp_dir)
+        else:
+            _waveform(source, tmp_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    media_dir = os.path.dirname(tmp_dir)
+    os.replace(tmp_dir, os.path.join(media_dir, key))
+    for entry in os.listdir(media_dir):
+        if entry != key:
+            shutil.rmtree(os.path.join(media_dir, entry), ignore_errors=True)
+    return key
+
+
+def preview_file(media_id, key, name):
+    """Path of a generated preview file, or None"""
+    if name not in FILES or not key.isalnum():
+        return None
+    path = os.path.join(PREVIEW_DIR, str(int(media_id)), key, name)
+    return path if os.path.isfile(path) else None
+
+
+def urls(media_id, key, file_type):
+    """Preview URLs for an item whose previews were generated under `key`"""
+    if not key:
+        return {}
+    base = f'/previews/{media_id}/{key}/'
+    if file_type == 'video':
+        return {'poster': base + 'poster.jpg', 'thumbnail': base + 'thumb.jpg',
+                'thumbnails_vtt': base + 'thumbnails.vtt'}
+    return {'thumbnail': base + 'thumb.png', 'peaks': base + 'peaks.json'}
+
+
+def remove(media_ids):
+    for media_id in media_ids:
+        shutil.rmtree(os.path.join(PREVIEW_DIR, str(int(media_id))), ignore_errors=True)
+
+
+class PreviewQueue:
+    """Generate previews in the background, one worker thread per process.
+
+    Rows with a NULL preview_status have not been handled yet; each is
+    claimed with a conditional UPDATE, as ProbeQueue does."""
+
+    def __init__(self, connect, media_folder):
+        self.connect = connect
+        self.media_folder = media_folder
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker_pid = None
+        self._stats = {'done': 0, 'unsupported': 0, 'failed': 0}
+
+    def start(self):
+        """Start this process's worker, which sweeps up media without previews"""
+        self._ensure_worker()
+
+    def enqueue(self, media_id):
+        self._ensure_worker()
+        self._queue.put(media_id)
+
+    def _ensure_worker(self):
+        pid = os.getpid()
+        if self._worker_pid == pid:
+            return
+        with self._lock:
+            if self._worker_pid == pid:
+                return
+            self._worker_pid = pid
+            self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self._sweep()
+            except sqlite3.Error:
+                pass
+            while True:
+                try:
+                    media_id = self._queue.get(timeout=SWEEP_INTERVAL)
+                except queue.Empty:
+                    break
+                self.generate(media_id)
+
+    def _sweep(self):
+        # Media from before previews existed, and items whose worker died
+        # mid-generation
+        conn = self.connect()
+        try:
+            conn.execute('''UPDATE media SET preview_status = NULL
+                            WHERE preview_status = 'generating' AND COALESCE(preview_claimed_at, 0) < ?''',
+                         (time.time() - STALE_AFTER,))
+            conn.commit()
+            ids = [row[0] for row in conn.execute(
+                "SELECT id FROM media WHERE preview_status IS NULL AND file_type IN ('video', 'audio')")]
+        finally:
+            conn.close()
+        for media_id in ids:
+            self._queue.put(media_id)
+
+    def generate(self, media_id):
+        conn = self.connect()
+        try:
+            claimed = conn.execute(
+                '''UPDATE media SET preview_status = 'generating', preview_claimed_at = ?
+                   WHERE id = ? AND preview_status IS NULL''',
+                (time.time(), media_id)).rowcount
+            conn.commit()
+            if not claimed:
+                return
+
+            key = None
+            try:
+                row = conn.execute('SELECT filename, file_type FROM media WHERE id = ?', (media_id,)).fetchone()
+                key = generate(os.path.join(self.media_folder, row['filename']), row['file_type'], media_id)
+                status = 'done'
+            except PreviewError:
+                status = 'unsupported'
+            except Exception:
+                # ffmpeg timeouts, OSError, or a decoder bug on an odd file:
+                # one bad item must neither stop the worker nor stay 'generating'
+                status = 'failed'
+            updated = conn.execute('UPDATE media SET preview_status = ?, preview_key = ? WHERE id = ?',
+                                   (status, key, media_id)).rowcount
+            conn.commit()
+            if not updated:
+                # Deleted while we worked
+                remove([media_id])
+            with self._lock:
+                self._stats[status] += 1
+        except sqlite3.Error:
+            # Left 'generating'; a later sweep finds it stale and retries
+            pass
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['pending'] = self._queue.qsize()
+        return snapshot
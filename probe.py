@@ -0,0 +1,660 @@
+"""
+Pure-Python media probing.
+
+Reads just enough of a file's container structure to report duration,
+codecs, resolution and bitrate: the MP4 moov box (wherever it sits in the
+file), the Matroska/WebM Info and Tracks elements, the first MP3 frame
+and its Xing/VBRI header, FLAC STREAMINFO, Ogg header pages plus the last
+page's granule position, and WAV fmt/data chunks. Nothing is decoded and
+media data is skipped with seeks, so a probe costs a few small reads
+however large the file is.
+
+ProbeQueue runs probes on a background thread per worker so uploads
+return without waiting for them.
+"""
+
+import os
+import time
+import queue
+import struct
+import sqlite3
+import threading
+
+# moov boxes are small next to the media they describe; refuse silly sizes
+MAX_MOOV_BYTES = 64 * 1024 * 1024
+MAX_HEADER_BYTES = 4 * 1024 * 1024
+TAIL_BYTES = 1024 * 1024
+# A row still 'probing' this long after its claim belongs to a dead worker
+STALE_AFTER = 600
+# How often an idle worker sweeps for unprobed and stale rows
+SWEEP_INTERVAL = 300
+
+
+class ProbeError(Exception):
+    pass
+
+
+def _result(container, **fields):
+    result = {'container': container, 'duration': None, 'video_codec': None, 'audio_codec': None,
+              'width': None, 'height': None, 'bitrate': None, 'mime_type': None}
+    result.update(fields)
+    return result
+
+
+def _read_at(f, offset, length):
+    f.seek(offset)
+    return f.read(length)
+
+
+# --- MP4 / QuickTime ---------------------------------------------------------
+
+
+def _iter_boxes(data, start=0, end=None):
+    end = len(data) if end is None else end
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, pos)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            return
+        yield box_type, pos + header, pos + size
+        pos += size
+
+
+def _find_moov(f, file_size):
+    pos = 0
+    while pos + 8 <= file_size:
+        header = _read_at(f, pos, 16)
+        if len(header) < 8:
+            break
+        size, box_type = struct.unpack_from('>I4s', header)
+        header_size = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', header, 8)[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header_size:
+            raise ProbeError('Corrupt MP4 box header')
+        if box_type == b'moov':
+            if size > MAX_MOOV_BYTES:
+                raise ProbeError('moov box too large')
+            return _read_at(f, pos + header_size, size - header_size)
+        pos += size
+    raise ProbeError('No moov box')
+
+
+def _parse_trak(data, start, end):
+    track = {}
+    for box_type, body, box_end in _iter_boxes(data, start, end):
+        if box_type == b'tkhd':
+            offset = body + (88 if data[body] == 1 else 76)
+            width, height = struct.unpack_from('>II', data, offset)
+            track['width'], track['height'] = width >> 16, height >> 16
+        elif box_type == b'mdia':
+            for sub_type, sub_body, sub_end in _iter_boxes(data, body, box_end):
+                if sub_type == b'mdhd':
+                    if data[sub_body] == 1:
+                        timescale, duration = struct.unpack_from('>IQ', data, sub_body + 20)
+                    else:
+                        timescale, duration = struct.unpack_from('>II', data, sub_body + 12)
+                    if timescale:
+                        track['duration'] = duration / timescale
+                elif sub_type == b'hdlr':
+                    track['handler'] = data[sub_body + 8:sub_body + 12]
+                elif sub_type == b'minf':
+                    track.update(_parse_minf(data, sub_body, sub_end))
+    return track
+
+
+def _parse_minf(data, start, end):
+    for box_type, body, box_end in _iter_boxes(data, start, end):
+        if box_type == b'stbl':
+            for sub_type, sub_body, _ in _iter_boxes(data, body, box_end):
+                if sub_type == b'stsd' and struct.unpack_from('>I', data, sub_body + 4)[0]:
+                    entry = sub_body + 8
+                    info = {'codec': data[entry + 4:entry + 8].decode('latin-1').strip()}
+                    if entry + 36 <= box_end:
+                        info['entry_width'], info['entry_height'] = struct.unpack_from('>HH', data, entry + 32)
+                    return info
+    return {}
+
+
+def probe_mp4(f, file_size):
+    moov = _find_moov(f, file_size)
+    result = _result('mp4')
+    for box_type, body, box_end in _iter_boxes(moov):
+        if box_type == b'mvhd':
+            if moov[body] == 1:
+                timescale, duration = struct.unpack_from('>IQ', moov, body + 20)
+            else:
+                timescale, duration = struct.unpack_from('>II', moov, body + 12)
+            if timescale:
+                result['duration'] = duration / timescale
+        elif box_type == b'trak':
+            track = _parse_trak(moov, body, box_end)
+            if track.get('handler') == b'vide' and not result['video_codec']:
+                result['video_codec'] = track.get('codec')
+                result['width'] = track.get('width') or track.get('entry_width')
+                result['height'] = track.get('height') or track.get('entry_height')
+            elif track.get('handler') == b'soun' and not result['audio_codec']:
+                result['audio_codec'] = track.get('codec')
+            if not result['duration'] and track.get('duration'):
+                result['duration'] = track['duration']
+    result['mime_type'] = 'video/mp4' if result['video_codec'] else 'audio/mp4'
+    return result
+
+
+# --- Matroska / WebM ---------------------------------------------------------
+
+EBML_HEADER = 0x1A45DFA3
+EBML_DOCTYPE = 0x4282
+MKV_SEGMENT = 0x18538067
+MKV_INFO = 0x1549A966
+MKV_TIMECODE_SCALE = 0x2AD7B1
+MKV_DURATION = 0x4489
+MKV_TRACKS = 0x1654AE6B
+MKV_TRACK_ENTRY = 0xAE
+MKV_TRACK_TYPE = 0x83
+MKV_CODEC_ID = 0x86
+MKV_VIDEO = 0xE0
+MKV_PIXEL_WIDTH = 0xB0
+MKV_PIXEL_HEIGHT = 0xBA
+MKV_CLUSTER = 0x1F43B675
+MKV_TIMECODE = 0xE7
+MKV_SIMPLE_BLOCK = 0xA3
+MKV_BLOCK_GROUP = 0xA0
+MKV_BLOCK = 0xA1
+
+_MKV_CODECS = {
+    'V_VP8': 'vp8', 'V_VP9': 'vp9', 'V_AV1': 'av1', 'V_MPEG4/ISO/AVC': 'avc1',
+    'V_MPEGH/ISO/HEVC': 'hvc1', 'V_THEORA': 'theora', 'A_OPUS': 'opus', 'A_VORBIS': 'vorbis',
+    'A_AAC': 'mp4a', 'A_MPEG/L3': 'mp3', 'A_FLAC': 'flac', 'A_AC3': 'ac-3', 'A_EAC3': 'ec-3',
+}
+
+
+def read_vint(data, pos, keep_marker=False):
+    """Decode an EBML variable-length integer. Returns (value, length);
+    value is None for the reserved 'unknown size' encoding."""
+    first = data[pos]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8 or pos + length > len(data):
+        raise ProbeError('Invalid EBML vint')
+    value = first if keep_marker else first & (mask - 1)
+    for byte in data[pos + 1:pos + length]:
+        value = (value << 8) | byte
+    if not keep_marker and value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def _read_element_header(data, pos):
+    element_id, id_length = read_vint(data, pos, keep_marker=True)
+    size, size_length = read_vint(data, pos + id_length)
+    return element_id, size, pos + id_length + size_length
+
+
+def iter_elements(data, start=0, end=None):
+    """Yield (id, body start, body end) for EBML children within data[start:end]"""
+    end = len(data) if end is None else end
+    pos = start
+    while pos < end:
+        element_id, size, body = _read_element_header(data, pos)
+        body_end = end if size is None else min(body + size, end)
+        yield element_id, body, body_end
+        pos = body_end
+
+
+def _uint(data, start, end):
+    return int.from_bytes(data[start:end], 'big')
+
+
+def _float(data, start, end):
+    return struct.unpack('>f' if end - start == 4 else '>d', data[start:end])[0]
+
+
+def _parse_info(data, start, end):
+    info = {'scale': 1000000}
+    for element_id, body, body_end in iter_elements(data, start, end):
+        if element_id == MKV_TIMECODE_SCALE:
+            info['scale'] = _uint(data, body, body_end)
+        elif element_id == MKV_DURATION:
+            info['duration'] = _float(data, body, body_end)
+    return info
+
+
+def _parse_tracks(data, start, end):
+    tracks = []
+    for element_id, body, body_end in iter_elements(data, start, end):
+        if element_id != MKV_TRACK_ENTRY:
+            continue
+        track = {}
+        for child_id, child, child_end in iter_elements(data, body, body_end):
+            if child_id == MKV_TRACK_TYPE:
+                track['type'] = _uint(data, child, child_end)
+            elif child_id == MKV_CODEC_ID:
+                codec = data[child:child_end].decode('ascii', 'replace').rstrip('\x00')
+                track['codec'] = _MKV_CODECS.get(codec, codec)
+            elif child_id == MKV_VIDEO:
+                for video_id, video, video_end in iter_elements(data, child, child_end):
+                    if video_id == MKV_PIXEL_WIDTH:
+                        track['width'] = _uint(data, video, video_end)
+                    elif video_id == MKV_PIXEL_HEIGHT:
+                        track['height'] = _uint(data, video, video_end)
+        tracks.append(track)
+    return tracks
+
+
+def _tail_timecode(f, file_size):
+    """Largest block timestamp in the last cluster, in TimecodeScale units.
+    MediaRecorder output has no Duration element, so this is how long a
+    browser recording actually is."""
+    start = max(0, file_size - TAIL_BYTES)
+    tail = _read_at(f, start, TAIL_BYTES)
+    cluster_id = MKV_CLUSTER.to_bytes(4, 'big')
+    pos = tail.rfind(cluster_id)
+    while pos >= 0:
+        try:
+            _, size, body = _read_element_header(tail, pos)
+            end = len(tail) if size is None else min(body + size, len(tail))
+            cluster_time = None
+            latest = 0
+            for element_id, child, child_end in iter_elements(tail, body, end):
+                if element_id == MKV_TIMECODE:
+                    cluster_time = _uint(tail, child, child_end)
+                elif element_id in (MKV_SIMPLE_BLOCK, MKV_BLOCK_GROUP):
+                    block = child
+                    if element_id == MKV_BLOCK_GROUP:
+                        block = next((b for i, b, _ in iter_elements(tail, child, child_end) if i == MKV_BLOCK), None)
+                        if block is None:
+                            continue
+                    _, track_length = read_vint(tail, block)
+                    latest = max(latest, struct.unpack_from('>h', tail, block + track_length)[0])
+            if cluster_time is not None:
+                return cluster_time + latest
+        except (ProbeError, IndexError, struct.error):
+            pass
+        # A false match inside block data; try the previous one
+        pos = tail.rfind(cluster_id, 0, pos)
+    return None
+
+
+def probe_matroska(f, file_size):
+    head = _read_at(f, 0, MAX_HEADER_BYTES)
+    doc_type = 'matroska'
+    info = tracks = None
+
+    for element_id, body, body_end in iter_elements(head):
+        if element_id == EBML_HEADER:
+            for child_id, child, child_end in iter_elements(head, body, body_end):
+                if child_id == EBML_DOCTYPE:
+                    doc_type = head[child:child_end].decode('ascii', 'replace').rstrip('\x00')
+        elif element_id == MKV_SEGMENT:
+            try:
+                for child_id, child, child_end in iter_elements(head, body, body_end):
+                    if child_id == MKV_INFO:
+                        info = _parse_info(head, child, child_end)
+                    elif child_id == MKV_TRACKS:
+                        tracks = _parse_tracks(head, child, child_end)
+                    elif child_id == MKV_CLUSTER or (info and tracks is not None):
+                        break
+            except (ProbeError, IndexError):
+                # Ran off the end of the header window
+                pass
+            break
+
+    if info is None or tracks is None:
+        raise ProbeError('Matroska Info/Tracks not found')
+
+    video = next((t for t in tracks if t.get('type') == 1), {})
+    audio = next((t for t in tracks if t.get('type') == 2), {})
+    scale = info['scale']
+    duration = info.get('duration')
+    if duration is None:
+        duration = _tail_timecode(f, file_size)
+
+    result = _result(
+        'webm' if doc_type == 'webm' else 'matroska',
+        duration=duration * scale / 1e9 if duration else None,
+        video_codec=video.get('codec'),
+        audio_codec=audio.get('codec'),
+        width=video.get('width'),
+        height=video.get('height'),
+    )
+    if doc_type == 'webm':
+        result['mime_type'] = 'video/webm' if video else 'audio/webm'
+    else:
+        result['mime_type'] = 'video/x-matroska' if video else 'audio/x-matroska'
+    return result
+
+
+# --- MP3 ---------------------------------------------------------------------
+
+_MP3_BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SAMPLE_RATES = {1: (44100, 48000, 32000), 2: (22050, 24000, 16000), 25: (11025, 12000, 8000)}
+
+
+def id3v2_size(header):
+    """Bytes taken by a leading ID3v2 tag, or 0"""
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    return 10 + size + (10 if header[5] & 0x10 else 0)
+
+
+def _mp3_frame_header(data, pos):
+    b1, b2, b3 = data[pos + 1], data[pos + 2], data[pos + 3]
+    version_bits = (b1 >> 3) & 3
+    layer_bits = (b1 >> 1) & 3
+    if version_bits == 1 or layer_bits == 0:
+        return None
+    version = {3: 1, 2: 2, 0: 25}[version_bits]
+    layer = 4 - layer_bits
+    bitrate_index = b2 >> 4
+    rate_index = (b2 >> 2) & 3
+    if bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = _MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version][rate_index]
+    mono = (b3 >> 6) == 3
+    samples = 384 if layer == 1 else 1152 if layer == 2 or version == 1 else 576
+    return {'version': version, 'layer': layer, 'bitrate': bitrate,
+            'sample_rate': sample_rate, 'mono': mono, 'samples': samples}
+
+
+def probe_mp3(f, file_size):
+    start = id3v2_size(_read_at(f, 0, 10))
+    data = _read_at(f, start, 64 * 1024)
+    frame = None
+    pos = 0
+    while pos + 4 <= len(data):
+        pos = data.find(b'\xff', pos)
+        if pos < 0 or pos + 4 > len(data):
+            break
+        if data[pos + 1] & 0xE0 == 0xE0:
+            frame = _mp3_frame_header(data, pos)
+            if frame:
+                break
+        pos += 1
+    if not frame:
+        raise ProbeError('No MPEG audio frame found')
+
+    audio_bytes = file_size - start - pos
+    if _read_at(f, file_size - 128, 3) == b'TAG':
+        audio_bytes -= 128
+
+    frames = None
+    if frame['layer'] == 3:
+        side_info = (17 if frame['mono'] else 32) if frame['version'] == 1 else (9 if frame['mono'] else 17)
+        xing = pos + 4 + side_info
+        if data[xing:xing + 4] in (b'Xing', b'Info'):
+            flags = struct.unpack_from('>I', data, xing + 4)[0]
+            if flags & 1:
+                frames = struct.unpack_from('>I', data, xing + 8)[0]
+        elif data[pos + 36:pos + 40] == b'VBRI':
+            frames = struct.unpack_from('>I', data, pos + 36 + 14)[0]
+
+    if frames:
+        duration = frames * frame['samples'] / frame['sample_rate']
+    else:
+        duration = audio_bytes * 8 / frame['bitrate']
+    codec = 'mp3' if frame['layer'] == 3 else f"mp{frame['layer']}"
+    return _result('mp3', duration=duration, audio_codec=codec, mime_type='audio/mpeg')
+
+
+# --- FLAC --------------------------------------------------------------------
+
+def probe_flac(f, file_size):
+    start = id3v2_size(_read_at(f, 0, 10))
+    header = _read_at(f, start, 42)
+    if header[:4] != b'fLaC' or header[4] & 0x7F != 0:
+        raise ProbeError('Missing FLAC STREAMINFO')
+    info = header[8:42]
+    packed = int.from_bytes(info[10:18], 'big')
+    sample_rate = packed >> 44
+    total_samples = packed & 0xFFFFFFFFF
+    duration = total_samples / sample_rate if sample_rate and total_samples else None
+    return _result('flac', duration=duration, audio_codec='flac', mime_type='audio/flac')
+
+
+# --- Ogg ---------------------------------------------------------------------
+
+def _iter_ogg_pages(data):
+    pos = data.find(b'OggS')
+    while 0 <= pos and pos + 27 <= len(data):
+        header_type = data[pos + 5]
+        granule, serial = struct.unpack_from('<qI', data, pos + 6)
+        segments = data[pos + 26]
+        table = data[pos + 27:pos + 27 + segments]
+        body = pos + 27 + segments
+        yield header_type, granule, serial, data[body:body + sum(table)]
+        pos = data.find(b'OggS', pos + 4)
+
+
+def probe_ogg(f, file_size):
+    head = _read_at(f, 0, 64 * 1024)
+    streams = {}
+    for header_type, _, serial, payload in _iter_ogg_pages(head):
+        if not header_type & 0x02:
+            break
+        if payload.startswith(b'\x01vorbis'):
+            streams[serial] = {'codec': 'vorbis', 'rate': struct.unpack_from('<I', payload, 12)[0], 'skip': 0}
+        elif payload.startswith(b'OpusHead'):
+            streams[serial] = {'codec': 'opus', 'rate': 48000, 'skip': struct.unpack_from('<H', payload, 10)[0]}
+        elif payload.startswith(b'\x80theora'):
+            width = int.from_bytes(payload[14:17], 'big')
+            height = int.from_bytes(payload[17:20], 'big')
+            streams[serial] = {'codec': 'theora', 'video': True, 'width': width, 'height': height}
+        elif payload.startswith(b'\x7fFLAC'):
+            streams[serial] = {'codec': 'flac', 'rate': int.from_bytes(payload[27:30], 'big') >> 4, 'skip': 0}
+    if not streams:
+        raise ProbeError('No known Ogg streams')
+
+    audio_serial, audio = next(((s, v) for s, v in streams.items() if not v.get('video')), (None, {}))
+    video = next((v for v in streams.values() if v.get('video')), {})
+
+    duration = None
+    if audio:
+        last_granule = None
+        tail = _read_at(f, max(0, file_size - 64 * 1024), 64 * 1024)
+        for _, granule, serial, _ in _iter_ogg_pages(tail):
+            if serial == audio_serial and granule >= 0:
+                last_granule = granule
+        if last_granule is not None and audio['rate']:
+            duration = max(0, last_granule - audio['skip']) / audio['rate']
+
+    return _result('ogg', duration=duration, video_codec=video.get('codec'), audio_codec=audio.get('codec'),
+                   width=video.get('width'), height=video.get('height'),
+                   mime_type='video/ogg' if video else 'audio/ogg')
+
+
+# --- WAV ---------------------------------------------------------------------
+
+def probe_wav(f, file_size):
+    header = _read_at(f, 0, 12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        raise ProbeError('Not a WAVE file')
+    pos = 12
+    fmt = None
+    while pos + 8 <= file_size:
+        chunk_id, size = struct.unpack('<4sI', _read_at(f, pos, 8))
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack('<HHII', _read_at(f, pos + 8, 12))
+        elif chunk_id == b'data' and fmt:
+            audio_format, _, _, byte_rate = fmt
+            codec = {1: 'pcm', 3: 'pcm_float'}.get(audio_format, f'wav_{audio_format:#06x}')
+            size = min(size, file_size - pos - 8)
+            return _result('wav', duration=size / byte_rate if byte_rate else None,
+                           audio_codec=codec, mime_type='audio/wav')
+        pos += 8 + size + (size & 1)
+    raise ProbeError('WAVE data chunk not found')
+
+
+# -----------------------------------------------------------------------------
+
+def _sniff(f, head):
+    offset = id3v2_size(head)
+    if offset:
+        # ID3 tags are mostly found on MP3, but FLAC files can carry one too
+        return probe_flac if _read_at(f, offset, 4) == b'fLaC' else probe_mp3
+    if head[4:8] in (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide'):
+        return probe_mp4
+    if head[:4] == b'\x1a\x45\xdf\xa3':
+        return probe_matroska
+    if head[:4] == b'OggS':
+        return probe_ogg
+    if head[:4] == b'RIFF' and head[8:12] == b'WAVE':
+        return probe_wav
+    if head[:4] == b'fLaC':
+        return probe_flac
+    if head[0] == 0xFF and head[1] & 0xE0 == 0xE0:
+        return probe_mp3
+    return None
+
+
+def probe_file(path):
+    """Return a metadata dict for the media at `path`, or None when the
+    container is not one we understand. Raises ProbeError on corrupt input."""
+    file_size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(64)
+        if len(head) < 12:
+            return None
+        parser = _sniff(f, head)
+        if parser is None:
+            return None
+        try:
+            result = parser(f, file_size)
+        except (IndexError, struct.error, UnicodeDecodeError) as e:
+            raise ProbeError(f'Truncated or corrupt {parser.__name__[6:]} data: {e}')
+
+    if result['duration'] and result['duration'] > 0:
+        result['bitrate'] = int(file_size * 8 / result['duration'])
+    else:
+        result['duration'] = None
+    return result
+
+
+class ProbeQueue:
+    """Probe media rows in the background, one worker thread per process.
+
+    Rows with a NULL probe_status have not been probed yet; each is claimed
+    with a conditional UPDATE first, so a row is probed once even when
+    several workers sweep the table at the same time."""
+
+    def __init__(self, connect, media_folder):
+        self.connect = connect
+        self.media_folder = media_folder
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker_pid = None
+        self._stats = {'probed': 0, 'failed': 0, 'unsupported': 0}
+
+    def start(self):
+        """Start this process's worker, which sweeps up rows left unprobed"""
+        self._ensure_worker()
+
+    def enqueue(self, media_id):
+        self._ensure_worker()
+        self._queue.put(media_id)
+
+    def _ensure_worker(self):
+        pid = os.getpid()
+        if self._worker_pid == pid:
+            return
+        with self._lock:
+            if self._worker_pid == pid:
+                return
+            self._worker_pid = pid
+            # A fork inherits the parent's queue contents; start clean
+            self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self._sweep()
+            except sqlite3.Error:
+                pass
+            while True:
+                try:
+                    media_id = self._queue.get(timeout=SWEEP_INTERVAL)
+                except queue.Empty:
+                    break
+                self.probe(media_id)
+
+    def _sweep(self):
+        # Pick up rows from before the probe existed, and rows whose worker
+        # died mid-probe
+        conn = self.connect()
+        try:
+            conn.execute('''UPDATE media SET probe_status = NULL
+                            WHERE probe_status = 'probing' AND COALESCE(probe_claimed_at, 0) < ?''',
+                         (time.time() - STALE_AFTER,))
+            conn.commit()
+            ids = [row[0] for row in conn.execute('SELECT id FROM media WHERE probe_status IS NULL')]
+        finally:
+            conn.close()
+        for media_id in ids:
+            self._queue.put(media_id)
+
+    def probe(self, media_id):
+        conn = self.connect()
+        try:
+            claimed = conn.execute(
+                "UPDATE media SET probe_status = 'probing', probe_claimed_at = ? WHERE id = ? AND probe_status IS NULL",
+                (time.time(), media_id)).rowcount
+            conn.commit()
+            if not claimed:
+                return
+
+            try:
+                row = conn.execute('SELECT filename, mime_type FROM media WHERE id = ?', (media_id,)).fetchone()
+                result = probe_file(os.path.join(self.media_folder, row[0]))
+                status = 'done' if result else 'unsupported'
+            except Exception:
+                # ProbeError, OSError, or a parser bug on an odd file: one bad
+                # item must neither stop the worker nor stay 'probing'
+                result, status = None, 'failed'
+
+            if result:
+                conn.execute('''UPDATE media SET duration = ?, container = ?, video_codec = ?, audio_codec = ?,
+                                width = ?, height = ?, bitrate = ?, mime_type = ?, probe_status = ?
+                                WHERE id = ?''',
+                             (result['duration'], result['container'], result['video_codec'],
+                              result['audio_codec'], result['width'], result['height'], result['bitrate'],
+                              result['mime_type'] or row[1], status, media_id))
+            else:
+                conn.execute('UPDATE media SET probe_status = ? WHERE id = ?', (status, media_id))
+            conn.commit()
+            with self._lock:
+                self._stats['probed' if status == 'done' else status] += 1
+        except sqlite3.Error:
+            # Left 'probing'; a later sweep finds it stale and retries
+            pass
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['pending'] = self._queue.qsize()
+        return snapshot
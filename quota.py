@@ -0,0 +1,227 @@
+"""
+Storage quota and eviction of the least-watched media.
+
+Bytes used by uploads are counted in the storage_usage table: triggers on
+blobs, media, subtitles and transcode_jobs keep the totals exact in the same transaction
+as the row change, so reading usage is one small query however large the
+library is. Derived files are not counted: the HLS and segment caches are
+bounded by their own HLS_CACHE_BYTES and SEGMENT_CACHE_DISK_BYTES, and
+preview images and peaks (a few hundred KB per item) go with their media.
+They share the volume, though, and MIN_FREE_BYTES still sees them.
+
+Once usage reaches HIGH_WATER of the quota, or the volume's free space
+drops under MIN_FREE_BYTES, media is evicted until usage is back under
+LOW_WATER. Candidates are ranked by
+
+    heat  = (1 + play_count + total_watch_time / 300) * 0.5 ** (idle hours / HALF_LIFE_HOURS)
+    score = heat / size in MB
+
+and the lowest scores go first, so large files nobody has watched lately
+are evicted before small or popular ones. Media uploaded or watched within
+GRACE_SECONDS is never evicted, nor is content whose blob is shared with
+other media (removing one reference would free nothing). Each eviction is
+logged in the evictions table with the numbers that decided it.
+"""
+
+import os
+import shutil
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cleanup
+import subtitles
+
+# 0 means "a fraction of the volume the uploads live on"
+QUOTA_BYTES = int(os.environ.get('STORAGE_QUOTA_BYTES', 0))
+DISK_FRACTION = float(os.environ.get('STORAGE_QUOTA_DISK_FRACTION', 0.8))
+HIGH_WATER = float(os.environ.get('STORAGE_HIGH_WATER', 0.9))
+LOW_WATER = float(os.environ.get('STORAGE_LOW_WATER', 0.75))
+MIN_FREE_BYTES = int(os.environ.get('STORAGE_MIN_FREE_BYTES', 512 * 1024 * 1024))
+GRACE_SECONDS = int(os.environ.get('STORAGE_EVICTION_GRACE', 3600))
+HALF_LIFE_HOURS = 24 * 7
+EVICTION_BATCH = 50
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+def usage(conn):
+    """Bytes used per kind ('blobs', 'media', 'subtitles', 'transcodes') plus 'total'"""
+    totals = {row[0]: row[1] for row in conn.execute('SELECT kind, bytes FROM storage_usage')}
+    totals['total'] = sum(totals.values())
+    return totals
+
+
+def candidates(conn, limit=None):
+    """Evictable media, lowest score (first to go) first. Each row carries
+    the bytes evicting it would free and the inputs to its score."""
+    rows = conn.execute('''
+        SELECT m.id, m.filename, m.blob_digest, m.play_count, m.total_watch_time,
+               COALESCE(m.last_accessed, m.upload_date) AS last_accessed,
+               COALESCE(b.size, m.file_size, 0) + COALESCE(t.output_bytes, 0) AS freeable,
+               (julianday('now') - julianday(COALESCE(m.last_accessed, m.upload_date))) * 24 AS idle_hours
+        FROM media m LEFT JOIN blobs b ON b.digest = m.blob_digest
+             LEFT JOIN transcode_jobs t ON t.media_id = m.id
+        WHERE (m.blob_digest IS NULL OR b.refcount = 1)
+          AND julianday(COALESCE(m.last_accessed, m.upload_date)) < julianday('now') - ? / 86400.0''',
+                        (GRACE_SECONDS,)).fetchall()
+
+    ranked = []
+    for row in rows:
+        heat = (1 + (row['play_count'] or 0) + (row['total_watch_time'] or 0) / 300) \
+            * 0.5 ** (max(row['idle_hours'] or 0, 0) / HALF_LIFE_HOURS)
+        score = heat / max(row['freeable'] / (1024 * 1024), 1)
+        ranked.append((score, row))
+    ranked.sort(key=lambda item: item[0])
+    return ranked[:limit] if limit else ranked
+
+
+class StorageQuota:
+    """Keeps uploads under the quota. check() is cheap and runs after every
+    upload; eviction itself happens on a background thread per process,
+    or inline from ensure_room() when an upload would not fit."""
+
+    def __init__(self, connect, upload_folder, subtitle_folder):
+        self.connect = connect
+        self.upload_folder = upload_folder
+        self.subtitle_folder = subtitle_folder
+        self._evict_lock = threading.Lock()
+
+    def limit(self):
+        if QUOTA_BYTES:
+            return QUOTA_BYTES
+        return int(shutil.disk_usage(self.upload_folder).total * DISK_FRACTION)
+
+    def status(self, conn):
+        limit = self.limit()
+        used = usage(conn)
+        free = shutil.disk_usage(self.upload_folder).free
+        return {
+            'usage': used,
+            'limit': limit,
+            'high_water': int(limit * HIGH_WATER),
+            'low_water': int(limit * LOW_WATER),
+            'disk_free': free,
+            'min_free': MIN_FREE_BYTES,
+            'over_high_water': used['total'] >= limit * HIGH_WATER or free < MIN_FREE_BYTES,
+        }
+
+    def _bytes_to_free(self, status, incoming=0):
+        """Bytes to evict so `incoming` more bytes leave usage at the low
+        water mark and the volume with MIN_FREE_BYTES to spare"""
+        over_quota = status['usage']['total'] + incoming - status['low_water']
+        under_free = MIN_FREE_BYTES + incoming - status['disk_free']
+        return max(over_quota, under_free, 0)
+
+    def check(self):
+        """Start a background eviction if usage is over the high water mark"""
+        conn = self.connect()
+        try:
+            status = self.status(conn)
+        finally:
+            conn.close()
+        if status['over_high_water'] and not self._evict_lock.locked():
+            threading.Thread(target=self._evict_in_background, daemon=True).start()
+
+    def _evict_in_background(self):
+        conn = self.connect()
+        try:
+            with self._evict_lock:
+                self._apply(conn, self._plan(conn, self._bytes_to_free(self.status(conn)), 'high water mark'))
+        except sqlite3.Error:
+            # The next upload checks again
+            pass
+        finally:
+            conn.close()
+
+    def ensure_room(self, conn, size):
+        """Make room for an upload of `size` bytes, evicting synchronously
+        if needed. Raises QuotaExceeded when even that is not enough."""
+        with self._evict_lock:
+            status = self.status(conn)
+            if status['usage']['total'] + size <= status['high_water'] and \
+                    status['disk_free'] - size >= MIN_FREE_BYTES:
+                return
+            self._apply(conn, self._plan(conn, self._bytes_to_free(status, size), 'upload needs room'))
+            status = self.status(conn)
+        if status['usage']['total'] + size > status['limit'] or status['disk_free'] - size < MIN_FREE_BYTES:
+            raise QuotaExceeded('Not enough storage space for this upload')
+
+    def evict(self, conn, bytes_needed, reason, dry_run=False):
+        """Evict the lowest-scoring media until `bytes_needed` bytes are
+        freed. Returns the decisions: what was (or with dry_run, would be)
+        evicted, with the numbers behind each choice."""
+        if dry_run:
+            return self._report(self._plan(conn, bytes_needed, reason))
+        with self._evict_lock:
+            return self._report(self._apply(conn, self._plan(conn, bytes_needed, reason)))
+
+    def _plan(self, conn, bytes_needed, reason):
+        decisions = []
+        planned = 0
+        if bytes_needed <= 0:
+            return decisions
+        for score, row in candidates(conn):
+            if planned >= bytes_needed:
+                break
+            decisions.append({
+                'media_id': row['id'],
+                'filename': row['filename'],
+                'file_size': row['freeable'],
+                'play_count': row['play_count'],
+                'total_watch_time': row['total_watch_time'],
+                'last_accessed': row['last_accessed'],
+                'score': score,
+                'reason': reason,
+                'row': row,
+            })
+            planned += row['freeable']
+        return decisions
+
+    def _apply(self, conn, decisions):
+        with ThreadPoolExecutor(max_workers=cleanup.UNLINK_WORKERS) as pool:
+            for i in range(0, len(decisions), EVICTION_BATCH):
+                batch = decisions[i:i + EVICTION_BATCH]
+                cleanup.delete_media(conn, [d['row'] for d in batch],
+                                     self.upload_folder, self.subtitle_folder, pool)
+                conn.executemany('''INSERT INTO evictions (media_id, filename, file_size, play_count,
+                                    total_watch_time, last_accessed, score, reason)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                 [(d['media_id'], d['filename'], d['file_size'], d['play_count'],
+                                   d['total_watch_time'], d['last_accessed'], d['score'], d['reason'])
+                                  for d in batch])
+                conn.commit()
+        return decisions
+
+    @staticmethod
+    def _report(decisions):
+        return [{key: value for key, value in d.items() if key != 'row'} for d in decisions]
+
+
+def recent_evictions(conn, limit=50):
+    return [dict(row) for row in conn.execute(
+        'SELECT * FROM evictions ORDER BY id DESC LIMIT ?', (limit,))]
+
+
+def recount(conn, subtitle_folder):
+    """Recompute the usage totals from the tables, filling in sizes of
+    subtitles uploaded before sizes were recorded. Returns usage()."""
+    for row in conn.execute('SELECT id, filename FROM subtitles WHERE file_size IS NULL').fetchall():
+        size = 0
+        for path in (os.path.join(subtitle_folder, row['filename']), subtitles.artifact_path(row['filename'])):
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+        conn.execute('UPDATE subtitles SET file_size = ? WHERE id = ?', (size, row['id']))
+    conn.execute("UPDATE storage_usage SET bytes = (SELECT COALESCE(SUM(size), 0) FROM blobs) WHERE kind = 'blobs'")
+    conn.execute("UPDATE storage_usage SET bytes = (SELECT COALESCE(SUM(file_size), 0) FROM media "
+                 "WHERE blob_digest IS NULL) WHERE kind = 'media'")
+    conn.execute("UPDATE storage_usage SET bytes = (SELECT COALESCE(SUM(file_size), 0) FROM subtitles) "
+                 "WHERE kind = 'subtitles'")
+    conn.execute("UPDATE storage_usage SET bytes = (SELECT COALESCE(SUM(output_bytes), 0) FROM transcode_jobs) "
+                 "WHERE kind = 'transcodes'")
+    conn.commit()
+    return usage(conn)
@@ -0,0 +1,433 @@
+"""
+Shared cache for proxied HLS media segments.
+
+Every viewer of a live stream asks /proxy_resource for the same .ts
+segments. Segments are kept in a byte-bounded in-memory LRU keyed by the
+decoded upstream URL, spill to a disk tier (shared by all workers) when
+they fall out of memory, and expire after a TTL. Concurrent misses for
+the same URL share a single upstream fetch: the first request starts it
+and every requester streams the bytes from the shared buffer as they
+arrive. A fetch bigger than MAX_ITEM_BYTES is passed through to its
+readers without being kept, and a fetch nobody is reading any more is
+cancelled.
+"""
+
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+
+# Progressive containers (.mp4, .m4a...) are deliberately absent: they are
+# whole files rather than segments and must not be buffered in memory.
+SEGMENT_EXTENSIONS = ('.ts', '.m4s', '.aac', '.cmfv', '.cmfa', '.vtt', '.webvtt')
+
+MEMORY_MAX_BYTES = int(os.environ.get('SEGMENT_CACHE_MEMORY_BYTES', 64 * 1024 * 1024))
+DISK_MAX_BYTES = int(os.environ.get('SEGMENT_CACHE_DISK_BYTES', 512 * 1024 * 1024))
+MAX_ITEM_BYTES = int(os.environ.get('SEGMENT_CACHE_MAX_ITEM_BYTES', 16 * 1024 * 1024))
+TTL_SECONDS = int(os.environ.get('SEGMENT_CACHE_TTL', 300))
+CACHE_DIR = os.environ.get('SEGMENT_CACHE_DIR', 'cache/segments')
+STALL_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+
+def is_segment_url(url):
+    return urlparse(url).path.lower().endswith(SEGMENT_EXTENSIONS)
+
+
+class Segment:
+    """A cached or in-flight segment, readable by any number of readers
+    while the upstream fetch is still filling it.
+
+    SegmentCache.open() hands each caller one reference, which it turns
+    into a reader with reader() (iter_chunks() does this) or gives back
+    with release(). When the last reader of an unfinished fetch leaves, the
+    fetch is cancelled. A fetch that grows past max_buffer_bytes can no
+    longer be cached: from then on chunks every reader has had are dropped,
+    and the fetch waits while the slowest reader is max_buffer_bytes behind,
+    so a huge file passes through without being buffered whole."""
+
+    def __init__(self, max_buffer_bytes=MAX_ITEM_BYTES):
+        self.status = None
+        self.content_type = None
+        self.chunks = []
+        # Absolute index of chunks[0]; above 0 once chunks have been dropped
+        self.first = 0
+        self.size = 0
+        self.buffered = 0
+        self.max_buffer_bytes = max_buffer_bytes
+        self.overflowed = False
+        self.cancelled = False
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+        self._listeners = set()
+        self._references = 0
+        # Reader token -> absolute index of its next chunk
+        self._positions = {}
+
+    @classmethod
+    def complete(cls, content_type, data):
+        segment = cls()
+        segment.status = 200
+        segment.content_type = content_type
+        segment.chunks = [data]
+        segment.size = segment.buffered = len(data)
+        segment.done = True
+        return segment
+
+    def attach(self):
+        """Take a reference for a new reader. False when the fetch was
+        cancelled or has already dropped its first chunks."""
+        with self.cond:
+            if self.cancelled or self.first:
+                return False
+            self._references += 1
+            return True
+
+    def release(self):
+        """Give back a reference without reading"""
+        with self.cond:
+            self._references = max(0, self._references - 1)
+            self._reader_left()
+
+    def reader(self):
+        """Turn a reference into a reader. Returns its token, for
+        read_from() and close_reader()."""
+        with self.cond:
+            self._references = max(0, self._references - 1)
+            token = object()
+            self._positions[token] = self.first
+            return token
+
+    def close_reader(self, token):
+        with self.cond:
+            if self._positions.pop(token, None) is not None:
+                self._trim()
+                self._reader_left()
+
+    def wait_for_headers(self):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.status is not None or self.error is not None,
+                                      STALL_TIMEOUT):
+                raise TimeoutError('Upstream segment fetch stalled')
+            if self.status is None:
+                raise self.error
+
+    def add_listener(self, callback):
+        """Have the fill thread call `callback()` whenever headers, data or
+        the end arrive, for readers that must not block on `cond` (the ASGI
+        event loop). It runs with `cond` held, so it must be quick."""
+        with self.cond:
+            self._listeners.add(callback)
+
+    def remove_listener(self, callback):
+        with self.cond:
+            self._listeners.discard(callback)
+
+    def read_from(self, token):
+        """Without blocking: (chunks reader `token` has not had yet, finished, error)"""
+        with self.cond:
+            position = self._positions[token]
+            chunks = self.chunks[position - self.first:]
+            self._positions[token] = position + len(chunks)
+            self._trim()
+            return chunks, self.done, self.error
+
+    def _ready(self, token):
+        # Caller holds cond
+        return self._positions[token] < self.first + len(self.chunks) or self.done
+
+    def content_length(self):
+        return self.size if self.done and self.error is None else None
+
+    def iter_chunks(self):
+        """Blocking iterator for one reader. Closing it, which WSGI servers
+        do even when it was never started, closes the reader."""
+        return _ChunkIterator(self)
+
+    def _changed(self):
+        # Caller holds cond
+        self.cond.notify_all()
+        for callback in self._listeners:
+            callback()
+
+    def _trim(self):
+        # Caller holds cond. Unread references still start at the beginning.
+        if not self.overflowed or self._references:
+            return
+        keep_from = min(self._positions.values(), default=self.first + len(self.chunks))
+        drop = keep_from - self.first
+        if drop > 0:
+            self.buffered -= sum(len(chunk) for chunk in self.chunks[:drop])
+            del self.chunks[:drop]
+            self.first = keep_from
+            # Wakes the fill thread if it is waiting for room
+            self._changed()
+
+    def _reader_left(self):
+        # Caller holds cond
+        if not self.done and not self._positions and not self._references:
+            self.cancelled = True
+            self._changed()
+
+    def _start(self, status, content_type):
+        with self.cond:
+            self.status = status
+            self.content_type = content_type
+            self._changed()
+
+    def _append(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.buffered += len(chunk)
+            if self.size > self.max_buffer_bytes:
+                self.overflowed = True
+                self._trim()
+            self._changed()
+            if self.overflowed and not self.cond.wait_for(
+                    lambda: self.buffered <= self.max_buffer_bytes or self.cancelled, STALL_TIMEOUT):
+                raise TimeoutError('Segment readers stalled')
+
+    def _finish(self, error=None):
+        with self.cond:
+            self.error = error
+            self.done = True
+            self._changed()
+
+
+class _ChunkIterator:
+    def __init__(self, segment):
+        self.segment = segment
+        self.token = segment.reader()
+        self.pending = deque()
+        self.finished = False
+        self.error = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        segment = self.segment
+        while not self.pending:
+            if self.finished or self.token is None:
+                self.close()
+                if self.error is not None:
+                    raise self.error
+                raise StopIteration
+            with segment.cond:
+                if not segment.cond.wait_for(lambda: segment._ready(self.token), STALL_TIMEOUT):
+                    self.close()
+                    raise TimeoutError('Upstream segment fetch stalled')
+            chunks, self.finished, self.error = segment.read_from(self.token)
+            self.pending.extend(chunks)
+        return self.pending.popleft()
+
+    def close(self):
+        if self.token is not None:
+            self.segment.close_reader(self.token)
+            self.token = None
+
+
+class SegmentCache:
+    def __init__(self, memory_max_bytes=MEMORY_MAX_BYTES, disk_max_bytes=DISK_MAX_BYTES,
+                 max_item_bytes=MAX_ITEM_BYTES, ttl=TTL_SECONDS, cache_dir=CACHE_DIR):
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.ttl = ttl
+        self.cache_dir = cache_dir
+        self._entries = OrderedDict()
+        self._memory_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'coalesced': 0, 'misses': 0, 'spills': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def open(self, url, fetch):
+        """Return a Segment for `url`, fetching it with `fetch()` (which must
+        return a streaming requests response) only if no cached copy or
+        joinable in-flight fetch exists. The caller holds one reference on
+        it: read it with iter_chunks() or reader(), or release() it."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                expires, segment = entry
+                if expires > now:
+                    self._entries.move_to_end(url)
+                    self._stats['memory_hits'] += 1
+                    segment.attach()
+                    return segment
+                self._drop(url)
+
+            segment = self._inflight.get(url)
+            if segment is not None and segment.attach():
+                self._stats['coalesced'] += 1
+                return segment
+
+        segment = self._load_from_disk(url, now)
+        if segment is not None:
+            with self._lock:
+                self._stats['disk_hits'] += 1
+                spilled = self._store(url, segment, now)
+            self._spill_all(spilled)
+            segment.attach()
+            return segment
+
+        with self._lock:
+            # Another thread may have started the fetch while we checked disk
+            segment = self._inflight.get(url)
+            if segment is not None and segment.attach():
+                self._stats['coalesced'] += 1
+                return segment
+            # Any in-flight fetch left here is too far along to join, or cancelled
+            segment = Segment(self.max_item_bytes)
+            segment.attach()
+            self._inflight[url] = segment
+            self._stats['misses'] += 1
+
+        threading.Thread(target=self._fill, args=(url, segment, fetch), daemon=True).start()
+        return segment
+
+    def _fill(self, url, segment, fetch):
+        response = None
+        try:
+            response = fetch()
+            segment._start(response.status_code,
+                           response.headers.get('Content-Type', 'application/octet-stream'))
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if segment.cancelled:
+                    break
+                if chunk:
+                    segment._append(chunk)
+                    if segment.overflowed:
+                        # Too big to cache; later requests fetch on their own
+                        with self._lock:
+                            self._forget(url, segment)
+            segment._finish(ConnectionAbortedError('Fetch cancelled: no readers left') if segment.cancelled else None)
+        except Exception as e:
+            segment._finish(e)
+        finally:
+            # Closing the response drops the upstream connection of a cancelled fetch
+            if response is not None:
+                response.close()
+            spilled = []
+            with self._lock:
+                self._forget(url, segment)
+                if segment.status == 200 and segment.error is None and not segment.overflowed:
+                    data = b''.join(segment.chunks)
+                    spilled = self._store(url, Segment.complete(segment.content_type, data), time.time())
+            self._spill_all(spilled)
+
+    def _forget(self, url, segment):
+        # Caller holds the lock
+        if self._inflight.get(url) is segment:
+            del self._inflight[url]
+
+    def _store(self, url, segment, now):
+        """Insert into the memory LRU (caller holds the lock). Returns the
+        entries evicted to make room, to be spilled once the lock is released."""
+        if url in self._entries:
+            self._drop(url)
+        self._entries[url] = (now + self.ttl, segment)
+        self._memory_bytes += segment.size
+
+        spilled = []
+        while self._memory_bytes > self.memory_max_bytes and len(self._entries) > 1:
+            old_url, (expires, old_segment) = self._entries.popitem(last=False)
+            self._memory_bytes -= old_segment.size
+            if expires > now:
+                spilled.append((old_url, expires, old_segment))
+        return spilled
+
+    def _spill_all(self, spilled):
+        for url, expires, segment in spilled:
+            self._spill(url, expires, segment)
+
+    def _drop(self, url):
+        expires, segment = self._entries.pop(url)
+        self._memory_bytes -= segment.size
+
+    def _disk_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.seg')
+
+    def _spill(self, url, expires, segment):
+        """Write an evicted segment to the disk tier. The file's mtime is set
+        to its expiry time so other workers can check freshness with a stat."""
+        path = self._disk_path(url)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(segment.content_type.encode('latin-1', 'replace') + b'\n')
+                f.write(segment.chunks[0])
+            os.utime(tmp_path, (expires, expires))
+            os.replace(tmp_path, path)
+        except OSError:
+            self._remove_quietly(tmp_path)
+            return
+
+        with self._lock:
+            self._stats['spills'] += 1
+            prune = self._stats['spills'] % 32 == 0
+        if prune:
+            self.prune_disk()
+
+    def _load_from_disk(self, url, now):
+        path = self._disk_path(url)
+        try:
+            if os.stat(path).st_mtime <= now:
+                os.remove(path)
+                return None
+            with open(path, 'rb') as f:
+                content_type = f.readline().rstrip(b'\n').decode('latin-1')
+                data = f.read()
+        except OSError:
+            return None
+        return Segment.complete(content_type, data)
+
+    def prune_disk(self):
+        """Delete expired spill files, then the soonest-to-expire ones until
+        the disk tier is back under its byte budget."""
+        now = time.time()
+        files = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.seg'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if st.st_mtime <= now:
+                self._remove_quietly(entry.path)
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            self._remove_quietly(path)
+            total -= size
+
+    @staticmethod
+    def _remove_quietly(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['memory_entries'] = len(self._entries)
+            snapshot['memory_bytes'] = self._memory_bytes
+            snapshot['inflight'] = len(self._inflight)
+        return snapshot
+
+
+segment_cache = SegmentCache()
@@ -14,6 +14,10 @@ mkdir -p static/subtitles
 mkdir -p static/vpn
 mkdir -p static/icons
 
+# Fingerprint and precompress static assets (static/dist)
+echo "Building static assets..."
+python3 assets.py
+
 # Initialize database (creates tables if they don't exist)
 echo "Initializing database..."
 python3 -c "from app import init_db; init_db()" || echo "Database already initialized"
@@ -29,15 +33,31 @@ fi
 # Set default PORT if not provided by Render
 export PORT=${PORT:-10000}
 export WEB_CONCURRENCY=${WEB_CONCURRENCY:-4}
+# wsgi: sync gunicorn workers; asgi: uvicorn workers with async streaming endpoints
+export SERVER_MODE=${SERVER_MODE:-wsgi}
 
 echo "=========================================="
 echo "Configuration:"
 echo "  PORT: $PORT"
 echo "  WORKERS: $WEB_CONCURRENCY"
+echo "  SERVER_MODE: $SERVER_MODE"
 echo "  ENVIRONMENT: ${FLASK_ENV:-production}"
 echo "=========================================="
 
 # Start gunicorn
+if [ "$SERVER_MODE" = "asgi" ]; then
+    echo "Starting gunicorn with uvicorn workers (async mode)..."
+    exec gunicorn \
+        --bind 0.0.0.0:$PORT \
+        --workers $WEB_CONCURRENCY \
+        --worker-class uvicorn.workers.UvicornWorker \
+        --timeout 120 \
+        --access-logfile - \
+        --error-logfile - \
+        --log-level info \
+        asgi:application
+fi
+
 echo "Starting gunicorn..."
 exec gunicorn \
     --bind 0.0.0.0:$PORT \
@@ -82,9 +82,60 @@ function showNotification(message, type = 'info') {
     }, 5000);
 }
 
+// Resumable upload through /uploads. `meta` is {filename} for media files or
+// {kind: 'recording', recording_type} for recordings. Chunks that fail are
+// retried from the offset the server reports, so a dropped connection only
+// costs the chunk in flight.
+async function uploadResumable(blob, meta, onProgress, chunkSize = 4 * 1024 * 1024) {
+    const createResponse = await fetch('/uploads', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ ...meta, size: blob.size })
+    });
+    const created = await createResponse.json();
+    if (!createResponse.ok) throw new Error(created.error || 'Upload failed');
+
+    const url = `/uploads/${created.upload_id}`;
+    let offset = 0;
+    let failures = 0;
+
+    while (offset < blob.size) {
+        try {
+            const response = await fetch(url, {
+                method: 'PATCH',
+                headers: {
+                    'Content-Type': 'application/offset+octet-stream',
+                    'Upload-Offset': String(offset)
+                },
+                body: blob.slice(offset, offset + chunkSize)
+            });
+            if (response.status === 413 || response.status === 404) {
+                const data = await response.json().catch(() => ({}));
+                throw Object.assign(new Error(data.error || 'Upload rejected'), { fatal: true });
+            }
+            // 409 (offset mismatch) falls through to the resync below
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            offset = parseInt(response.headers.get('Upload-Offset'), 10);
+            failures = 0;
+            if (onProgress) onProgress(offset, blob.size);
+        } catch (error) {
+            if (error.fatal || ++failures > 5) throw error;
+            await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** failures));
+            // Ask the server how much actually arrived before retrying
+            const head = await fetch(url, { method: 'HEAD' }).catch(() => null);
+            if (head && head.ok) offset = parseInt(head.headers.get('Upload-Offset'), 10);
+        }
+    }
+
+    const finishResponse = await fetch(`${url}/finish`, { method: 'POST' });
+    const result = await finishResponse.json();
+    if (!finishResponse.ok) throw new Error(result.error || 'Upload failed');
+    return result;
+}
+
 if ('serviceWorker' in navigator) {
     window.addEventListener('load', () => {
-        navigator.serviceWorker.register('/static/sw.js')
+        navigator.serviceWorker.register('/static/sw.js', { scope: '/' })
             .then(registration => {
                 console.log('ServiceWorker registration successful:', registration.scope);
             })
@@ -1,6 +1,12 @@
 let player;
 let bookmarks = [];
 const filename = document.getElementById('mediaPlayer').dataset.filename;
+const mediaId = document.getElementById('mediaPlayer').dataset.mediaId;
+
+// Subtitles are fetched a window at a time around the playhead instead of
+// downloading and parsing whole files up front
+const CUE_WINDOW_SECONDS = 120;
+let subtitleTracks = [];
 
 document.addEventListener('DOMContentLoaded', function() {
     player = videojs('mediaPlayer', {
@@ -13,6 +19,8 @@ document.addEventListener('DOMContentLoaded', function() {
     loadPlayerSettings();
     loadBookmarks();
     setupEventListeners();
+    setupSubtitleTracks();
+    setupSeekPreviews();
     
     player.on('play', function() {
         updateAnalytics('play');
@@ -90,6 +98,177 @@ function setupEventListeners() {
     });
 }
 
+function setupSubtitleTracks() {
+    document.querySelectorAll('[data-subtitle]').forEach(el => {
+        const language = el.dataset.language;
+        subtitleTracks.push({
+            track: player.addTextTrack('subtitles', language, language),
+            file: el.dataset.subtitle,
+            windows: new Set(),
+            cueIds: new Set()
+        });
+    });
+    if (subtitleTracks.length === 0) return;
+
+    player.on('timeupdate', loadVisibleCues);
+    player.on('seeking', loadVisibleCues);
+    player.textTracks().addEventListener('change', loadVisibleCues);
+
+    let searchTimer;
+    document.getElementById('cueSearch').addEventListener('input', function() {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => searchCues(this.value), 300);
+    });
+}
+
+// Seek previews: thumbnails.vtt maps time ranges to tiles of one sprite
+// image, shown above the progress bar while hovering it
+async function setupSeekPreviews() {
+    const url = document.getElementById('mediaPlayer').dataset.thumbnails;
+    if (!url) return;
+
+    let cues;
+    try {
+        const response = await fetch(url);
+        if (!response.ok) return;
+        cues = parseThumbnailCues(await response.text(), url);
+    } catch (error) {
+        return;
+    }
+    if (cues.length === 0) return;
+
+    const progress = player.controlBar.progressControl.el();
+    const preview = document.createElement('div');
+    preview.className = 'vjs-seek-preview';
+    preview.style.cssText = 'position:absolute;bottom:100%;display:none;pointer-events:none;' +
+        'border:1px solid #fff;background-repeat:no-repeat;';
+    progress.appendChild(preview);
+
+    progress.addEventListener('mousemove', function(event) {
+        const rect = progress.getBoundingClientRect();
+        const time = Math.max(0, (event.clientX - rect.left) / rect.width) * player.duration();
+        const cue = cues.find(c => time >= c.start && time < c.end) || cues[cues.length - 1];
+        preview.style.width = cue.w + 'px';
+        preview.style.height = cue.h + 'px';
+        preview.style.backgroundImage = `url("${cue.src}")`;
+        preview.style.backgroundPosition = `-${cue.x}px -${cue.y}px`;
+        preview.style.left = Math.min(Math.max(event.clientX - rect.left - cue.w / 2, 0), rect.width - cue.w) + 'px';
+        preview.style.display = 'block';
+    });
+    progress.addEventListener('mouseleave', function() {
+        preview.style.display = 'none';
+    });
+}
+
+function parseThumbnailCues(text, baseUrl) {
+    const seconds = stamp => stamp.split(':').reduce((total, part) => total * 60 + parseFloat(part), 0);
+    const cues = [];
+    text.split(/\r?\n\r?\n/).forEach(block => {
+        const lines = block.trim().split(/\r?\n/);
+        const timing = lines.findIndex(line => line.includes('-->'));
+        if (timing < 0 || !lines[timing + 1]) return;
+        const [start, end] = lines[timing].split('-->').map(s => seconds(s.trim()));
+        const [image, fragment] = lines[timing + 1].split('#xywh=');
+        if (!fragment) return;
+        const [x, y, w, h] = fragment.split(',').map(Number);
+        cues.push({ start, end, src: new URL(image, new URL(baseUrl, location.href)).href, x, y, w, h });
+    });
+    return cues;
+}
+
+function loadVisibleCues() {
+    const bucket = Math.floor(player.currentTime() / CUE_WINDOW_SECONDS);
+    subtitleTracks.forEach(entry => {
+        if (entry.track.mode !== 'showing') return;
+        // The current window and the next, so cues are ready before they are due
+        loadCueWindow(entry, bucket);
+        loadCueWindow(entry, bucket + 1);
+    });
+}
+
+async function loadCueWindow(entry, bucket) {
+    if (entry.windows.has(bucket)) return;
+    entry.windows.add(bucket);
+
+    const start = bucket * CUE_WINDOW_SECONDS;
+    try {
+        const response = await fetch(`/subtitles/${encodeURIComponent(entry.file)}/cues?start=${start}&end=${start + CUE_WINDOW_SECONDS}`);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        const data = await response.json();
+        const Cue = window.VTTCue || window.vttjs.VTTCue;
+        data.cues.forEach(cue => {
+            // Cues spanning a window boundary come back in both windows
+            if (entry.cueIds.has(cue.id)) return;
+            entry.cueIds.add(cue.id);
+            const vttCue = new Cue(cue.start, cue.end, cue.text);
+            applyCueSettings(vttCue, cue.settings);
+            entry.track.addCue(vttCue);
+        });
+    } catch (error) {
+        entry.windows.delete(bucket);
+    }
+}
+
+// WebVTT cue settings ("line:0 position:20%,line-left align:start") as
+// VTTCue properties. A value the browser rejects is skipped, as a
+// parsed .vtt file would skip it.
+function applyCueSettings(cue, settings) {
+    if (!settings) return;
+    const percent = value => /^\d+(\.\d+)?%$/.test(value) ? parseFloat(value) : null;
+    settings.split(/\s+/).forEach(setting => {
+        const [name, raw] = setting.split(':');
+        if (!raw) return;
+        const [value, alignment] = raw.split(',');
+        try {
+            if (name === 'vertical') {
+                cue.vertical = value;
+            } else if (name === 'line') {
+                if (value.endsWith('%')) {
+                    if (percent(value) === null) return;
+                    cue.snapToLines = false;
+                    cue.line = percent(value);
+                } else if (/^-?\d+$/.test(value)) {
+                    cue.line = parseInt(value, 10);
+                } else {
+                    return;
+                }
+                if (alignment) cue.lineAlign = alignment;
+            } else if (name === 'position') {
+                if (percent(value) === null) return;
+                cue.position = percent(value);
+                if (alignment) cue.positionAlign = alignment;
+            } else if (name === 'size') {
+                if (percent(value) === null) return;
+                cue.size = percent(value);
+            } else if (name === 'align') {
+                cue.align = value;
+            }
+        } catch (error) {
+            // Unsupported by this browser's VTTCue
+        }
+    });
+}
+
+async function searchCues(query) {
+    const results = document.getElementById('cueSearchResults');
+    results.innerHTML = '';
+    if (!query.trim()) return;
+
+    const active = subtitleTracks.find(entry => entry.track.mode === 'showing') || subtitleTracks[0];
+    const response = await fetch(`/subtitles/${encodeURIComponent(active.file)}/cues?q=${encodeURIComponent(query)}&limit=20`);
+    if (!response.ok) return;
+    const data = await response.json();
+
+    data.cues.forEach(cue => {
+        const item = document.createElement('button');
+        item.type = 'button';
+        item.className = 'list-group-item list-group-item-action small';
+        item.textContent = `${formatTime(cue.start)} ${cue.text.replace(/<[^>]+>/g, '')}`;
+        item.addEventListener('click', () => player.currentTime(cue.start));
+        results.appendChild(item);
+    });
+}
+
 function savePlaybackPosition() {
     const position = player.currentTime();
     localStorage.setItem(`position_${filename}`, position.toString());
@@ -99,22 +278,56 @@ function getSavedPosition() {
     return parseFloat(localStorage.getItem(`position_${filename}`) || '0');
 }
 
-async function updateAnalytics(eventType, watchTime = 0) {
-    try {
-        await fetch('/update_analytics', {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                filename: filename,
-                event_type: eventType,
-                watch_time: watchTime
-            })
-        });
-    } catch (error) {
-        console.error('Analytics update failed:', error);
+// Analytics events are queued and sent in batches rather than one request each
+let analyticsQueue = [];
+const ANALYTICS_FLUSH_MS = 15000;
+const ANALYTICS_MAX_QUEUE = 20;
+
+function updateAnalytics(eventType, watchTime = 0) {
+    analyticsQueue.push({
+        filename: filename,
+        event_type: eventType,
+        watch_time: watchTime
+    });
+    
+    if (analyticsQueue.length >= ANALYTICS_MAX_QUEUE) {
+        flushAnalytics();
+    }
+}
+
+function flushAnalytics(useBeacon = false) {
+    if (analyticsQueue.length === 0) return;
+    
+    const body = JSON.stringify({ events: analyticsQueue });
+    analyticsQueue = [];
+    
+    if (useBeacon && navigator.sendBeacon) {
+        navigator.sendBeacon('/update_analytics/batch', new Blob([body], { type: 'application/json' }));
+        return;
     }
+    
+    fetch('/update_analytics/batch', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: body,
+        keepalive: true
+    }).catch(error => {
+        console.error('Analytics update failed:', error);
+    });
 }
 
+setInterval(flushAnalytics, ANALYTICS_FLUSH_MS);
+
+document.addEventListener('visibilitychange', function() {
+    if (document.visibilityState === 'hidden') {
+        flushAnalytics(true);
+    }
+});
+
+window.addEventListener('pagehide', function() {
+    flushAnalytics(true);
+});
+
 function takeScreenshot() {
     const video = player.el().querySelector('video');
     const canvas = document.createElement('canvas');
@@ -209,7 +422,7 @@ async function uploadSubtitle() {
     
     const formData = new FormData();
     formData.append('file', fileInput.files[0]);
-    formData.append('media_id', new URLSearchParams(window.location.search).get('file'));
+    formData.append('media_id', mediaId);
     formData.append('language', langInput.value || 'unknown');
     
     try {
@@ -46,7 +46,7 @@ window.addEventListener('appinstalled', () => {
 // Register service worker
 if ('serviceWorker' in navigator) {
   window.addEventListener('load', () => {
-    navigator.serviceWorker.register('/static/sw.js')
+    navigator.serviceWorker.register('/static/sw.js', { scope: '/' })
       .then(registration => {
         console.log('ServiceWorker registration successful:', registration.scope);
       })
@@ -7,6 +7,8 @@ let recordingTimer;
 let audioContext;
 let analyser;
 let animationId;
+// Mode of the take in recordedChunks; the toggle may change after it stops
+let recordingType = 'video';
 
 const preview = document.getElementById('preview');
 const playback = document.getElementById('playback');
@@ -15,6 +17,7 @@ const startBtn = document.getElementById('startBtn');
 const stopBtn = document.getElementById('stopBtn');
 const pauseBtn = document.getElementById('pauseBtn');
 const uploadBtn = document.getElementById('uploadBtn');
+const saveBtn = document.getElementById('saveBtn');
 const discardBtn = document.getElementById('discardBtn');
 const playbackCard = document.getElementById('playbackCard');
 const recordingTime = document.getElementById('recordingTime');
@@ -100,6 +103,7 @@ function drawVisualizer() {
 
 async function startRecording() {
     const isVideoMode = videoMode.checked;
+    recordingType = isVideoMode ? 'video' : 'audio';
     
     try {
         const constraints = isVideoMode
@@ -225,6 +229,28 @@ async function downloadRecording() {
     }, 1000);
 }
 
+async function saveRecording() {
+    if (recordedChunks.length === 0) {
+        showRecorderNotification('No recording to save', 'warning');
+        return;
+    }
+
+    const blob = new Blob(recordedChunks, { type: `${recordingType}/webm` });
+    const label = saveBtn.innerHTML;
+    saveBtn.disabled = true;
+    try {
+        await uploadResumable(blob, { kind: 'recording', recording_type: recordingType }, (sent, total) => {
+            saveBtn.innerHTML = `<i class="bi bi-cloud-upload"></i> Saving... ${Math.round(sent / total * 100)}%`;
+        });
+        showRecorderNotification('Recording saved to the library', 'success');
+    } catch (error) {
+        showRecorderNotification('Failed to save recording: ' + error.message, 'error');
+    } finally {
+        saveBtn.disabled = false;
+        saveBtn.innerHTML = label;
+    }
+}
+
 function discardRecording() {
     recordedChunks = [];
     playback.src = '';
@@ -236,6 +262,7 @@ startBtn.addEventListener('click', startRecording);
 stopBtn.addEventListener('click', stopRecording);
 pauseBtn.addEventListener('click', pauseRecording);
 uploadBtn.addEventListener('click', downloadRecording);
+saveBtn.addEventListener('click', saveRecording);
 discardBtn.addEventListener('click', discardRecording);
 
 videoMode.addEventListener('change', () => {
@@ -1,4 +1,6 @@
 
+// CACHE_NAME and urlsToCache are regenerated by `python assets.py` into
+// static/dist/sw.js, which is what /static/sw.js serves once built
 const CACHE_NAME = 'stream-weaver-v1';
 const urlsToCache = [
   '/',
@@ -23,16 +25,21 @@ self.addEventListener('install', event => {
 
 // Cache and return requests
 self.addEventListener('fetch', event => {
-  // Skip cross-origin requests
-  if (!event.request.url.startsWith(self.location.origin)) {
+  const url = new URL(event.request.url);
+  // Skip cross-origin requests and anything that is not a GET
+  if (url.origin !== self.location.origin || event.request.method !== 'GET') {
     return;
   }
 
-  // Skip requests to /stream/ and /proxy_resource/ (media streaming)
-  if (event.request.url.includes('/stream/') || 
-      event.request.url.includes('/proxy_resource/') ||
-      event.request.url.includes('/parse_playlist') ||
-      event.request.url.includes('/upload')) {
+  // Pages come from the network; the precached home page is the offline fallback
+  if (event.request.mode === 'navigate') {
+    event.respondWith(fetch(event.request).catch(() => caches.match('/')));
+    return;
+  }
+
+  // Only built assets are cached: their URLs change with their content, so a
+  // cached copy is never stale. Media, API and proxy requests go to the network.
+  if (!url.pathname.startsWith('/static/dist/')) {
     return;
   }
 
@@ -0,0 +1,231 @@
+"""
+Byte-range streaming and conditional caching for uploaded media.
+
+Ranges are served in bounded chunks (or handed to the server's
+wsgi.file_wrapper so gunicorn can use sendfile), so memory per viewer
+stays constant no matter how large the requested range is.
+
+Uploaded files never change once written (the upload timestamp is part
+of the filename), so they carry strong validators and can be cached by
+the browser indefinitely.
+"""
+
+import os
+import re
+import mimetypes
+import uuid
+from flask import Response
+from werkzeug.http import http_date, parse_date
+
+CHUNK_SIZE = 64 * 1024
+MAX_RANGES = 16
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_RANGE_SPEC = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(range_header, size):
+    """Parse a Range header into a list of inclusive (start, end) tuples.
+    Returns None when the header should be ignored (not a bytes range or
+    malformed) and an empty list when no range is satisfiable."""
+    if not range_header:
+        return None
+
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec:
+        return None
+
+    ranges = []
+    for part in spec.split(','):
+        match = _RANGE_SPEC.match(part)
+        if not match:
+            return None
+        first, last = match.groups()
+
+        if not first and not last:
+            return None
+
+        if not first:
+            # Suffix range: the last N bytes
+            suffix = int(last)
+            if suffix == 0:
+                continue
+            start = max(size - suffix, 0)
+            end = size - 1
+        else:
+            start = int(first)
+            end = int(last) if last else size - 1
+            if last and end < start:
+                return None
+            if start >= size:
+                continue
+            end = min(end, size - 1)
+
+        ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+
+    return _coalesce(ranges)
+
+
+def _coalesce(ranges):
+    """Sort the ranges and merge any that overlap or touch"""
+    if len(ranges) < 2:
+        return ranges
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def file_etag(stat_result):
+    """Strong validator derived from the file's size and mtime"""
+    return f'"{stat_result.st_size:x}-{int(stat_result.st_mtime_ns):x}"'
+
+
+def _etag_list(header):
+    """Split an If-None-Match header into opaque tags without the weak prefix"""
+    tags = []
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+
+def is_not_modified(request_headers, etag, last_modified):
+    """Evaluate If-None-Match / If-Modified-Since for a GET or HEAD.
+    If-None-Match wins when both are present, as RFC 9110 requires."""
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match:
+        tags = _etag_list(if_none_match)
+        return '*' in tags or etag in tags
+
+    if_modified_since = request_headers.get('If-Modified-Since')
+    if if_modified_since:
+        date = parse_date(if_modified_since)
+        return date is not None and int(last_modified) <= int(date.timestamp())
+
+    return False
+
+
+def if_range_matches(if_range, etag, last_modified):
+    """Check an If-Range header against the current validators.
+    If-Range only accepts strong comparison, so weak ETags never match."""
+    if not if_range:
+        return True
+
+    if_range = if_range.strip()
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+
+    date = parse_date(if_range)
+    return date is not None and int(date.timestamp()) == int(last_modified)
+
+
+def iter_file_range(path, start, length, chunk_size=CHUNK_SIZE):
+    """Yield `length` bytes of `path` starting at `start` in bounded chunks"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _part_header(boundary, content_type, start, end, size):
+    return (f'\r\n--{boundary}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode('latin-1')
+
+
+def plan_file_response(path, request_headers, mimetype=None, cache_control=IMMUTABLE_CACHE_CONTROL):
+    """Work out the response for `path` without touching its contents.
+    Returns (status, headers, parts) where each part is either literal bytes
+    or a (start, length) slice of the file. Shared by the WSGI and ASGI
+    serving modes so both answer conditional and range requests identically."""
+    stat_result = os.stat(path)
+    size = stat_result.st_size
+    etag = file_etag(stat_result)
+    content_type = mimetype or mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': http_date(stat_result.st_mtime),
+        'Cache-Control': cache_control
+    }
+
+    if is_not_modified(request_headers, etag, stat_result.st_mtime):
+        return 304, headers, []
+
+    ranges = parse_range_header(request_headers.get('Range'), size)
+    if ranges is not None and not if_range_matches(request_headers.get('If-Range'), etag, stat_result.st_mtime):
+        ranges = None
+
+    if ranges is None:
+        headers['Content-Type'] = content_type
+        headers['Content-Length'] = str(size)
+        return 200, headers, [(0, size)]
+
+    if not ranges:
+        body = b'Requested Range Not Satisfiable'
+        headers['Content-Range'] = f'bytes */{size}'
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        headers['Content-Length'] = str(len(body))
+        return 416, headers, [body]
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Type'] = content_type
+        headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+        headers['Content-Length'] = str(end - start + 1)
+        return 206, headers, [(start, end - start + 1)]
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    for start, end in ranges:
+        parts.append(_part_header(boundary, content_type, start, end, size))
+        parts.append((start, end - start + 1))
+    parts.append(f'\r\n--{boundary}--\r\n'.encode('latin-1'))
+
+    headers['Content-Type'] = f'multipart/byteranges; boundary={boundary}'
+    headers['Content-Length'] = str(sum(len(p) if isinstance(p, bytes) else p[1] for p in parts))
+    return 206, headers, parts
+
+
+def _iter_parts(path, parts):
+    for part in parts:
+        if isinstance(part, bytes):
+            yield part
+        else:
+            yield from iter_file_range(path, *part)
+
+
+def stream_file(environ, path, request_headers, mimetype=None, cache_control=IMMUTABLE_CACHE_CONTROL):
+    """Build a 200/206/304/416 response for `path`, honouring conditional
+    requests, Range and If-Range"""
+    status, headers, parts = plan_file_response(path, request_headers, mimetype, cache_control)
+
+    # A single slice running to EOF can go to the server's wsgi.file_wrapper,
+    # which gunicorn turns into sendfile(); anything else uses a bounded generator
+    file_wrapper = environ.get('wsgi.file_wrapper')
+    if (file_wrapper is not None and len(parts) == 1 and isinstance(parts[0], tuple)
+            and sum(parts[0]) == os.path.getsize(path)):
+        f = open(path, 'rb')
+        f.seek(parts[0][0])
+        body = file_wrapper(f, CHUNK_SIZE)
+    else:
+        body = _iter_parts(path, parts)
+
+    return Response(body, status, headers=headers, direct_passthrough=True)
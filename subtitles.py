@@ -0,0 +1,226 @@
+"""
+Subtitle normalisation.
+
+Browsers only accept WebVTT in <track>, and only as UTF-8. Every uploaded
+subtitle is converted once into a normalised .vtt artifact: SRT is parsed
+with pysrt and rewritten as WebVTT, VTT is re-encoded and given a proper
+header, and both are decoded with encoding detection first (BOMs, then
+UTF-8, then charset_normalizer's best guess, then cp1252). The artifact
+lives in SUBTITLE_CACHE_FOLDER and is served as a static file with
+validators, so no request ever parses a subtitle.
+
+For long subtitle files CueIndex answers "which cues overlap this time
+window" and full-text search from a parsed copy of the artifact, so a
+player can fetch the few cues around the playhead instead of the whole
+file.
+"""
+
+import os
+import re
+import uuid
+import codecs
+import bisect
+import threading
+from collections import OrderedDict
+
+import pysrt
+
+try:
+    from charset_normalizer import from_bytes
+except ImportError:  # pragma: no cover - shipped as a dependency of requests
+    from_bytes = None
+
+SUBTITLE_CACHE_FOLDER = os.environ.get('SUBTITLE_CACHE_DIR', 'cache/subtitles')
+CUE_INDEX_CACHE_SIZE = 32
+
+_BOMS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+# SRT styling WebVTT does not understand: <font ...> tags and ASS overrides like {\an8}
+_UNSUPPORTED_MARKUP = re.compile(r'</?font[^>]*>|\{\\[^}]*\}', re.IGNORECASE)
+_CUE_TIMING = re.compile(r'^((?:\d+:)?\d{1,2}:\d{2}\.\d{3})\s+-->\s+((?:\d+:)?\d{1,2}:\d{2}\.\d{3})(.*)$')
+_TAGS = re.compile(r'<[^>]+>')
+
+
+class SubtitleError(ValueError):
+    pass
+
+
+def decode(raw):
+    """Decode subtitle bytes, guessing the encoding when there is no BOM"""
+    for bom, encoding in _BOMS:
+        if raw.startswith(bom):
+            return raw.decode(encoding)
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    if from_bytes is not None:
+        best = from_bytes(raw).best()
+        if best is not None:
+            return str(best)
+    return raw.decode('cp1252', errors='replace')
+
+
+def _timestamp(t):
+    return f'{t.hours:02d}:{t.minutes:02d}:{t.seconds:02d}.{t.milliseconds:03d}'
+
+
+def srt_to_vtt(text):
+    subs = pysrt.from_string(text)
+    if not subs:
+        raise SubtitleError('No subtitle cues found')
+
+    out = ['WEBVTT', '']
+    for item in subs:
+        cue_text = _UNSUPPORTED_MARKUP.sub('', item.text).strip()
+        # A blank line would end the cue early
+        cue_text = re.sub(r'\n\s*\n', '\n', cue_text)
+        out.append(f'{_timestamp(item.start)} --> {_timestamp(item.end)}')
+        out.append(cue_text)
+        out.append('')
+    return '\n'.join(out)
+
+
+def normalize_vtt(text):
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    if not text.startswith('WEBVTT'):
+        if '-->' not in text:
+            raise SubtitleError('Not a WebVTT file')
+        text = 'WEBVTT\n\n' + text
+    return text
+
+
+def convert(source_path):
+    """Return normalised WebVTT text for an uploaded .srt or .vtt file"""
+    with open(source_path, 'rb') as f:
+        text = decode(f.read())
+    if source_path.lower().endswith('.srt'):
+        return srt_to_vtt(text)
+    return normalize_vtt(text)
+
+
+def artifact_path(filename):
+    # Keep the source extension so name.srt and name.vtt never share an artifact
+    return os.path.join(SUBTITLE_CACHE_FOLDER, filename + '.vtt')
+
+
+def ensure_vtt(source_path):
+    """Path of the cached WebVTT artifact for `source_path`, converting it
+    if the artifact is missing or older than the source"""
+    target = artifact_path(os.path.basename(source_path))
+    try:
+        if os.path.getmtime(target) >= os.path.getmtime(source_path):
+            return target
+    except FileNotFoundError:
+        pass
+
+    text = convert(source_path)
+    os.makedirs(SUBTITLE_CACHE_FOLDER, exist_ok=True)
+    # Write then rename, so concurrent first requests never see a partial file
+    tmp_path = f'{target}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+        f.write(text)
+    os.replace(tmp_path, target)
+    return target
+
+
+def remove_artifact(filename):
+    try:
+        os.remove(artifact_path(filename))
+    except FileNotFoundError:
+        pass
+
+
+def _seconds(timestamp):
+    seconds = 0.0
+    for part in timestamp.split(':'):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+class CueIndex:
+    """Cues of one WebVTT file sorted by start time.
+
+    `max_ends[i]` is the latest end time among cues 0..i. It never
+    decreases, so the first cue that can still be showing at time t is
+    found by bisecting it, even when long cues overlap shorter ones."""
+
+    def __init__(self, cues):
+        cues.sort(key=lambda cue: (cue['start'], cue['end']))
+        for i, cue in enumerate(cues):
+            cue['id'] = i
+        self.cues = cues
+        self.starts = [cue['start'] for cue in cues]
+        self.max_ends = []
+        latest = 0.0
+        for cue in cues:
+            latest = max(latest, cue['end'])
+            self.max_ends.append(latest)
+        self._search_text = [_TAGS.sub('', cue['text']).lower() for cue in cues]
+
+    @classmethod
+    def from_vtt(cls, text):
+        cues = []
+        for block in re.split(r'\n\s*\n', text.replace('\r\n', '\n')):
+            lines = block.strip('\n').split('\n')
+            for i, line in enumerate(lines):
+                match = _CUE_TIMING.match(line.strip())
+                if match:
+                    cues.append({
+                        'start': _seconds(match.group(1)),
+                        'end': _seconds(match.group(2)),
+                        'settings': match.group(3).strip(),
+                        'text': '\n'.join(lines[i + 1:]),
+                    })
+                    break
+        return cls(cues)
+
+    def window(self, start, end, limit=None):
+        """Cues that are on screen at some point in [start, end)"""
+        lo = bisect.bisect_right(self.max_ends, start)
+        hi = bisect.bisect_left(self.starts, end)
+        result = [cue for cue in self.cues[lo:hi] if cue['end'] > start]
+        return result if limit is None else result[:max(limit, 0)]
+
+    def search(self, query, limit=50):
+        query = query.lower().strip()
+        if not query:
+            return []
+        result = []
+        for i, text in enumerate(self._search_text):
+            if query in text:
+                result.append(self.cues[i])
+                if len(result) >= limit:
+                    break
+        return result
+
+    def __len__(self):
+        return len(self.cues)
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def cue_index(source_path):
+    """CueIndex for an uploaded subtitle, built from its WebVTT artifact
+    and kept in a small per-process LRU until the artifact changes"""
+    path = ensure_vtt(source_path)
+    key = (path, os.stat(path).st_mtime_ns)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+
+    with open(path, encoding='utf-8') as f:
+        index = CueIndex.from_vtt(f.read())
+
+    with _indexes_lock:
+        _indexes[key] = index
+        while len(_indexes) > CUE_INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
@@ -0,0 +1,61 @@
+import io
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    # Folders and the database are relative to the working directory, which
+    # must be a scratch one before app is first imported
+    previous = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('app'))
+    try:
+        import app
+        app.init_db()
+        yield app
+    finally:
+        os.chdir(previous)
+
+
+class FrozenDatetime(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 1, 1, 12, 0, 0)
+
+
+def test_same_second_uploads_keep_their_own_files(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'datetime', FrozenDatetime)
+    client = app_module.app.test_client()
+
+    bodies = [b'first upload', b'second upload']
+    responses = [client.post('/upload', data={'file': (io.BytesIO(body), 'clip.mp3')}) for body in bodies]
+
+    assert [response.status_code for response in responses] == [200, 200]
+    filenames = [response.get_json()['filename'] for response in responses]
+    assert filenames[0] != filenames[1]
+    for filename, body in zip(filenames, bodies):
+        streamed = client.get(f'/stream/{filename}')
+        assert streamed.status_code == 200
+        assert streamed.data == body
+
+
+def test_same_second_recordings_keep_their_own_files(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'datetime', FrozenDatetime)
+    client = app_module.app.test_client()
+
+    bodies = [b'\x1a\x45\xdf\xa3 one', b'\x1a\x45\xdf\xa3 two']
+    responses = [client.post('/upload_recording', data={'file': (io.BytesIO(body), 'blob'), 'type': 'audio'})
+                 for body in bodies]
+
+    assert [response.status_code for response in responses] == [200, 200]
+    filenames = [response.get_json()['filename'] for response in responses]
+    assert filenames[0] != filenames[1]
+    for filename, body in zip(filenames, bodies):
+        with open(os.path.join(app_module.UPLOAD_FOLDER, filename), 'rb') as f:
+            assert f.read() == body
@@ -0,0 +1,410 @@
+"""
+Background transcoding of uploads into an HLS bitrate ladder.
+
+Every uploaded video or audio item gets a row in transcode_jobs. Workers
+claim queued jobs highest priority first and run one ffmpeg process per
+job, which decodes the source once and encodes every rung of LADDER at or
+below the source height (audio gets a single AAC rendition) into
+TRANSCODE_DIR/<media_id>/master.m3u8 plus one media playlist per rung.
+
+The queue is shared by every process through SQLite: a job is claimed in
+a BEGIN IMMEDIATE transaction that also counts running jobs, so at most
+WORKERS ffmpeg processes run at once however many web workers or
+transcode_worker.py instances are polling. Each runs at a lowered CPU
+priority with THREADS decoder threads, one filter thread, and THREADS
+encoder threads shared out between its rungs (at least one per rung). Running jobs report progress
+and a heartbeat every few seconds. A job whose heartbeat stops (its
+process died) is put back in the queue, up to MAX_ATTEMPTS tries.
+Cancelling a job, or deleting its media, makes the next heartbeat fail,
+and the worker kills ffmpeg. Output is written to a temporary directory
+and renamed into place when complete, so players never see a half-written
+ladder.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import threading
+import subprocess
+from werkzeug.security import safe_join
+
+import hls_packager
+
+OUTPUT_DIR = os.environ.get('TRANSCODE_DIR', 'transcodes')
+# Concurrent jobs across all processes, and decoder/encoder threads per job
+WORKERS = int(os.environ.get('TRANSCODE_WORKERS', 1))
+THREADS = int(os.environ.get('TRANSCODE_THREADS', 2))
+# Run workers inside the web app; set to 0 when transcode_worker.py runs them
+IN_APP = os.environ.get('TRANSCODE_IN_APP', '1') == '1'
+NICENESS = 10
+POLL_SECONDS = 5
+HEARTBEAT_SECONDS = 2
+STALE_AFTER = 60
+MAX_ATTEMPTS = 3
+SEGMENT_SECONDS = hls_packager.SEGMENT_SECONDS
+# (name, height, video kbit/s), highest first
+LADDER = [
+    ('1080p', 1080, 5000),
+    ('720p', 720, 2800),
+    ('480p', 480, 1400),
+    ('360p', 360, 800),
+]
+# Rungs used when the source height could not be read
+UNKNOWN_HEIGHT_MAX = 720
+AUDIO_BITRATE = 128
+TRANSCODED_TYPES = ('video', 'audio')
+# Formats browsers cannot play at all are transcoded first
+BROWSER_PLAYABLE = ('video/mp4', 'video/webm', 'audio/mpeg', 'audio/mp4', 'audio/ogg', 'audio/webm',
+                    'audio/wav', 'audio/x-wav', 'audio/flac')
+PRIORITY_UNPLAYABLE = 10
+
+_STREAM = re.compile(r'Stream #\d+:\d+.*?: (Video|Audio): (.*)')
+_SIZE = re.compile(r'\b(\d{2,5})x(\d{2,5})\b')
+_DURATION = re.compile(r'Duration: (\d+):(\d\d):(\d\d(?:\.\d+)?)')
+
+
+def default_priority(mime_type):
+    return 0 if mime_type in BROWSER_PLAYABLE else PRIORITY_UNPLAYABLE
+
+
+def enqueue(conn, media_id, priority=0):
+    """Queue a transcode of `media_id` in the caller's transaction. An
+    existing job just takes the new priority; a failed or cancelled one is
+    queued again. Returns the job id."""
+    conn.execute('''INSERT INTO transcode_jobs (media_id, priority) VALUES (?, ?)
+                    ON CONFLICT(media_id) DO UPDATE SET
+                        priority = excluded.priority,
+                        status = CASE WHEN status IN ('failed', 'cancelled') THEN 'queued' ELSE status END,
+                        attempts = CASE WHEN status IN ('failed', 'cancelled') THEN 0 ELSE attempts END,
+                        error = CASE WHEN status IN ('failed', 'cancelled') THEN NULL ELSE error END''',
+                 (media_id, priority))
+    return conn.execute('SELECT id FROM transcode_jobs WHERE media_id = ?', (media_id,)).fetchone()[0]
+
+
+def _job_dict(row):
+    job = dict(row)
+    job['renditions'] = json.loads(job['renditions']) if job['renditions'] else []
+    return job
+
+
+def job_for_media(conn, media_id):
+    row = conn.execute('SELECT * FROM transcode_jobs WHERE media_id = ?', (media_id,)).fetchone()
+    return _job_dict(row) if row else None
+
+
+def list_jobs(conn, status=None, limit=100):
+    """Jobs in queue order: running first, then queued by priority, then
+    the most recently finished"""
+    query = '''SELECT j.*, m.filename FROM transcode_jobs j JOIN media m ON m.id = j.media_id'''
+    params = []
+    if status:
+        query += ' WHERE j.status = ?'
+        params.append(status)
+    query += ''' ORDER BY CASE j.status WHEN 'running' THEN 0 WHEN 'queued' THEN 1 ELSE 2 END,
+                 j.priority DESC, COALESCE(j.finished_at, 0) DESC, j.id LIMIT ?'''
+    params.append(limit)
+    return [_job_dict(row) for row in conn.execute(query, params)]
+
+
+def cancel(conn, job_id):
+    """Cancel a queued or running job. Returns False if it had already ended."""
+    cursor = conn.execute('''UPDATE transcode_jobs SET status = 'cancelled', worker = NULL, finished_at = ?
+                             WHERE id = ? AND status IN ('queued', 'running')''', (time.time(), job_id))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def recover(conn):
+    """Requeue running jobs whose worker stopped sending heartbeats.
+    Returns the number of jobs recovered."""
+    cursor = conn.execute('''UPDATE transcode_jobs
+                             SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                                 error = 'Worker stopped responding', worker = NULL
+                             WHERE status = 'running' AND heartbeat_at < ?''',
+                          (MAX_ATTEMPTS, time.time() - STALE_AFTER))
+    conn.commit()
+    return cursor.rowcount
+
+
+def _claim(conn, worker):
+    """Mark the next queued job as running under `worker`, unless WORKERS
+    jobs are running already. Returns the job joined with its media, or None."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        job = None
+        running = conn.execute("SELECT COUNT(*) FROM transcode_jobs WHERE status = 'running'").fetchone()[0]
+        if running < WORKERS:
+            job = conn.execute('''SELECT j.id, j.media_id, j.attempts, m.filename, m.file_type
+                                  FROM transcode_jobs j JOIN media m ON m.id = j.media_id
+                                  WHERE j.status = 'queued' ORDER BY j.priority DESC, j.id LIMIT 1''').fetchone()
+        if job is not None:
+            now = time.time()
+            conn.execute('''UPDATE transcode_jobs SET status = 'running', worker = ?, attempts = attempts + 1,
+                            progress = 0, error = NULL, heartbeat_at = ?, started_at = ?, finished_at = NULL
+                            WHERE id = ?''', (worker, now, now, job['id']))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return job
+
+
+def _heartbeat(conn, job_id, worker, progress):
+    """Returns False once the job is no longer ours (cancelled, deleted or
+    recovered by another worker)"""
+    cursor = conn.execute('''UPDATE transcode_jobs SET heartbeat_at = ?, progress = ?
+                             WHERE id = ? AND worker = ? AND status = 'running' ''',
+                          (time.time(), progress, job_id, worker))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def _output_dir(media_id):
+    return os.path.join(OUTPUT_DIR, str(int(media_id)))
+
+
+def _tmp_dir(media_id):
+    return _output_dir(media_id) + '.tmp'
+
+
+def output_file(media_id, name):
+    """Path of a transcoded file (master.m3u8, <rung>/index.m3u8, segments),
+    or None if it does not exist"""
+    path = safe_join(_output_dir(media_id), name)
+    return path if path is not None and os.path.isfile(path) else None
+
+
+def remove_outputs(media_ids):
+    for media_id in media_ids:
+        shutil.rmtree(_output_dir(media_id), ignore_errors=True)
+        shutil.rmtree(_tmp_dir(media_id), ignore_errors=True)
+
+
+def inspect(source):
+    """(has_video, has_audio, height, duration) as reported by ffmpeg"""
+    result = subprocess.run([hls_packager.FFMPEG, '-hide_banner', '-nostdin', '-i', source],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=30)
+    info = result.stderr.decode('utf-8', 'replace')
+    has_video = has_audio = False
+    height = duration = None
+    for kind, details in _STREAM.findall(info):
+        if kind == 'Audio':
+            has_audio = True
+        elif 'attached pic' not in details and not has_video:
+            # Cover art in audio files shows up as a video stream
+            has_video = True
+            size = _SIZE.search(details)
+            height = int(size.group(2)) if size else None
+    match = _DURATION.search(info)
+    if match:
+        duration = int(match.group(1)) * 3600 + int(match.group(2)) * 60 + float(match.group(3))
+    return has_video, has_audio, height, duration
+
+
+def ladder(height):
+    """Rungs of LADDER for a source `height` (None if unknown)"""
+    if height is None:
+        return [rung for rung in LADDER if rung[1] <= UNKNOWN_HEIGHT_MAX]
+    rungs = [rung for rung in LADDER if rung[1] <= height]
+    if not rungs:
+        # Smaller than the lowest rung: one rendition at the source height
+        _, _, bitrate = LADDER[-1]
+        rungs = [(f'{height - height % 2}p', height - height % 2, bitrate)]
+    return rungs
+
+
+def _ffmpeg_args(source, tmp_dir, rungs, has_audio):
+    args = [hls_packager.FFMPEG, '-nostdin', '-loglevel', 'error', '-progress', 'pipe:1', '-nostats',
+            '-threads', str(THREADS), '-i', source, '-filter_complex_threads', '1']
+    streams = []
+    if rungs:
+        # THREADS shared out between the rungs' encoders (at least one each)
+        encoder_threads = [max(1, THREADS // len(rungs) + (i < THREADS % len(rungs))) for i in range(len(rungs))]
+        splits = ''.join(f'[s{i}]' for i in range(len(rungs)))
+        scales = ';'.join(f'[s{i}]scale=-2:{height}[v{i}]' for i, (_, height, _) in enumerate(rungs))
+        args += ['-filter_complex', f'[0:v:0]split={len(rungs)}{splits};{scales}']
+        for i, (name, _, bitrate) in enumerate(rungs):
+            args += ['-map', f'[v{i}]']
+            if has_audio:
+                args += ['-map', '0:a:0']
+            args += [f'-b:v:{i}', f'{bitrate}k', f'-maxrate:v:{i}', f'{bitrate * 3 // 2}k',
+                     f'-bufsize:v:{i}', f'{bitrate * 2}k', f'-threads:v:{i}', str(encoder_threads[i])]
+            streams.append(f'v:{i},a:{i},name:{name}' if has_audio else f'v:{i},name:{name}')
+        # Keyframes on segment boundaries so every rung switches cleanly
+        args += ['-c:v', 'libx264', '-preset', 'veryfast', '-profile:v', 'main', '-pix_fmt', 'yuv420p',
+                 '-sc_threshold', '0', '-force_key_frames', f'expr:gte(t,n_forced*{SEGMENT_SECONDS})']
+    else:
+        args += ['-map', '0:a:0']
+        streams.append('a:0,name:audio')
+    if has_audio:
+        args += ['-c:a', 'aac', '-b:a', f'{AUDIO_BITRATE}k', '-ac', '2']
+    args += ['-f', 'hls', '-hls_time', str(SEGMENT_SECONDS), '-hls_playlist_type', 'vod',
+             '-hls_flags', 'independent_segments',
+             '-hls_segment_filename', os.path.join(tmp_dir, '%v', '%05d.ts'),
+             '-master_pl_name', 'master.m3u8', '-var_stream_map', ' '.join(streams),
+             os.path.join(tmp_dir, '%v', 'index.m3u8')]
+    return args
+
+
+def _lower_priority(pid):
+    try:
+        os.setpriority(os.PRIO_PROCESS, pid, NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+
+def _tree_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class TranscodeWorker:
+    """Runs queued jobs on WORKERS threads per process, each supervising
+    one ffmpeg child. The global limit is enforced when claiming, so
+    starting workers in several processes never exceeds it."""
+
+    def __init__(self, connect, media_folder):
+        self.connect = connect
+        self.media_folder = media_folder
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker_pid = None
+        self._stats = {'done': 0, 'failed': 0, 'cancelled': 0}
+
+    def start(self):
+        """Start this process's worker threads (once per process)"""
+        pid = os.getpid()
+        if self._worker_pid == pid or not hls_packager.available():
+            return
+        with self._lock:
+            if self._worker_pid == pid:
+                return
+            self._worker_pid = pid
+        for _ in range(WORKERS):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def wake(self):
+        """Look for work now rather than at the next poll"""
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                ran = self.run_once()
+            except (sqlite3.Error, OSError):
+                ran = False
+            if not ran:
+                self._wake.wait(POLL_SECONDS)
+                self._wake.clear()
+
+    def run_once(self):
+        """Claim and run one job. Returns False if there was none to run."""
+        conn = self.connect()
+        try:
+            recover(conn)
+            worker = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+            job = _claim(conn, worker)
+            if job is None:
+                return False
+            self._transcode(conn, job, worker)
+            return True
+        finally:
+            conn.close()
+
+    def _transcode(self, conn, job, worker):
+        media_id = job['media_id']
+        source = os.path.join(self.media_folder, job['filename'])
+        tmp_dir = _tmp_dir(media_id)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        try:
+            has_video, has_audio, height, duration = inspect(source)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            return self._finish_failed(conn, job, worker, tmp_dir, f'Could not read source: {e}')
+        if not has_video and not has_audio:
+            return self._finish_failed(conn, job, worker, tmp_dir, 'No audio or video stream found', final=True)
+
+        rungs = ladder(height) if has_video and job['file_type'] == 'video' else []
+        for name in [rung[0] for rung in rungs] or ['audio']:
+            os.makedirs(os.path.join(tmp_dir, name))
+
+        log_path = os.path.join(tmp_dir, 'ffmpeg.log')
+        with open(log_path, 'wb') as log:
+            process = subprocess.Popen(_ffmpeg_args(source, tmp_dir, rungs, has_audio),
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=log)
+        _lower_priority(process.pid)
+
+        progress = 0
+        last_beat = time.monotonic()
+        cancelled = False
+        for line in process.stdout:
+            if line.startswith(b'out_time_us=') and duration:
+                try:
+                    progress = min(int(line[12:]) / 1e6 / duration, 0.99)
+                except ValueError:
+                    pass
+            if time.monotonic() - last_beat >= HEARTBEAT_SECONDS:
+                last_beat = time.monotonic()
+                if not _heartbeat(conn, job['id'], worker, progress):
+                    cancelled = True
+                    process.kill()
+                    break
+        process.stdout.close()
+        returncode = process.wait()
+
+        if cancelled:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            self._count('cancelled')
+            return
+        if returncode != 0:
+            with open(log_path, 'rb') as log:
+                lines = log.read().decode('utf-8', 'replace').strip().splitlines()
+            return self._finish_failed(conn, job, worker, tmp_dir,
+                                       lines[-1] if lines else f'ffmpeg exited with {returncode}')
+
+        os.remove(log_path)
+        output_bytes = _tree_size(tmp_dir)
+        final_dir = _output_dir(media_id)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+        renditions = [{'name': name, 'height': height, 'bitrate': bitrate} for name, height, bitrate in rungs] \
+            or [{'name': 'audio', 'height': None, 'bitrate': AUDIO_BITRATE}]
+        cursor = conn.execute('''UPDATE transcode_jobs SET status = 'done', progress = 1, worker = NULL,
+                                 renditions = ?, output_bytes = ?, finished_at = ?
+                                 WHERE id = ? AND worker = ? AND status = 'running' ''',
+                              (json.dumps(renditions), output_bytes, time.time(), job['id'], worker))
+        conn.commit()
+        if cursor.rowcount == 0:
+            # Cancelled or deleted while the last segments were written
+            shutil.rmtree(final_dir, ignore_errors=True)
+            self._count('cancelled')
+            return
+        self._count('done')
+
+    def _finish_failed(self, conn, job, worker, tmp_dir, error, final=False):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        conn.execute('''UPDATE transcode_jobs
+                        SET status = CASE WHEN ? OR attempts >= ? THEN 'failed' ELSE 'queued' END,
+                            error = ?, worker = NULL, finished_at = ?
+                        WHERE id = ? AND worker = ? AND status = 'running' ''',
+                     (final, MAX_ATTEMPTS, error[:500], time.time(), job['id'], worker))
+        conn.commit()
+        self._count('failed')
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+        snapshot['running_here'] = self._worker_pid == os.getpid()
+        return snapshot
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Transcode worker for deployments that keep ffmpeg out of the web workers
+Set TRANSCODE_IN_APP=0 for the app and run this alongside it
+Pass --once to work through the queue and exit (for scheduled tasks)
+"""
+
+import sys
+import time
+import sqlite3
+import db
+import transcode
+import hls_packager
+
+# Configuration
+UPLOAD_FOLDER = 'static/uploads'
+DATABASE = 'mediafusion.db'
+
+def connect():
+    conn = db.connect(DATABASE)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def drain(worker):
+    """Run jobs until none is left to claim. Returns the number run."""
+    ran = 0
+    while worker.run_once():
+        ran += 1
+    return ran
+
+if __name__ == '__main__':
+    if not hls_packager.available():
+        print("✗ ffmpeg not found; install it or set FFMPEG_BINARY")
+        sys.exit(1)
+    
+    worker = transcode.TranscodeWorker(connect, UPLOAD_FOLDER)
+    if '--once' in sys.argv:
+        ran = drain(worker)
+        print(f"Jobs run: {ran}")
+        print(f"Summary: {worker.stats()}")
+        sys.exit(0)
+    
+    print(f"Transcoding with up to {transcode.WORKERS} job(s) at a time, Ctrl+C to stop...")
+    worker.start()
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print(f"\nStopped. Summary: {worker.stats()}")
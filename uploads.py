@@ -0,0 +1,196 @@
+"""
+Resumable, chunked uploads.
+
+A tus-style protocol that streams request bodies straight to disk:
+
+    POST   /uploads              declare name and size, get an upload id
+    PATCH  /uploads/<id>         append bytes at Upload-Offset
+    HEAD   /uploads/<id>         current Upload-Offset, to resume after a drop
+    POST   /uploads/<id>/finish  move the completed file into place
+    DELETE /uploads/<id>         abandon the upload
+
+Chunks are appended to a .part file outside the public static folder and
+the finished file is renamed into the blob store, so every byte is written
+once. The declared size is checked against MAX_FILE_SIZE when the upload is
+created, and each PATCH stops reading as soon as it would run past the
+declared size. The part file's length is the authoritative offset, so an
+interrupted PATCH keeps whatever reached the disk and the client resumes
+from there.
+
+The content digest used by the blob store is computed while chunks arrive.
+Hash state lives in the worker that received the previous chunk; a chunk
+landing on another worker (or after a restart) first rehashes the bytes
+already on disk.
+"""
+
+import os
+import time
+import uuid
+import fcntl
+import threading
+import blobstore
+
+PARTS_FOLDER = os.environ.get('UPLOAD_PARTS_DIR', 'cache/uploads')
+CHUNK_SIZE = 64 * 1024
+# Unfinished uploads untouched for this long are removed by prune_stale()
+STALE_AFTER = int(os.environ.get('UPLOAD_STALE_AFTER', 24 * 3600))
+
+# upload id -> (offset, hasher) for uploads this worker has been receiving
+_hashers = {}
+_hashers_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """An upload request that cannot be honoured; `status` is the HTTP status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def part_path(upload_id):
+    return os.path.join(PARTS_FOLDER, f'{upload_id}.part')
+
+
+def current_offset(upload_id):
+    try:
+        return os.path.getsize(part_path(upload_id))
+    except FileNotFoundError:
+        return 0
+
+
+def create(conn, filename, original_name, file_type, mime_type, upload_length):
+    """Register a new upload and its empty part file. Returns the upload id."""
+    upload_id = uuid.uuid4().hex
+    os.makedirs(PARTS_FOLDER, exist_ok=True)
+    open(part_path(upload_id), 'wb').close()
+
+    conn.execute('''INSERT INTO upload_sessions (id, filename, original_name, file_type, mime_type, upload_length)
+                    VALUES (?, ?, ?, ?, ?, ?)''',
+                 (upload_id, filename, original_name, file_type, mime_type, upload_length))
+    conn.commit()
+    return upload_id
+
+
+def get(conn, upload_id):
+    return conn.execute('SELECT * FROM upload_sessions WHERE id = ?', (upload_id,)).fetchone()
+
+
+def _take_hasher(upload_id, offset):
+    with _hashers_lock:
+        state = _hashers.pop(upload_id, None)
+    if state is not None and state[0] == offset:
+        return state[1]
+    return blobstore.hash_file(part_path(upload_id), offset)
+
+
+def _keep_hasher(upload_id, offset, hasher):
+    with _hashers_lock:
+        _hashers[upload_id] = (offset, hasher)
+
+
+def append(session, stream, offset, content_length=None):
+    """Stream `stream` onto the part file, starting at `offset`, which must
+    match the bytes already received. Returns the new offset."""
+    upload_length = session['upload_length']
+    if content_length is not None and offset + content_length > upload_length:
+        raise UploadError('Chunk runs past the declared upload size', 413)
+
+    try:
+        part = open(part_path(session['id']), 'r+b')
+    except FileNotFoundError:
+        raise UploadError('Upload not found', 404)
+
+    with part:
+        # One writer per upload, across threads and worker processes
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Another request is writing to this upload', 409)
+
+        received = os.fstat(part.fileno()).st_size
+        if offset != received:
+            raise UploadError(f'Upload-Offset {offset} does not match {received}', 409)
+
+        hasher = _take_hasher(session['id'], received)
+        part.seek(received)
+        try:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                if received + len(chunk) > upload_length:
+                    # Keep what is valid and drop the rest of this request
+                    chunk = chunk[:upload_length - received]
+                    part.write(chunk)
+                    hasher.update(chunk)
+                    received += len(chunk)
+                    raise UploadError('Upload exceeds its declared size', 413)
+                part.write(chunk)
+                hasher.update(chunk)
+                received += len(chunk)
+        finally:
+            part.flush()
+            # Even a dropped connection leaves a consistent (offset, hash) pair
+            _keep_hasher(session['id'], received, hasher)
+    return received
+
+
+def finish(conn, session):
+    """Close a fully received upload and forget the session.
+    Returns (part file path, content digest); the caller moves the file on."""
+    try:
+        part = open(part_path(session['id']), 'rb')
+    except FileNotFoundError:
+        raise UploadError('Upload was already finished or cancelled', 409)
+
+    with part:
+        # Not while a PATCH is still writing, nor alongside another finish
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Another request is writing to this upload', 409)
+
+        received = os.fstat(part.fileno()).st_size
+        if received != session['upload_length']:
+            raise UploadError(f"Upload incomplete: {received} of {session['upload_length']} bytes", 409)
+
+        digest = _take_hasher(session['id'], received).hexdigest()
+        # A finish that read the session before this one deleted it loses here
+        claimed = conn.execute('DELETE FROM upload_sessions WHERE id = ?', (session['id'],)).rowcount
+        conn.commit()
+        if not claimed:
+            raise UploadError('Upload was already finished or cancelled', 409)
+    return part_path(session['id']), digest
+
+
+def discard(conn, upload_id):
+    with _hashers_lock:
+        _hashers.pop(upload_id, None)
+    try:
+        os.remove(part_path(upload_id))
+    except FileNotFoundError:
+        pass
+    conn.execute('DELETE FROM upload_sessions WHERE id = ?', (upload_id,))
+    conn.commit()
+
+
+def find_stale(conn, max_age=STALE_AFTER):
+    """Ids of uploads whose part file has not grown for `max_age` seconds"""
+    cutoff = time.time() - max_age
+    stale = []
+    for row in conn.execute('SELECT id FROM upload_sessions').fetchall():
+        try:
+            if os.path.getmtime(part_path(row[0])) < cutoff:
+                stale.append(row[0])
+        except FileNotFoundError:
+            stale.append(row[0])
+    return stale
+
+
+def prune_stale(conn, max_age=STALE_AFTER):
+    """Drop stale uploads (see find_stale). Returns the number removed."""
+    stale = find_stale(conn, max_age)
+    for upload_id in stale:
+        discard(conn, upload_id)
+    return len(stale)
@@ -0,0 +1,121 @@
+"""
+Shared upstream HTTP client for the proxy endpoints.
+
+proxy_resource, proxy_browse and parse_playlist all go through one
+requests.Session per worker process, so keep-alive connections to an
+origin are reused across requests instead of paying a fresh TCP+TLS
+handshake for every HLS segment.
+"""
+
+import os
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.retry import Retry
+
+POOL_CONNECTIONS = int(os.environ.get('UPSTREAM_POOL_CONNECTIONS', 20))
+POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', 32))
+MAX_RETRIES = int(os.environ.get('UPSTREAM_MAX_RETRIES', 2))
+BACKOFF_FACTOR = float(os.environ.get('UPSTREAM_BACKOFF_FACTOR', 0.3))
+CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 5))
+
+_stats = {'requests': 0, 'pool_hits': 0, 'pool_misses': 0}
+_stats_lock = threading.Lock()
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def _count(key):
+    with _stats_lock:
+        _stats[key] += 1
+
+
+class _CountingMixin:
+    """Counts connection checkouts. A checkout is a hit when the pool hands
+    back a connection whose socket is still open; new or dropped
+    connections have no socket yet and will need a fresh handshake."""
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout=timeout)
+        _count('pool_hits' if getattr(conn, 'sock', None) is not None else 'pool_misses')
+        return conn
+
+
+class _CountingHTTPConnectionPool(_CountingMixin, HTTPConnectionPool):
+    pass
+
+
+class _CountingHTTPSConnectionPool(_CountingMixin, HTTPSConnectionPool):
+    pass
+
+
+class _PooledAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool
+        }
+
+
+def _build_session():
+    retry = Retry(
+        total=MAX_RETRIES,
+        connect=MAX_RETRIES,
+        read=MAX_RETRIES,
+        status=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD', 'OPTIONS']),
+        raise_on_status=False
+    )
+    adapter = _PooledAdapter(pool_connections=POOL_CONNECTIONS,
+                             pool_maxsize=POOL_MAXSIZE,
+                             max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Return this worker's shared session, rebuilding it after a fork so
+    pooled sockets are never shared between processes."""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def request(method, url, read_timeout=30, **kwargs):
+    """Issue a request through the shared pool with separate connect/read timeouts"""
+    _count('requests')
+    kwargs.setdefault('timeout', (CONNECT_TIMEOUT, read_timeout))
+    return get_session().request(method, url, **kwargs)
+
+
+def get(url, read_timeout=30, **kwargs):
+    return request('GET', url, read_timeout=read_timeout, **kwargs)
+
+
+def head(url, read_timeout=30, **kwargs):
+    return request('HEAD', url, read_timeout=read_timeout, **kwargs)
+
+
+def stats():
+    """Snapshot of this worker's pool counters"""
+    with _stats_lock:
+        snapshot = dict(_stats)
+    checkouts = snapshot['pool_hits'] + snapshot['pool_misses']
+    snapshot['hit_ratio'] = round(snapshot['pool_hits'] / checkouts, 3) if checkouts else None
+    snapshot['pid'] = os.getpid()
+    snapshot['pool_connections'] = POOL_CONNECTIONS
+    snapshot['pool_maxsize'] = POOL_MAXSIZE
+    return snapshot
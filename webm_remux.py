@@ -0,0 +1,600 @@
+"""
+Remuxing of browser recordings into seekable WebM.
+
+MediaRecorder writes WebM as a live stream: the Segment and often every
+Cluster have unknown sizes, Info carries no Duration and there are no
+Cues, so a player cannot seek without reading the whole file. remux()
+rewrites such a file without touching the coded frames:
+
+    EBML header | Segment (sized) | SeekHead | Info (+Duration) | Tracks |
+    Cues | Clusters (sized) | anything else the source had
+
+Cues sit in front of the clusters, so the player gets them with its first
+range request, and a seek afterwards is one range request at the cluster
+the cue points to. The source is read with seeks: one pass indexes the
+clusters and keyframes, a second copies cluster bodies through in chunks,
+so memory does not grow with the recording. A tail cut off mid-block (a
+recorder that stopped abruptly) is dropped.
+
+RemuxQueue runs this on a background thread per worker after upload and
+swaps the result into the blob store, so the stored file is replaced
+atomically and uploads return without waiting.
+"""
+
+import os
+import time
+import queue
+import struct
+import sqlite3
+import threading
+
+import blobstore
+from probe import (ProbeError, read_vint, iter_elements, probe_matroska, EBML_HEADER, MKV_SEGMENT, MKV_INFO,
+                   MKV_TIMECODE_SCALE, MKV_DURATION, MKV_TRACKS, MKV_TRACK_ENTRY, MKV_TRACK_TYPE, MKV_CLUSTER,
+                   MKV_TIMECODE, MKV_SIMPLE_BLOCK, MKV_BLOCK_GROUP, MKV_BLOCK)
+
+MKV_SEEK_HEAD = 0x114D9B74
+MKV_SEEK = 0x4DBB
+MKV_SEEK_ID = 0x53AB
+MKV_SEEK_POSITION = 0x53AC
+MKV_CUES = 0x1C53BB6B
+MKV_CUE_POINT = 0xBB
+MKV_CUE_TIME = 0xB3
+MKV_CUE_TRACK_POSITIONS = 0xB7
+MKV_CUE_TRACK = 0xF7
+MKV_CUE_CLUSTER_POSITION = 0xF1
+MKV_CUE_RELATIVE_POSITION = 0xF0
+MKV_TRACK_NUMBER = 0xD7
+MKV_BLOCK_DURATION = 0x9B
+MKV_REFERENCE_BLOCK = 0xFB
+MKV_POSITION = 0xA7
+MKV_PREV_SIZE = 0xAB
+MKV_TAGS = 0x1254C367
+MKV_CHAPTERS = 0x1043A770
+MKV_ATTACHMENTS = 0x1941A469
+EBML_VOID = 0xEC
+EBML_CRC32 = 0xBF
+
+# Elements that can only appear directly under Segment; one of these ends
+# an unknown-size Cluster
+_LEVEL1 = (MKV_CLUSTER, MKV_CUES, MKV_TAGS, MKV_CHAPTERS, MKV_ATTACHMENTS, MKV_SEEK_HEAD, MKV_INFO, MKV_TRACKS)
+# Rewritten from scratch, or meaningless once positions change
+_DROPPED = (MKV_SEEK_HEAD, MKV_CUES, EBML_VOID, EBML_CRC32)
+_DROPPED_IN_CLUSTER = (MKV_POSITION, MKV_PREV_SIZE, EBML_VOID, EBML_CRC32)
+
+REMUX_MIME_TYPES = ('video/webm', 'audio/webm')
+# Recordings are stored under this prefix (app.recording_filename); other
+# WebM uploads come from encoders that already write Duration and Cues
+RECORDING_PREFIX = 'recording_'
+# Info/Tracks/SeekHead of any sane file fit in this much of its head
+HEAD_BYTES = 4 * 1024 * 1024
+COPY_CHUNK = 1024 * 1024
+READ_WINDOW = 256 * 1024
+# Width of sizes and positions that must be known before what they point at
+SIZE_WIDTH = 8
+# A row still 'remuxing' this long after its claim belongs to a dead worker
+STALE_AFTER = 3600
+# How often an idle worker sweeps for recordings not remuxed yet
+SWEEP_INTERVAL = 300
+
+
+class RemuxError(Exception):
+    pass
+
+
+# --- Reading -----------------------------------------------------------------
+
+
+class _Reader:
+    """Small reads at arbitrary positions, served from a read-ahead window
+    (blocks are scanned in file order, a few bytes of header each)"""
+
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        self._window = b''
+        self._window_pos = 0
+
+    def read(self, pos, length):
+        offset = pos - self._window_pos
+        if offset < 0 or offset + length > len(self._window):
+            self.f.seek(pos)
+            self._window = self.f.read(max(length, READ_WINDOW))
+            self._window_pos = pos
+            offset = 0
+        return self._window[offset:offset + length]
+
+    def header(self, pos):
+        """(id, size, body position) of the element at `pos`; size is None
+        for unknown. Raises ProbeError if the header runs past EOF."""
+        data = self.read(pos, 12)
+        if not data:
+            raise ProbeError('Unexpected end of file')
+        element_id, id_length = read_vint(data, 0, keep_marker=True)
+        size, size_length = read_vint(data, id_length)
+        return element_id, size, pos + id_length + size_length
+
+
+def _uint(data):
+    return int.from_bytes(data, 'big')
+
+
+def _block_info(reader, element_id, body, end):
+    """(track, relative timecode, keyframe, duration) of a SimpleBlock or BlockGroup"""
+    duration = None
+    keyframe = True
+    if element_id == MKV_BLOCK_GROUP:
+        block = None
+        pos = body
+        while pos < end:
+            child_id, child_size, child_body = reader.header(pos)
+            if child_id == MKV_BLOCK:
+                block = child_body
+            elif child_id == MKV_REFERENCE_BLOCK:
+                keyframe = False
+            elif child_id == MKV_BLOCK_DURATION:
+                duration = _uint(reader.read(child_body, child_size))
+            pos = child_body + child_size
+        if block is None:
+            raise ProbeError('BlockGroup without a Block')
+        body = block
+    data = reader.read(body, 12)
+    track, track_length = read_vint(data, 0)
+    timecode, flags = struct.unpack_from('>hB', data, track_length)
+    if element_id == MKV_SIMPLE_BLOCK:
+        keyframe = bool(flags & 0x80)
+    return track, timecode, keyframe, duration
+
+
+def _cue_track(tracks):
+    """Track number cues should index: the first video track, else the first track"""
+    numbers = {}
+    for element_id, body, body_end in iter_elements(tracks):
+        if element_id != MKV_TRACK_ENTRY:
+            continue
+        entry = {child_id: tracks[child:child_end]
+                 for child_id, child, child_end in iter_elements(tracks, body, body_end)}
+        if MKV_TRACK_NUMBER in entry:
+            numbers[_uint(entry[MKV_TRACK_NUMBER])] = _uint(entry.get(MKV_TRACK_TYPE, b'\x00'))
+    if not numbers:
+        raise RemuxError('No tracks')
+    return next((number for number, track_type in numbers.items() if track_type == 1), min(numbers))
+
+
+def _scan_cluster(reader, start, size, body, segment_end, cue_track, track_times):
+    """Index one Cluster. Returns (cluster, next position); next position
+    is None once the file turns out to be truncated."""
+    end = segment_end if size is None else min(body + size, segment_end)
+    cluster = {'timecode': None, 'ranges': [], 'length': 0, 'cue': None}
+    pos = body
+    while pos < end:
+        try:
+            element_id, child_size, child_body = reader.header(pos)
+        except ProbeError:
+            return cluster, None
+        if size is None and element_id in _LEVEL1:
+            return cluster, pos
+        if child_size is None or child_body + child_size > end:
+            # A block cut off by the end of the recording
+            return cluster, None
+        child_end = child_body + child_size
+
+        if element_id == MKV_TIMECODE:
+            cluster['timecode'] = _uint(reader.read(child_body, child_size))
+        elif element_id in (MKV_SIMPLE_BLOCK, MKV_BLOCK_GROUP):
+            if cluster['timecode'] is None:
+                raise RemuxError('Block before Cluster Timecode')
+            track, relative, keyframe, duration = _block_info(reader, element_id, child_body, child_end)
+            timecode = cluster['timecode'] + relative
+            previous = track_times.get(track)
+            if duration is None and previous is not None:
+                # Assume the last frame lasts as long as the one before it
+                duration = max(timecode - previous[0], 0)
+            if previous is None or timecode >= previous[0]:
+                track_times[track] = (timecode, duration or 0)
+            if cluster['cue'] is None and track == cue_track and keyframe:
+                cluster['cue'] = (timecode, cluster['length'])
+
+        if element_id not in _DROPPED_IN_CLUSTER:
+            ranges = cluster['ranges']
+            if ranges and ranges[-1][1] == pos:
+                ranges[-1] = (ranges[-1][0], child_end)
+            else:
+                ranges.append((pos, child_end))
+            cluster['length'] += child_end - pos
+        pos = child_end
+    return cluster, (end if size is None else body + size)
+
+
+def _scan(reader):
+    element_id, size, body = reader.header(0)
+    if element_id != EBML_HEADER or size is None:
+        raise RemuxError('Not an EBML file')
+    ebml_end = body + size
+
+    pos = ebml_end
+    while True:
+        element_id, size, body = reader.header(pos)
+        if element_id == MKV_SEGMENT:
+            break
+        if element_id != EBML_VOID or size is None:
+            raise RemuxError('Segment not found')
+        pos = body + size
+    segment_end = reader.size if size is None else min(body + size, reader.size)
+
+    layout = {'ebml_end': ebml_end, 'info': None, 'tracks': None, 'clusters': [], 'others': [],
+              'track_times': {}, 'truncated': False}
+    cue_track = None
+    pos = body
+    while pos is not None and pos < segment_end:
+        try:
+            element_id, size, body = reader.header(pos)
+        except ProbeError:
+            layout['truncated'] = True
+            break
+        if element_id == MKV_CLUSTER:
+            if cue_track is None:
+                raise RemuxError('Cluster before Tracks')
+            cluster, pos = _scan_cluster(reader, pos, size, body, segment_end, cue_track, layout['track_times'])
+            if cluster['length']:
+                layout['clusters'].append(cluster)
+            layout['truncated'] = layout['truncated'] or pos is None
+            continue
+        if size is None or body + size > segment_end:
+            layout['truncated'] = True
+            break
+        if element_id == MKV_INFO:
+            layout['info'] = reader.read(body, size)
+        elif element_id == MKV_TRACKS:
+            layout['tracks'] = reader.read(body, size)
+            cue_track = _cue_track(layout['tracks'])
+        elif element_id not in _DROPPED:
+            layout['others'].append((pos, body + size))
+        pos = body + size
+
+    if layout['info'] is None or layout['tracks'] is None:
+        raise RemuxError('Info or Tracks missing')
+    if not layout['clusters']:
+        raise RemuxError('No media data')
+    return layout
+
+
+def needs_remux(path):
+    """True if the file at `path` is Matroska/WebM lacking Duration or Cues"""
+    with open(path, 'rb') as f:
+        head = f.read(HEAD_BYTES)
+    if head[:4] != EBML_HEADER.to_bytes(4, 'big'):
+        return False
+    has_duration = has_cues = False
+    try:
+        for element_id, body, body_end in iter_elements(head):
+            if element_id != MKV_SEGMENT:
+                continue
+            for child_id, child, child_end in iter_elements(head, body, body_end):
+                if child_id == MKV_INFO:
+                    has_duration = any(i == MKV_DURATION for i, _, _ in iter_elements(head, child, child_end))
+                elif child_id == MKV_SEEK_HEAD:
+                    # Cues at the end of the file are listed here
+                    has_cues = has_cues or MKV_CUES.to_bytes(4, 'big') in head[child:child_end]
+                elif child_id == MKV_CUES:
+                    has_cues = True
+                elif child_id == MKV_CLUSTER:
+                    break
+            break
+    except (ProbeError, IndexError):
+        pass
+    return not (has_duration and has_cues)
+
+
+# --- Writing -----------------------------------------------------------------
+
+
+def _size_vint(size, width=None):
+    if width is None:
+        width = 1
+        while size >= (1 << (7 * width)) - 1:
+            width += 1
+    return ((1 << (7 * width)) | size).to_bytes(width, 'big')
+
+
+def _id_bytes(element_id):
+    return element_id.to_bytes((element_id.bit_length() + 7) // 8, 'big')
+
+
+def _element(element_id, payload):
+    return _id_bytes(element_id) + _size_vint(len(payload)) + payload
+
+
+def _uint_element(element_id, value, width=None):
+    width = width or max(1, (value.bit_length() + 7) // 8)
+    return _element(element_id, value.to_bytes(width, 'big'))
+
+
+def _info(info, duration):
+    """Info with Duration set (as a double) and stale checksums dropped"""
+    payload = b''
+    pos = 0
+    for element_id, body, body_end in iter_elements(info):
+        if element_id not in (MKV_DURATION, EBML_VOID, EBML_CRC32):
+            payload += info[pos:body_end]
+        pos = body_end
+    return _element(MKV_INFO, payload + _element(MKV_DURATION, struct.pack('>d', duration)))
+
+
+def _cues(clusters, positions, cue_track):
+    points = []
+    for cluster, position in zip(clusters, positions):
+        if cluster['cue'] is None:
+            continue
+        timecode, relative = cluster['cue']
+        points.append(_element(MKV_CUE_POINT, _uint_element(MKV_CUE_TIME, timecode) + _element(
+            MKV_CUE_TRACK_POSITIONS,
+            _uint_element(MKV_CUE_TRACK, cue_track)
+            + _uint_element(MKV_CUE_CLUSTER_POSITION, position, SIZE_WIDTH)
+            + _uint_element(MKV_CUE_RELATIVE_POSITION, relative, SIZE_WIDTH))))
+    return _element(MKV_CUES, b''.join(points))
+
+
+def _seek_head(entries):
+    return _element(MKV_SEEK_HEAD, b''.join(
+        _element(MKV_SEEK, _element(MKV_SEEK_ID, _id_bytes(element_id))
+                 + _uint_element(MKV_SEEK_POSITION, position, SIZE_WIDTH))
+        for element_id, position in entries))
+
+
+def _cluster_header(cluster):
+    return _id_bytes(MKV_CLUSTER) + _size_vint(cluster['length'], SIZE_WIDTH)
+
+
+def _copy(reader, out, start, end):
+    reader.f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        chunk = reader.f.read(min(COPY_CHUNK, remaining))
+        if not chunk:
+            raise RemuxError('Source changed while remuxing')
+        out.write(chunk)
+        remaining -= len(chunk)
+
+
+def remux(source, out):
+    """Write a seekable copy of the WebM/Matroska file at `source` to the
+    binary file object `out`. Returns {'duration', 'cues', 'truncated'}
+    with duration in seconds."""
+    with open(source, 'rb') as f:
+        reader = _Reader(f, os.fstat(f.fileno()).st_size)
+        layout = _scan(reader)
+
+        scale = 1000000
+        for element_id, body, body_end in iter_elements(layout['info']):
+            if element_id == MKV_TIMECODE_SCALE:
+                scale = _uint(layout['info'][body:body_end])
+        if not layout['track_times']:
+            raise RemuxError('No blocks in any cluster')
+        duration = max(timecode + last for timecode, last in layout['track_times'].values())
+        cue_track = _cue_track(layout['tracks'])
+
+        info = _info(layout['info'], float(duration))
+        tracks = _element(MKV_TRACKS, layout['tracks'])
+        clusters = layout['clusters']
+        # Every position below is fixed-width, so sizes can be computed
+        # with placeholder positions and stay valid once they are filled in
+        seek_ids = (MKV_INFO, MKV_TRACKS, MKV_CUES)
+        seek_head_size = len(_seek_head([(element_id, 0) for element_id in seek_ids]))
+        cues_size = len(_cues(clusters, [0] * len(clusters), cue_track))
+        info_at = seek_head_size
+        tracks_at = info_at + len(info)
+        cues_at = tracks_at + len(tracks)
+
+        positions = []
+        position = cues_at + cues_size
+        for cluster in clusters:
+            positions.append(position)
+            position += len(_cluster_header(cluster)) + cluster['length']
+        segment_size = position + sum(end - start for start, end in layout['others'])
+
+        cues = _cues(clusters, positions, cue_track)
+        out.write(reader.read(0, layout['ebml_end']))
+        out.write(_id_bytes(MKV_SEGMENT) + _size_vint(segment_size, SIZE_WIDTH))
+        out.write(_seek_head(zip(seek_ids, (info_at, tracks_at, cues_at))))
+        out.write(info)
+        out.write(tracks)
+        out.write(cues)
+        for cluster in clusters:
+            out.write(_cluster_header(cluster))
+            for start, end in cluster['ranges']:
+                _copy(reader, out, start, end)
+        for start, end in layout['others']:
+            _copy(reader, out, start, end)
+
+    return {'duration': duration * scale / 1e9,
+            'cues': sum(1 for cluster in clusters if cluster['cue'] is not None),
+            'truncated': layout['truncated']}
+
+
+class _HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.hasher = blobstore.new_hasher()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        self.f.write(data)
+
+
+# --- Background stage --------------------------------------------------------
+
+
+def is_recording(filename, mime_type):
+    """Whether a media row is a browser recording, which the remux stage handles"""
+    return mime_type in REMUX_MIME_TYPES and filename.startswith(RECORDING_PREFIX)
+
+
+def replace_media(conn, media_id, media_folder):
+    """Remux media `media_id` in place if it needs it. The result goes into
+    the blob store under its new digest and the media row and upload link
+    are switched over to it. Returns 'done' or 'skipped'; raises RemuxError."""
+    row = conn.execute('SELECT filename, blob_digest, file_size FROM media WHERE id = ?', (media_id,)).fetchone()
+    if row is None:
+        return 'skipped'
+    path = os.path.join(media_folder, row['filename'])
+    if not needs_remux(path):
+        return 'skipped'
+
+    tmp_dir = os.path.join(blobstore.BLOB_FOLDER, 'tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, f'remux-{media_id}-{os.getpid()}')
+    try:
+        with open(tmp_path, 'wb') as f:
+            writer = _HashingWriter(f)
+            result = remux(path, writer)
+        # Check the output parses the way a player will read it
+        with open(tmp_path, 'rb') as f:
+            probe_matroska(f, writer.size)
+    except (ProbeError, IndexError, struct.error) as e:
+        os.remove(tmp_path)
+        raise RemuxError(str(e))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    digest = writer.hasher.hexdigest()
+
+    if row['blob_digest'] is None:
+        # Stored before the blob store: replace the file itself
+        os.replace(tmp_path, path)
+        conn.execute('UPDATE media SET file_size = ?, duration = ? WHERE id = ?',
+                     (writer.size, result['duration'], media_id))
+        conn.commit()
+        return 'done'
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        switched = conn.execute('''UPDATE media SET blob_digest = ?, file_size = ?, duration = ?
+                                   WHERE id = ? AND blob_digest = ?''',
+                                (digest, writer.size, result['duration'], media_id, row['blob_digest'])).rowcount
+        orphans = []
+        if switched:
+            blobstore.put(conn, tmp_path, digest, writer.size)
+            orphans = blobstore.release(conn, [row['blob_digest']])
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        else:
+            # put() had moved it into the store
+            blobstore.remove(conn, [digest])
+        raise
+    if not switched:
+        # Deleted (or replaced) while we worked
+        os.remove(tmp_path)
+        return 'skipped'
+    try:
+        blobstore.link(digest, path)
+    except FileNotFoundError:
+        # Deleted between the commit and here; delete_media removed the blob
+        pass
+    blobstore.remove(conn, orphans)
+    return 'done'
+
+
+class RemuxQueue:
+    """Remux uploaded WebM in the background, one worker thread per process.
+
+    Rows with a NULL remux_status and a WebM MIME type have not been looked
+    at yet; each is claimed with a conditional UPDATE, as ProbeQueue does."""
+
+    def __init__(self, connect, media_folder):
+        self.connect = connect
+        self.media_folder = media_folder
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._worker_pid = None
+        self._stats = {'done': 0, 'skipped': 0, 'failed': 0}
+
+    def start(self):
+        """Start this process's worker, which sweeps up recordings left behind"""
+        self._ensure_worker()
+
+    def enqueue(self, media_id):
+        self._ensure_worker()
+        self._queue.put(media_id)
+
+    def _ensure_worker(self):
+        pid = os.getpid()
+        if self._worker_pid == pid:
+            return
+        with self._lock:
+            if self._worker_pid == pid:
+                return
+            self._worker_pid = pid
+            self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                self._sweep()
+            except sqlite3.Error:
+                pass
+            while True:
+                try:
+                    media_id = self._queue.get(timeout=SWEEP_INTERVAL)
+                except queue.Empty:
+                    break
+                self.remux(media_id)
+
+    def _sweep(self):
+        # Recordings from before this stage existed, and ones whose worker
+        # died mid-remux
+        conn = self.connect()
+        try:
+            conn.execute("""UPDATE media SET remux_status = NULL
+                            WHERE remux_status = 'remuxing' AND COALESCE(remux_claimed_at, 0) < ?""",
+                         (time.time() - STALE_AFTER,))
+            conn.commit()
+            placeholders = ','.join('?' * len(REMUX_MIME_TYPES))
+            ids = [row[0] for row in conn.execute(
+                f'''SELECT id FROM media WHERE remux_status IS NULL AND mime_type IN ({placeholders})
+                    AND substr(filename, 1, ?) = ?''',
+                (*REMUX_MIME_TYPES, len(RECORDING_PREFIX), RECORDING_PREFIX))]
+        finally:
+            conn.close()
+        for media_id in ids:
+            self._queue.put(media_id)
+
+    def remux(self, media_id):
+        conn = self.connect()
+        try:
+            claimed = conn.execute(
+                "UPDATE media SET remux_status = 'remuxing', remux_claimed_at = ? WHERE id = ? AND remux_status IS NULL",
+                (time.time(), media_id)).rowcount
+            conn.commit()
+            if not claimed:
+                return
+            try:
+                status = replace_media(conn, media_id, self.media_folder)
+            except sqlite3.Error:
+                raise
+            except Exception:
+                # RemuxError, OSError, or a parser bug on an odd file: one bad
+                # item must neither stop the worker nor stay 'remuxing'
+                conn.rollback()
+                status = 'failed'
+            conn.execute('UPDATE media SET remux_status = ? WHERE id = ?', (status, media_id))
+            conn.commit()
+            with self._lock:
+                self._stats[status] += 1
+        except sqlite3.Error:
+            # Left 'remuxing'; a later sweep finds it stale and retries
+            pass
+        finally:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot['pending'] = self._queue.qsize()
+        return snapshot